@@ -1,12 +1,28 @@
 #!/usr/bin/env python
 """
-annotator.py -i INPUT -o OUTPUT -d DEPTH_FIELD -v VARIANT_DEPTH_FIELD [-g <True | False>]
+annotator.py <-i INPUT -o OUTPUT | --batch GLOB [GLOB ...] --output-dir DIR | --manifest FILE
+             --output-dir DIR> -d DEPTH_FIELD -v VARIANT_DEPTH_FIELD [-g <True | False>] [-j JOBS]
+             [--cache CACHE] [--cache-max-entries N] [--cache-max-age DAYS] [--store STORE]
+             [--decompress-threads N] [--backend BACKEND] [--record RECORD]
+             [--rate-limit RATE] [--max-retries N] [--checkpoint] [--resume]
+             [--samples <all | SAMPLE1,SAMPLE2,...>]
+             [--output-format <tsv | tsv.gz | tsv.zst | parquet | arrow>]
+             [--fields FIELD1,FIELD2,...] [--metrics METRICS] [--sort] [--sort-memory MB]
+             [--filter FILTERS] [--min-total-reads N] [--min-variant-reads N]
+             [--min-vaf VAF] [--max-vaf VAF] [--variant-types TYPE1,TYPE2,...]
+             [--parse-processes N]
 
-Runs annotator on a specified input VCF, and writes the result to a specified output file.
+Runs annotator on a specified input VCF, and writes the result to a specified output file. In batch
+mode, runs annotator on many input VCFs, annotating the variants they share only once, and writes
+one output file per input.
 
 Args:
-    -i  INPUT (str):               path to the input VCF
-    -o  OUTPUT (str):              path to the output tab-separated file
+    -i  INPUT (str):               path to the input VCF. gzip and BGZF (bgzip) compressed VCFs
+                                   are detected and decompressed on the fly
+    -o  OUTPUT (str):              path to the output file
+    --batch GLOB (str):            batch mode: glob patterns of input VCFs
+    --manifest FILE (str):         batch mode: a file listing one input VCF per line
+    --output-dir DIR (str):        batch mode: the directory to write one output file per input to
     -d  DEPTH_COLUMN (str):        the name of the FORMAT field that specifies total read coverage 
                                    of the variant locus
     -v  VARIANT_DEPTH_FIELD (str): the name of the FORMAT field that specifies variant read 
@@ -14,16 +30,90 @@ Args:
     -g  PER_GENE (boolean):        if enabled, annotator will return one gene annotation per 
                                    variant. Otherwise (by default) will return one annotation per
                                    transcript
+    -j  JOBS (int):                the maximum number of VEP API requests to have in flight at 
+                                   once. Default: 1
+    --cache CACHE (str):           path to a persistent annotation cache. Only variants missing 
+                                   from the cache are sent to the VEP API
+    --cache-max-entries N (int):   the maximum number of variants to keep in the cache
+    --cache-max-age DAYS (float):  the maximum age, in days, of a cached annotation; 0 expires
+                                   every cached annotation
+    --store STORE (str):           path to a local annotation store, built from past results with
+                                   "python -m annotator.store". Variants found in it are not sent
+                                   to the VEP API
+    --decompress-threads N (int):  the number of threads to decompress BGZF input with
+    --backend BACKEND (str):       where to send VEP queries: "ensembl" (default), the base URL of
+                                   a self-hosted VEP REST mirror or of an annotation service
+                                   ("python -m annotator.service"), or a file of recorded responses
+    --record RECORD (str):         a JSON lines file to record every VEP response to, for replaying
+                                   with --backend
+    --rate-limit RATE (float):     the maximum number of VEP REST requests per second. Defaults to
+                                   Ensembl's published limit for the public server
+    --max-retries N (int):         the maximum number of retries of a throttled or failed request
+    --checkpoint (boolean):        journal every completed VEP chunk to OUTPUT.journal, so that a
+                                   failed run can be resumed
+    --resume (boolean):            resume a failed run from OUTPUT.journal, skipping the chunks it
+                                   already completed
+    --samples SAMPLES (str):       annotate several samples of a multi-sample VCF in one pass, 
+                                   writing one row per sample in long format. Either "all" or a 
+                                   comma-separated list of sample names
+    --output-format FORMAT (str):  the output format: tab-separated (tsv), gzip or zstd compressed
+                                   tab-separated (tsv.gz, tsv.zst), Parquet (parquet) or Arrow IPC
+                                   (arrow). Detected from the extension of OUTPUT by default
+    --fields FIELDS (str):         the annotation columns to write, as a comma-separated list of
+                                   field names or SCOPE:KEY[=NAME] specifications. "default" stands
+                                   for the default columns
+    --metrics METRICS (str):       a JSON file to write a report of the run's performance to: the
+                                   time spent in each stage, peak memory, throughput and VEP
+                                   request latency histograms
+    --sort (boolean):              write variants in genomic order: by chromosome, in the order of
+                                   the VCF's ##contig lines or else in natural order, then by
+                                   position. Skipped if the VCF is already sorted
+    --sort-memory MB (float):      the memory budget of --sort, in MB. Larger inputs are sorted in
+                                   runs spilled to temporary files. Default: 512
+    --filter FILTERS (str):        annotate only variants whose FILTER values are in this
+                                   comma-separated list, e.g. "PASS", and none of the values
+                                   prefixed with "!", e.g. "!badReads"
+    --min-total-reads N (int):     annotate only variants with at least N total reads
+    --min-variant-reads N (int):   annotate only variants with at least N variant reads
+    --min-vaf VAF (float):         annotate only variants with a variant read fraction of at least
+                                   VAF
+    --max-vaf VAF (float):         annotate only variants with a variant read fraction of at most
+                                   VAF
+    --variant-types TYPES (str):   annotate only variants of these comma-separated types: SNV,
+                                   substitution, insertion, deletion, indel, sequence_alteration
+    --parse-processes N (int):     the number of processes to parse the VCF with, in shards of
+                                   the file; 0 for one per CPU. Default: 1
 """
 
 import argparse
+import logging
 
 ## Import annotator modules
+import annotator.backends
+import annotator.batch
+import annotator.extract
+import annotator.filters
 import annotator.vcf
 import annotator.vep
 import annotator.main
+import annotator.metrics
+import annotator.output
 
 
+def positive_int(value) -> int:
+    "Parse a command-line argument that must be an integer > 0"
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not an integer > 0")
+    return number
+
+def non_negative_float(value) -> float:
+    "Parse a command-line argument that must be a number >= 0"
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is not a number >= 0")
+    return number
+
 def main():
     "runs the annotator program on the input data if this module is main"
     parser = argparse.ArgumentParser(
@@ -36,15 +126,41 @@ def main():
     parser.add_argument(
         "-i", 
         "--input",
-        help = "Path to input file. It must be a VCF with a properly formatted header.",
+        help = (
+            "Path to input file. It must be a VCF with a properly formatted header. It may be gzip "
+            "or BGZF (bgzip) compressed."
+        ),
         type = str,
-        required = True)
+        default = None)
     parser.add_argument(
         "-o",
         "--output", 
-        help = "Path to the output tab-separated file. If it does not exist, it will be created.",
+        help = (
+            "Path to the output file. If it does not exist, it will be created. Its format is "
+            "detected from its extension (.tsv, .gz, .zst, .parquet, .arrow) unless "
+            "--output-format is given."
+        ),
         type = str,
-        required = True)
+        default = None)
+    parser.add_argument(
+        "--batch",
+        help = (
+            "Batch mode: glob patterns of input VCFs. The variants shared between inputs are only "
+            "annotated once, and one output file per input is written to --output-dir."
+        ),
+        nargs = "+",
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--manifest",
+        help = "Batch mode: a file listing one input VCF path per line.",
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--output-dir",
+        help = "Batch mode: the directory to write one output file (INPUT_NAME.tsv) per input to.",
+        type = str,
+        default = None)
     parser.add_argument(
         "-d",
         "--total_depth",
@@ -64,15 +180,267 @@ def main():
         default = False,
         action = argparse.BooleanOptionalAction
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help = "Maximum number of VEP API requests to have in flight at once. Default: 1",
+        type = positive_int,
+        default = 1)
+    parser.add_argument(
+        "--cache",
+        help = (
+            "Path to a persistent annotation cache (SQLite database). It will be created if it "
+            "does not exist. Only variants missing from the cache are sent to the VEP API."
+        ),
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--cache-max-entries",
+        help = "Maximum number of variants to keep in the cache. Least recently used are evicted.",
+        type = int,
+        default = None)
+    parser.add_argument(
+        "--cache-max-age",
+        help = "Maximum age, in days, of a cached annotation. 0 expires every cached annotation.",
+        type = non_negative_float,
+        default = None)
+    parser.add_argument(
+        "--store",
+        help = (
+            "Path to a local annotation store, built from past journals, caches, recorded "
+            "responses or outputs with 'python -m annotator.store'. Variants found in it are not "
+            "sent to the VEP API."
+        ),
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--decompress-threads",
+        help = "Number of threads to decompress BGZF (bgzip) compressed input with. Default: 1",
+        type = int,
+        default = 1)
+    parser.add_argument(
+        "--backend",
+        help = (
+            "Where to send VEP queries: 'ensembl' for the public Ensembl REST API (default), the "
+            "http(s):// base URL of a self-hosted VEP REST mirror or of an annotation service "
+            "('python -m annotator.service'), or the path to a file of recorded VEP responses to "
+            "replay offline."
+        ),
+        type = str,
+        default = "ensembl")
+    parser.add_argument(
+        "--record",
+        help = "Append every VEP response to this JSON lines file, for replaying with --backend.",
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--rate-limit",
+        help = (
+            "Maximum number of VEP REST requests per second. Defaults to Ensembl's published limit "
+            "for the public server, and no limit for a mirror."
+        ),
+        type = float,
+        default = None)
+    parser.add_argument(
+        "--max-retries",
+        help = (
+            "Maximum number of retries of a throttled (429) or failed request, with exponential "
+            "backoff that honours Retry-After. Default: 5"
+        ),
+        type = int,
+        default = 5)
+    parser.add_argument(
+        "--checkpoint",
+        help = (
+            "Journal every completed VEP chunk to OUTPUT.journal, so that a failed run can be "
+            "resumed with --resume. The journal is removed once the run completes."
+        ),
+        action = "store_true")
+    parser.add_argument(
+        "--resume",
+        help = (
+            "Resume a failed run from its OUTPUT.journal. Chunks completed in the journal are not "
+            "queried again. Implies --checkpoint."
+        ),
+        action = "store_true")
+    parser.add_argument(
+        "--samples",
+        help = (
+            "Annotate several samples of a multi-sample VCF in a single pass: 'all', or a "
+            "comma-separated list of sample names. Each site is queried once, and written once per "
+            "sample with a leading SAMPLE column."
+        ),
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--output-format",
+        help = (
+            "Output format: tab-separated (tsv), gzip or zstd compressed tab-separated (tsv.gz, "
+            "tsv.zst), Parquet (parquet) or Arrow IPC (arrow). zstd requires the zstandard "
+            "package, Parquet and Arrow the pyarrow package. Default: detected from the output "
+            "file extension, or tsv in batch mode."
+        ),
+        choices = annotator.output.OUTPUT_FORMATS,
+        default = None)
+    parser.add_argument(
+        "--fields",
+        help = (
+            "Comma-separated annotation columns to write, after the variant columns. Either "
+            f"names ({', '.join(annotator.extract.FIELDS)}) or SCOPE:KEY[=NAME] for any other "
+            "key of a VEP annotation, where SCOPE is annotation, feature or colocated. 'default' "
+            "stands for the default columns, e.g. --fields default,SIFT,POLYPHEN"
+        ),
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--metrics",
+        help = (
+            "Write a JSON report of the run's performance to this file: wall and CPU time per "
+            "stage (parse, annotate, merge, write), peak memory, variants per second, and "
+            "histograms of VEP request latency, chunk size and response size."
+        ),
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--sort",
+        help = (
+            "Write variants in genomic order: by chromosome, in the order of the VCF's ##contig "
+            "lines or else in natural order (1, 2, ..., 22, X, Y, MT), then by position. Skipped "
+            "if the VCF is already sorted."
+        ),
+        action = "store_true")
+    parser.add_argument(
+        "--sort-memory",
+        help = (
+            "The memory budget of --sort, in MB. Larger inputs are sorted in runs spilled to "
+            "temporary files, and merged. Default: 512"
+        ),
+        type = float,
+        default = 512)
+    parser.add_argument(
+        "--filter",
+        help = (
+            "Annotate only variants whose FILTER values are all in this comma-separated list, "
+            "e.g. PASS, and none of the values prefixed with '!', e.g. '!badReads'. Dropped "
+            "variants are neither sent to VEP nor written."
+        ),
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--min-total-reads",
+        help = "Annotate only variants with at least this many total reads (TOTAL_READS).",
+        type = int,
+        default = None)
+    parser.add_argument(
+        "--min-variant-reads",
+        help = "Annotate only variants with at least this many variant reads (N_VARIANT_READS).",
+        type = int,
+        default = None)
+    parser.add_argument(
+        "--min-vaf",
+        help = "Annotate only variants with at least this variant read fraction.",
+        type = float,
+        default = None)
+    parser.add_argument(
+        "--max-vaf",
+        help = "Annotate only variants with at most this variant read fraction.",
+        type = float,
+        default = None)
+    parser.add_argument(
+        "--variant-types",
+        help = (
+            "Annotate only variants of these comma-separated types: "
+            f"{', '.join(annotator.filters.VARIANT_TYPES)}."
+        ),
+        type = str,
+        default = None)
+    parser.add_argument(
+        "--parse-processes",
+        help = (
+            "Number of processes to read and parse the VCF with, splitting it into shards of the "
+            "file; 0 for one per CPU. Plain and BGZF compressed VCFs are parsed in parallel, "
+            "gzip compressed ones serially. Default: 1"
+        ),
+        type = int,
+        default = 1)
     args = parser.parse_args()
 
-    annotator.main.run_annotator(
-        args.input,
-        args.output,
-        args.total_depth,
-        args.variant_depth,
-        args.per_gene
-    )
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(name)s: %(message)s")
+
+    if args.fields is not None:
+        try:
+            fields = annotator.extract.parse_fields(args.fields)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        fields = None
+
+    try:
+        variant_filter = annotator.filters.VariantFilter(
+            filter_values = args.filter,
+            min_total_reads = args.min_total_reads,
+            min_variant_reads = args.min_variant_reads,
+            min_vaf = args.min_vaf,
+            max_vaf = args.max_vaf,
+            variant_types = args.variant_types.split(",") if args.variant_types else None
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    ## Settings shared by single-file and batch mode
+    kwargs = {
+        "by_gene": args.per_gene,
+        "max_workers": args.jobs,
+        "cache_path": args.cache,
+        "cache_max_entries": args.cache_max_entries,
+        "cache_max_age": args.cache_max_age * 86400 if args.cache_max_age is not None else None,
+        "store_path": args.store,
+        "decompress_threads": args.decompress_threads,
+        "backend": annotator.backends.get_backend(args.backend,
+                                                  record = args.record,
+                                                  rate_limit = args.rate_limit,
+                                                  max_retries = args.max_retries),
+        "samples": args.samples if args.samples in (None, "all") else args.samples.split(","),
+        "output_format": args.output_format,
+        "fields": fields,
+        "metrics": annotator.metrics.Metrics() if args.metrics else None,
+        "sort": args.sort,
+        "sort_memory": args.sort_memory,
+        "variant_filter": variant_filter if variant_filter else None,
+        "parse_processes": args.parse_processes or None
+    }
+
+    if args.batch or args.manifest:
+        if not args.output_dir:
+            parser.error("--output-dir is required in batch mode")
+        if args.checkpoint or args.resume:
+            parser.error("--checkpoint and --resume are not supported in batch mode")
+    elif not args.input or not args.output:
+        parser.error("-i/--input and -o/--output are required, unless in batch mode")
+
+    ## Write the metrics report even if the run fails, since that's when it's most wanted
+    try:
+        if args.batch or args.manifest:
+            annotator.batch.run_batch(
+                annotator.batch.resolve_inputs(args.batch, args.manifest),
+                args.output_dir,
+                args.total_depth,
+                args.variant_depth,
+                **kwargs
+            )
+        else:
+            annotator.main.run_annotator(
+                args.input,
+                args.output,
+                args.total_depth,
+                args.variant_depth,
+                checkpoint = args.checkpoint,
+                resume = args.resume,
+                **kwargs
+            )
+    finally:
+        if kwargs["metrics"] is not None:
+            kwargs["metrics"].write(args.metrics)
 
 if __name__ == "__main__":
     main()
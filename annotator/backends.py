@@ -0,0 +1,257 @@
+"""
+This module implements the annotation backends that vep.get_variant_annotations() sends its queries
+to. A backend takes a list of parsed variant lines and the VEP query parameters, and returns one VEP
+annotation (dict) per variant, in order.
+
+Three backends are provided:
+    RestBackend:      the Ensembl VEP REST API, or any self-hosted mirror of it given its base URL
+    ReplayBackend:    answers from a file of recorded VEP responses, without any network access
+    RecordingBackend: wraps another backend and records its responses to a file for replaying
+"""
+import abc
+import json
+import threading
+
+import annotator.exceptions
+import annotator.jsonutil
+import annotator.transport
+
+## Base URL of the public Ensembl REST API
+ENSEMBL_REST_URL = "https://rest.ensembl.org"
+
+def variant_query(line) -> str:
+    """
+    Format a parsed variant line as a VEP region query string. Per VEP documentation, format is
+    same as VCF 4.0: CHROM POS ID REF ALT QUAL FILTER INFO, space-separated. Sub a period in for ID,
+    QUAL, FILTER, INFO. VEP echoes this string back in the "input" field of its response.
+
+    Args:
+        line (list): a variant, as output by vcf.parse_vcf()
+
+    Returns:
+        The query string for the variant.
+    """
+    return f"{line[0]} {line[1]} . {line[2]} {line[3]} . . ."
+
+class AnnotationBackend(abc.ABC):
+    """
+    Base class of annotation backends. Subclasses implement annotate(), and call this __init__().
+    """
+    def __init__(self):
+        self._retry_listeners = []
+
+    @abc.abstractmethod
+    def annotate(self, vcf_lines, params) -> list:
+        """
+        Annotate a list of variants.
+
+        Args:
+            vcf_lines (list): a non-empty list of variants, as output by vcf.parse_vcf()
+            params (dict):    the VEP query parameters, as returned by vep.vep_parameters()
+
+        Returns:
+            A list of VEP annotations (dicts), one per input variant.
+        """
+
+    @property
+    def last_response_bytes(self):
+        "The size of the raw response to the last annotate() call of this thread, if known"
+        return None
+
+    @property
+    def retry_listeners(self) -> list:
+        """
+        The functions to call, without arguments, whenever a request is retried because the server
+        is throttling or failing, e.g. to send smaller requests. Backends that never retry never
+        call them.
+        """
+        return self._retry_listeners
+
+class RestBackend(AnnotationBackend):
+    """
+    Queries a VEP REST API: the public Ensembl server by default, or a self-hosted mirror.
+
+    Requests share one connection-pooled session, so connections are kept alive between chunks, and
+    go through a client-side token-bucket rate limiter. Throttled (429) and transient server errors
+    are retried with exponential backoff, honouring Retry-After.
+
+    Args:
+        base_url (str):     base URL of the REST server. Default: ENSEMBL_REST_URL
+        species (str):      the species to annotate against. Default: "homo_sapiens"
+        timeout (int):      request timeout, in seconds. Default: 60
+        rate_limit (float): the maximum number of requests per second. Default: Ensembl's published
+                            limit for the public server, None (unlimited) for a mirror
+        max_retries (int):  the maximum number of retries of a failed request. Default: 5
+        pool_size (int):    the number of connections to keep alive. Default: 10
+    """
+    def __init__(self, base_url = ENSEMBL_REST_URL, species = "homo_sapiens", timeout = 60,
+                 rate_limit = None, max_retries = 5, pool_size = 10):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+        self.species = species
+        self.timeout = timeout
+        self.max_retries = max_retries
+        if rate_limit is None and self.base_url == ENSEMBL_REST_URL:
+            rate_limit = annotator.transport.ENSEMBL_RATE_LIMIT
+        if rate_limit:
+            self.rate_limiter = annotator.transport.TokenBucket(rate_limit)
+        else:
+            self.rate_limiter = None
+        self.session = annotator.transport.create_session(pool_size = pool_size)
+        ## Chunks may be annotated from several threads at once
+        self._local = threading.local()
+
+    @property
+    def last_response_bytes(self):
+        return getattr(self._local, "response_bytes", None)
+
+    def _retried(self):
+        "Notify the retry listeners of a retried request"
+        for listener in list(self.retry_listeners):
+            listener()
+
+    def annotate(self, vcf_lines, params) -> list:
+        url = f"{self.base_url}/vep/{self.species}/region"
+        headers={ "Content-Type" : "application/json", "Accept" : "application/json"}
+        ## Build the JSON request body
+        query_string = annotator.jsonutil.dumps_bytes(
+            {"variants": [variant_query(line) for line in vcf_lines]}
+        )
+
+        ## Post the request
+        r = annotator.transport.post(self.session,
+                                     url,
+                                     rate_limiter = self.rate_limiter,
+                                     max_retries = self.max_retries,
+                                     headers = headers,
+                                     data = query_string,
+                                     params = params,
+                                     timeout = self.timeout,
+                                     on_retry = self._retried
+                                     )
+
+        ## Throw an error if the request is an error. A 400 means VEP rejected (a variant of) the
+        ## query itself, so retrying it as is won't help; report the server's reason instead.
+        if r.status_code == 400:
+            raise annotator.exceptions.BadRequestError(
+                f"API request rejected with status 400: {r.text[:1000]}"
+                )
+        if r.status_code != 200:
+            raise annotator.exceptions.RequestError(
+                (
+                    f"API request failed with status {r.status_code}!"
+                    f"See below for the data given to the API:\n{query_string.decode('utf-8')}"
+                )
+                )
+        self._local.response_bytes = len(r.content)
+        ## Decode the raw body, rather than through r.json(), so the fast decoder is used if present
+        return annotator.jsonutil.loads(r.content)
+
+class ReplayBackend(AnnotationBackend):
+    """
+    Answers queries from a file of recorded VEP responses, so that annotation can run (and be tested
+    or benchmarked) without network access.
+
+    The file is either a JSON list of VEP responses, or JSON lines. Each line is either a bare VEP
+    response, which matches any query parameters, or a {"params": ..., "response": ...} record as
+    written by RecordingBackend. Responses are matched to variants on their "input" field.
+
+    Args:
+        path (str): path to the recorded responses
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._responses = {}
+        with open(path, "r", encoding = "utf-8") as f:
+            text = f.read()
+        if text.lstrip().startswith("["):
+            records = annotator.jsonutil.loads(text)
+        else:
+            records = [annotator.jsonutil.loads(l) for l in text.splitlines() if l.strip()]
+        for record in records:
+            if "response" in record:
+                key = (record["response"]["input"], self._params_key(record["params"]))
+                self._responses[key] = record["response"]
+            else:
+                self._responses[(record["input"], None)] = record
+
+    @staticmethod
+    def _params_key(params):
+        return json.dumps(params, sort_keys = True)
+
+    def annotate(self, vcf_lines, params) -> list:
+        params_key = self._params_key(params)
+        out = []
+        for line in vcf_lines:
+            query = variant_query(line)
+            response = self._responses.get((query, params_key), self._responses.get((query, None)))
+            if response is None:
+                raise annotator.exceptions.RequestError(
+                    f"No recorded response for variant {query} in {self.path}"
+                )
+            out.append(response)
+        return out
+
+class RecordingBackend(AnnotationBackend):
+    """
+    Wraps another backend and appends every response it returns to a JSON lines file, which can
+    later be replayed with ReplayBackend.
+
+    Args:
+        backend (AnnotationBackend): the backend to record
+        path (str):                  path to the JSON lines file to append to
+    """
+    def __init__(self, backend, path):
+        super().__init__()
+        self.backend = backend
+        self.path = path
+        ## Chunks may be annotated from several threads at once
+        self._lock = threading.Lock()
+
+    @property
+    def last_response_bytes(self):
+        return self.backend.last_response_bytes
+
+    @property
+    def retry_listeners(self) -> list:
+        return self.backend.retry_listeners
+
+    def annotate(self, vcf_lines, params) -> list:
+        responses = self.backend.annotate(vcf_lines, params)
+        with self._lock:
+            with open(self.path, "a", encoding = "utf-8") as f:
+                for response in responses:
+                    f.write(
+                        annotator.jsonutil.dumps({"params": params, "response": response}) + "\n"
+                    )
+        return responses
+
+def get_backend(spec = None, record = None, rate_limit = None,
+                max_retries = 5) -> AnnotationBackend:
+    """
+    Build a backend from a command-line style specification.
+
+    Args:
+        spec (str):         "ensembl" or None for the public Ensembl REST API, an http(s):// base
+                            URL for a self-hosted REST mirror, or the path to a file of recorded
+                            responses to replay. Default: None
+        record (str):       if given, path to a JSON lines file that every response is appended
+                            to. Default: None
+        rate_limit (float): the maximum number of REST requests per second. Default: None
+                            (Ensembl's published limit for the public server, unlimited for a
+                            mirror)
+        max_retries (int):  the maximum number of retries of a failed REST request. Default: 5
+
+    Returns:
+        An AnnotationBackend.
+    """
+    if spec is None or spec == "ensembl":
+        backend = RestBackend(rate_limit = rate_limit, max_retries = max_retries)
+    elif spec.startswith(("http://", "https://")):
+        backend = RestBackend(spec, rate_limit = rate_limit, max_retries = max_retries)
+    else:
+        backend = ReplayBackend(spec)
+    if record:
+        backend = RecordingBackend(backend, record)
+    return backend
@@ -0,0 +1,281 @@
+"""
+This module implements batch annotation of many VCFs at once. The union of distinct variants across
+all the inputs is annotated once, and then one output file is written per input, so that the number
+of API calls scales with the number of distinct variants rather than the number of files.
+"""
+import glob
+import logging
+import os
+import tempfile
+
+import annotator.backends
+import annotator.cache
+import annotator.chunking
+import annotator.extract
+import annotator.main
+import annotator.metrics
+import annotator.output
+import annotator.shards
+import annotator.store
+import annotator.vcf
+import annotator.vep
+
+logger = logging.getLogger(__name__)
+
+def resolve_inputs(patterns = None, manifest = None) -> list:
+    """
+    Build the list of input VCFs from glob patterns and/or a manifest file.
+
+    Args:
+        patterns (list): glob patterns (or plain paths) of input VCFs. Default: None
+        manifest (str):  path to a manifest with one input VCF path per line. Blank lines and lines
+                         starting with "#" are ignored. Default: None
+
+    Returns:
+        A list of input paths, in the order given, without duplicates.
+
+    Excepts:
+        ValueError: If a pattern matches no files, or there are no inputs at all
+    """
+    paths = []
+    for pattern in patterns or []:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise ValueError(f"No input files match {pattern}")
+        paths.extend(matches)
+    if manifest:
+        with open(manifest, "r", encoding = "utf-8") as f:
+            paths.extend(l.strip() for l in f if l.strip() and not l.startswith("#"))
+    if not paths:
+        raise ValueError("No input files were given")
+    ## Drop duplicates, keeping the first occurrence
+    return list(dict.fromkeys(paths))
+
+def output_path(vcf_path, output_dir, output_format = None) -> str:
+    """
+    Name the output file of an input VCF: its file name without the .gz/.vcf/.txt extensions, with
+    the extension of the output format, in output_dir.
+
+    Args:
+        vcf_path (str):      path to the input VCF
+        output_dir (str):    the output directory
+        output_format (str): one of output.OUTPUT_FORMATS. Default: None (tsv)
+
+    Returns:
+        The output path.
+    """
+    name = os.path.basename(vcf_path)
+    for extension in (".gz", ".bgz", ".vcf", ".txt"):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return os.path.join(output_dir,
+                        name + annotator.output.format_extension(output_format or "tsv"))
+
+def iter_file_variants(vcf_path, total_cov_field, var_cov_field, sample_name = None,
+                       samples = None, decompress_threads = 1, parse_processes = 1):
+    """
+    Lazily read and parse the variant lines of a VCF, as run_annotator() would.
+
+    Args:
+        vcf_path (str):        path to the input VCF
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT coverage.
+        sample_name (str):     the sample to parse in single sample mode. Default: None
+        samples (list):        the samples to parse in multi-sample mode, or "all". Default: None
+        decompress_threads (int): the number of threads used to decompress BGZF input. Default: 1
+        parse_processes (int): the number of processes to parse the VCF with, as by
+                               run_annotator(). Default: 1
+
+    Yields:
+        Variant lines, as output by vcf.parse_vcf().
+    """
+    if parse_processes != 1:
+        records = annotator.shards.iter_parse_vcf_parallel(vcf_path, total_cov_field,
+                                                           var_cov_field,
+                                                           sample_name = sample_name,
+                                                           samples = samples,
+                                                           processes = parse_processes,
+                                                           threads = decompress_threads)
+        if samples:
+            for _, line in records:
+                yield line
+        else:
+            yield from records
+        return
+    if samples:
+        for _, line in annotator.vcf.iter_parse_vcf_samples(
+                annotator.vcf.iter_vcf(vcf_path, threads = decompress_threads),
+                total_cov_field, var_cov_field,
+                samples = None if samples == "all" else samples):
+            yield line
+    else:
+        yield from annotator.vcf.iter_scan_vcf(vcf_path, total_cov_field, var_cov_field,
+                                               sample_name = sample_name,
+                                               threads = decompress_threads)
+
+def run_batch(vcf_paths, output_dir, total_cov_field, var_cov_field, sample_name = None,
+              samples = None, by_gene = False, chunk_size = 200, max_workers = 1,
+              cache_path = None, cache_max_entries = None, cache_max_age = None,
+              decompress_threads = 1, backend = None, output_format = None,
+              fields = None, metrics = None, sort = False, sort_memory = 512,
+              variant_filter = None, parse_processes = 1, store_path = None) -> dict:
+    """
+    Annotates many VCFs, sharing work across them. First, the union of distinct variants across all
+    the inputs is collected and annotated once, into an annotation cache. Then each input is run
+    through run_annotator() against that cache, so no variant is queried twice.
+
+    Args:
+        vcf_paths (list):      paths to the input VCFs, as returned by resolve_inputs()
+        output_dir (str):      the directory to write one output file per input into. Each is
+                               named after its input, as by output_path()
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference)
+                               coverage.
+        sample_name (str):     the sample to annotate in single sample mode. Default: None
+        samples (list):        the samples to annotate in multi-sample mode, or "all".
+                               Default: None
+        by_gene (boolean):     whether to query for impact by transcript (default, False) or the
+                               highest impact per gene (True). Default: False
+        chunk_size (int):      the maximum number of variants to submit per VEP API call.
+                               Default: 200
+        max_workers (int):     the maximum number of VEP API calls to have in flight at once.
+                               Default: 1
+        cache_path (str):      path to a persistent annotation cache. If not given, a temporary
+                               cache is used for the duration of the batch. A persistent cache
+                               should be large enough (cache_max_entries) to hold every distinct
+                               variant of the batch, or evicted variants are queried again.
+                               Default: None
+        cache_max_entries (int): the maximum number of entries to keep in the persistent cache.
+                               Default: None (unbounded)
+        cache_max_age (float): the maximum age in seconds of a persistent cache entry. Default: None
+        decompress_threads (int): the number of threads used to decompress BGZF input. Default: 1
+        backend (object):      the annotator.backends.AnnotationBackend to send queries to.
+                               Default: None (the public Ensembl REST API)
+        output_format (str):   the output format, one of output.OUTPUT_FORMATS. Default: None (tsv)
+        fields (list):         the annotation output columns, as field names or specifications
+                               (see extract.parse_fields()). Default: None (extract.DEFAULT_FIELDS)
+        metrics (object):      an annotator.metrics.Metrics to record the whole batch in, as by
+                               run_annotator(). Default: None (no instrumentation)
+        sort (boolean):        whether to write each output in genomic order, as by run_annotator().
+                               Default: False (input order)
+        sort_memory (float):   the memory budget of sorting, in MB. Default: 512
+        variant_filter (object): an annotator.filters.VariantFilter. Variants it drops are neither
+                               annotated nor written, as by run_annotator(). Default: None
+        parse_processes (int): the number of processes to parse each VCF with, as by
+                               run_annotator(). Default: 1
+        store_path (str):      path to a local annotation store, as built by annotator.store.
+                               Variants found in it are neither cached nor sent to the API.
+                               Default: None (no store)
+
+    Returns:
+        A dict of the number of rows written per output path.
+
+    Excepts:
+        ValueError: If two inputs would be written to the same output path, or chunk_size or
+                    max_workers is not an integer > 0
+    """
+    ## Batches hold chunk_size * max_workers variants, so both must be positive
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise ValueError("Provided chunk size must be an integer > 0")
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise ValueError("Provided max_workers must be an integer > 0")
+    ## Name the outputs, and refuse to silently overwrite one input's output with another's
+    outputs = [output_path(vcf_path, output_dir, output_format) for vcf_path in vcf_paths]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("Several input files have the same name, so their outputs would collide.")
+
+    ## Collect the distinct variants across every input. Only the variant lines are held in
+    ## memory; their annotations go to the cache.
+    union = {}
+    n_variants = 0
+    for vcf_path in vcf_paths:
+        lines = iter_file_variants(vcf_path, total_cov_field, var_cov_field,
+                                   sample_name = sample_name, samples = samples,
+                                   decompress_threads = decompress_threads,
+                                   parse_processes = parse_processes)
+        if metrics is not None:
+            lines = metrics.timed_iter("parse", lines)
+        if variant_filter:
+            lines = variant_filter.apply(lines)
+        for line in lines:
+            n_variants += 1
+            union.setdefault(annotator.backends.variant_query(line), line)
+    logger.info("Batch of %s files: %s variants, %s distinct", len(vcf_paths), n_variants,
+                len(union))
+    if variant_filter:
+        ## The counts of each file are logged again by run_annotator()
+        variant_filter.log_summary("variants across the batch")
+
+    ## Leave out the variants that the local annotation store already holds
+    extractor = annotator.extract.Extractor(fields)
+    if store_path:
+        params = annotator.vep.storage_parameters(annotator.vep.vep_parameters(by_gene, extractor),
+                                                  extractor)
+        with annotator.store.AnnotationStore(store_path) as store:
+            for query, annotation in zip(list(union), store.get_many(list(union.values()),
+                                                                     params)):
+                if annotation is not None:
+                    del union[query]
+            logger.info("Annotation store statistics: %s", store.stats())
+
+    ## Record the requests sent to the backend, and log progress through the distinct variants
+    if metrics is not None:
+        backend = metrics.instrument(backend if backend is not None
+                                     else annotator.vep.default_backend())
+        metrics.progress.add_total(len(union))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ## A cache whose entries expire at once can't hand the annotations on to the outputs, so
+        ## use a temporary one instead
+        if cache_path is None or cache_max_age == 0:
+            cache_path = os.path.join(tmpdir, "cache.sqlite")
+            cache_max_entries = None
+            cache_max_age = None
+
+        ## Annotate the union once, into the cache
+        chunk_sizer = annotator.chunking.AdaptiveChunkSize(chunk_size)
+        with annotator.cache.AnnotationCache(cache_path,
+                                             max_entries = cache_max_entries,
+                                             max_age = cache_max_age) as cache:
+            for batch in annotator.main.iter_batches(union.values(), chunk_size * max_workers):
+                with annotator.metrics.stage(metrics, "annotate"):
+                    annotator.vep.get_cached_annotations(batch,
+                                                         cache,
+                                                         by_gene = by_gene,
+                                                         chunk_size = chunk_size,
+                                                         max_workers = max_workers,
+                                                         backend = backend,
+                                                         extractor = extractor,
+                                                         metrics = metrics,
+                                                         chunk_sizer = chunk_sizer)
+            logger.info("Annotation cache statistics: %s", cache.stats())
+        union.clear()
+
+        ## Write each input's output, with every annotation served from the cache
+        rows_written = {}
+        for vcf_path, output in zip(vcf_paths, outputs):
+            rows_written[output] = annotator.main.run_annotator(
+                vcf_path,
+                output,
+                total_cov_field,
+                var_cov_field,
+                sample_name = sample_name,
+                samples = samples,
+                by_gene = by_gene,
+                chunk_size = chunk_size,
+                max_workers = max_workers,
+                cache_path = cache_path,
+                cache_max_entries = cache_max_entries,
+                cache_max_age = cache_max_age,
+                decompress_threads = decompress_threads,
+                backend = backend,
+                output_format = output_format,
+                fields = fields,
+                metrics = metrics,
+                sort = sort,
+                sort_memory = sort_memory,
+                variant_filter = variant_filter,
+                parse_processes = parse_processes,
+                store_path = store_path
+            )
+    return rows_written
@@ -0,0 +1,225 @@
+"""
+This module handles compressed VCF input. It implements gzip/BGZF detection and a BGZF reader that
+decompresses blocks in parallel.
+
+BGZF (the blocked gzip format used by bgzip/htslib) is a series of independent gzip members of at
+most 64 KiB each, with the size of every block stored in its header. Blocks can therefore be located
+without decompressing anything, and decompressed independently of each other.
+"""
+import collections
+import concurrent.futures
+import gzip
+import io
+import struct
+import zlib
+
+## gzip magic number, and the fixed part of a BGZF block header up to and including the "BC"
+## subfield identifier
+GZIP_MAGIC = b"\x1f\x8b"
+BGZF_HEADER_SIZE = 18
+## Maximum uncompressed payload of a BGZF block, as written by bgzip
+BGZF_BLOCK_SIZE = 0xff00
+## The empty block that terminates a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+def detect_compression(path) -> str:
+    """
+    Detect whether a file is plain, gzip or BGZF compressed from its first bytes.
+
+    Args:
+        path (str): path to the file
+
+    Returns:
+        "bgzf", "gzip" or None for uncompressed files.
+    """
+    with open(path, "rb") as f:
+        header = f.read(BGZF_HEADER_SIZE)
+    if header[:2] != GZIP_MAGIC:
+        return None
+    ## BGZF blocks set FEXTRA, and carry a "BC" subfield of length 2 holding the block size
+    if len(header) == BGZF_HEADER_SIZE and header[3] & 4 and header[12:14] == b"BC" \
+            and header[14:16] == b"\x02\x00":
+        return "bgzf"
+    return "gzip"
+
+def iter_bgzf_blocks(f):
+    """
+    Read the raw (still compressed) blocks of a BGZF file.
+
+    Args:
+        f (file): a BGZF file opened in binary mode
+
+    Yields:
+        Bytes objects, each holding a whole BGZF block.
+
+    Excepts:
+        ValueError: If the file is not BGZF, or a block is truncated
+    """
+    while True:
+        header = f.read(BGZF_HEADER_SIZE)
+        if not header:
+            return
+        if len(header) < BGZF_HEADER_SIZE or header[:2] != GZIP_MAGIC or header[12:14] != b"BC":
+            raise ValueError("Not a BGZF block. The file may be truncated or not BGZF compressed.")
+        ## BSIZE is the total block size minus one
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        rest = f.read(block_size - BGZF_HEADER_SIZE)
+        if len(rest) != block_size - BGZF_HEADER_SIZE:
+            raise ValueError("BGZF block is truncated.")
+        yield header + rest
+
+def block_offsets(path) -> list:
+    """
+    Locate the blocks of a BGZF file from their headers alone, without reading their contents.
+
+    Args:
+        path (str): path to the BGZF file
+
+    Returns:
+        A list of the byte offsets at which each block starts, followed by the size of the file.
+
+    Excepts:
+        ValueError: If the file is not BGZF, or a block is truncated
+    """
+    offsets = []
+    with open(path, "rb") as f:
+        size = f.seek(0, io.SEEK_END)
+        offset = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(BGZF_HEADER_SIZE)
+            if len(header) < BGZF_HEADER_SIZE or header[:2] != GZIP_MAGIC \
+                    or header[12:14] != b"BC":
+                raise ValueError("Not a BGZF block. The file may be truncated or not BGZF "
+                                 "compressed.")
+            offsets.append(offset)
+            offset += struct.unpack("<H", header[16:18])[0] + 1
+        if offset != size:
+            raise ValueError("BGZF block is truncated.")
+    offsets.append(size)
+    return offsets
+
+def decompress_block(block) -> bytes:
+    """
+    Decompress a single BGZF block and verify its checksum.
+
+    Args:
+        block (bytes): a whole BGZF block, as yielded by iter_bgzf_blocks()
+
+    Returns:
+        The decompressed contents of the block.
+
+    Excepts:
+        ValueError: If the checksum or size of the decompressed data do not match the block footer
+    """
+    extra_length = struct.unpack("<H", block[10:12])[0]
+    crc, size = struct.unpack("<II", block[-8:])
+    data = zlib.decompress(block[12 + extra_length:-8], -15)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise ValueError("BGZF block failed its integrity check.")
+    return data
+
+def compress(data) -> bytes:
+    """
+    Compress data to BGZF, as bgzip would. The result is also a valid gzip file.
+
+    Args:
+        data (bytes): the data to compress
+
+    Returns:
+        The BGZF-compressed data, terminated by an empty EOF block.
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        chunk = data[start:start + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        deflated = compressor.compress(chunk) + compressor.flush()
+        header = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+        blocks.append(
+            header
+            + struct.pack("<H", len(header) + 2 + len(deflated) + 8 - 1)
+            + deflated
+            + struct.pack("<II", zlib.crc32(chunk), len(chunk))
+        )
+    blocks.append(BGZF_EOF)
+    return b"".join(blocks)
+
+class BgzfReader(io.RawIOBase):
+    """
+    A read-only binary stream over a BGZF file that decompresses blocks in a thread pool. zlib
+    releases the GIL while inflating, so decompression scales with the number of threads. At most
+    threads * 4 blocks are decompressed ahead of the reader, which bounds memory use.
+
+    Args:
+        path (str):    path to the BGZF file
+        threads (int): the number of decompression threads. Default: 4
+    """
+    def __init__(self, path, threads = 4):
+        super().__init__()
+        if not isinstance(threads, int) or threads < 1:
+            raise ValueError("Provided threads must be an integer > 0")
+        self._f = open(path, "rb")
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = threads)
+        self._blocks = iter_bgzf_blocks(self._f)
+        self._pending = collections.deque()
+        self._lookahead = threads * 4
+        self._buffer = b""
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _next_block(self):
+        "Return the next decompressed block, or None at the end of the file"
+        ## Keep the pool topped up with blocks to decompress
+        while len(self._pending) < self._lookahead:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._pending.append(self._executor.submit(decompress_block, block))
+        if not self._pending:
+            return None
+        return self._pending.popleft().result()
+
+    def readinto(self, b):
+        ## Skip over empty blocks (such as the EOF marker) until there's data or the file ends
+        while self._offset >= len(self._buffer):
+            data = self._next_block()
+            if data is None:
+                return 0
+            self._buffer = data
+            self._offset = 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait = True)
+            self._f.close()
+        super().close()
+
+def open_text(path, threads = 1):
+    """
+    Open a plain, gzip or BGZF compressed file for reading as UTF-8 text, detecting the compression
+    from the file contents rather than its extension.
+
+    Args:
+        path (str):    path to the file
+        threads (int): the number of threads to decompress BGZF input with. Plain gzip can't be
+                       decompressed in parallel, so it is always read with a single thread.
+                       Default: 1
+
+    Returns:
+        A text file object.
+    """
+    compression = detect_compression(path)
+    if compression == "bgzf" and threads > 1:
+        return io.TextIOWrapper(io.BufferedReader(BgzfReader(path, threads = threads)),
+                                encoding = "utf-8")
+    if compression is not None:
+        return gzip.open(path, "rt", encoding = "utf-8")
+    return open(path, "r", encoding = "utf-8")
@@ -0,0 +1,181 @@
+"""
+This module implements a persistent, on-disk cache of VEP annotations. Annotations are stored as
+JSON in a SQLite database, keyed by variant and the VEP parameters used to query for it, so that
+repeated runs over overlapping cohorts only query the API for variants they have not seen.
+
+The annotator stores annotations pruned to the parts its output columns read (see
+vep.prune_annotation()), not the raw VEP responses, and adds those parts to the parameters it keys
+them on (see vep.storage_parameters()). An entry is therefore only reused by runs that write the
+same output columns; runs with other columns miss and query VEP again.
+"""
+import json
+import sqlite3
+import time
+
+import annotator.jsonutil
+
+class AnnotationCache:
+    """
+    A SQLite-backed cache of VEP annotations, keyed on (CHROM, POS, REF, ALT, per_gene, VEP
+    parameters). Annotations are stored as given, pruned or not.
+
+    Entries can be evicted by age (entries older than max_age seconds are dropped) and by size (the
+    least recently used entries are dropped once there are more than max_entries). Hits, misses,
+    stores and evictions are counted over the lifetime of the object.
+
+    Args:
+        path (str):        path to the SQLite database. It will be created if it does not exist.
+        max_entries (int): the maximum number of entries to keep. Default: None (unbounded)
+        max_age (float):   the maximum age of an entry in seconds, 0 to expire every entry.
+                           Default: None (never expires)
+    """
+    def __init__(self, path, max_entries = None, max_age = None):
+        if max_entries is not None and max_entries < 1:
+            raise ValueError("Provided max_entries must be an integer > 0")
+        if max_age is not None and max_age < 0:
+            raise ValueError("Provided max_age must be >= 0")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS annotations ("
+            "chrom TEXT, pos TEXT, ref TEXT, alt TEXT, per_gene INTEGER, params TEXT, "
+            "response TEXT, created REAL, accessed REAL, "
+            "PRIMARY KEY (chrom, pos, ref, alt, per_gene, params))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS accessed_idx ON annotations (accessed)")
+        self._conn.commit()
+        ## Drop anything that expired since the last run
+        self.evict()
+
+    @staticmethod
+    def _key(line, params):
+        "Build the cache key of a variant line, as output by vcf.parse_vcf()"
+        return (
+            str(line[0]),
+            str(line[1]),
+            str(line[2]),
+            str(line[3]),
+            int(params.get("per_gene") == "true"),
+            json.dumps(params, sort_keys = True)
+        )
+
+    def get_many(self, vcf_lines, params) -> list:
+        """
+        Look up the cached annotations of a list of variants.
+
+        Args:
+            vcf_lines (list): a list of variants, as output by vcf.parse_vcf()
+            params (dict):    the VEP query parameters, as returned by vep.vep_parameters()
+
+        Returns:
+            A list with one element per input variant: the cached VEP annotation (dict), or None if
+            the variant is not in the cache.
+        """
+        now = time.time()
+        out = []
+        hit_keys = []
+        for line in vcf_lines:
+            key = self._key(line, params)
+            row = self._conn.execute(
+                "SELECT response, created FROM annotations WHERE chrom = ? AND pos = ? AND ref = ? "
+                "AND alt = ? AND per_gene = ? AND params = ?",
+                key
+            ).fetchone()
+            ## Treat expired entries as misses. They'll be overwritten when re-queried.
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
+                out.append(None)
+            else:
+                self.hits += 1
+                hit_keys.append((now,) + key)
+                out.append(annotator.jsonutil.loads(row[0]))
+
+        ## Bump the access time of the hits, for LRU eviction
+        self._conn.executemany(
+            "UPDATE annotations SET accessed = ? WHERE chrom = ? AND pos = ? AND ref = ? "
+            "AND alt = ? AND per_gene = ? AND params = ?",
+            hit_keys
+        )
+        self._conn.commit()
+        return out
+
+    def put_many(self, vcf_lines, annotations, params):
+        """
+        Store the annotations of a list of variants.
+
+        Args:
+            vcf_lines (list):   a list of variants, as output by vcf.parse_vcf()
+            annotations (list): the VEP annotations (dicts), one per element of vcf_lines
+            params (dict):      the VEP query parameters, as returned by vep.vep_parameters()
+        """
+        now = time.time()
+        rows = [
+            self._key(line, params) + (annotator.jsonutil.dumps(annotation), now, now)
+            for line, annotation in zip(vcf_lines, annotations)
+        ]
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO annotations "
+            "(chrom, pos, ref, alt, per_gene, params, response, created, accessed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        self._conn.commit()
+        self.stores += len(rows)
+        self.evict()
+
+    def evict(self) -> int:
+        """
+        Drop entries older than max_age, then the least recently used entries beyond max_entries.
+
+        Returns:
+            The number of evicted entries.
+        """
+        evicted = 0
+        if self.max_age is not None:
+            evicted += self._conn.execute(
+                "DELETE FROM annotations WHERE created < ?", (time.time() - self.max_age,)
+            ).rowcount
+        if self.max_entries is not None:
+            evicted += self._conn.execute(
+                "DELETE FROM annotations WHERE rowid IN (SELECT rowid FROM annotations "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            ).rowcount
+        self._conn.commit()
+        self.evictions += evicted
+        return evicted
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            A dict of the hit/miss/store/eviction counters, the hit rate and the number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 5) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "entries": len(self)
+        }
+
+    def close(self):
+        "Close the underlying database connection"
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,71 @@
+"""
+This module implements adaptive chunk sizing for VEP requests. The number of variants per request
+starts at the maximum (by default Ensembl's limit of 200), shrinks when requests get slow, their
+responses get large, or the server fails, and grows back gradually once requests are fast again.
+"""
+import math
+import threading
+
+## Ensembl's limit on the number of variants in one POST to the VEP region endpoint
+MAX_POST_SIZE = 200
+
+class AdaptiveChunkSize:
+    """
+    A thread-safe controller of the number of variants to send per request, shared by the chunks of
+    a run. It adapts like TCP congestion control: it decreases multiplicatively on server errors,
+    and in proportion to the overshoot on slow or oversized responses, and increases additively on
+    fast, small responses.
+
+    Args:
+        maximum (int):            the maximum (and starting) chunk size. Default: MAX_POST_SIZE
+        minimum (int):            the minimum chunk size. Default: 1
+        target_latency (float):   the request latency to stay under, in seconds. Requests taking
+                                  less than half of it let the chunk size grow. Default: 20
+        max_response_bytes (int): the response size to stay under, in bytes.
+                                  Default: 32 MB
+    """
+    def __init__(self, maximum = MAX_POST_SIZE, minimum = 1, target_latency = 20.0,
+                 max_response_bytes = 32 << 20):
+        if not isinstance(maximum, int) or maximum < 1:
+            raise ValueError("Provided chunk size must be an integer > 0")
+        self.maximum = maximum
+        self.minimum = max(1, min(minimum, maximum))
+        self.target_latency = target_latency
+        self.max_response_bytes = max_response_bytes
+        ## Grow back from the minimum to the maximum in about ten fast requests
+        self.step = max(1, math.ceil(maximum / 10))
+        self._size = maximum
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        "The number of variants to send in the next request"
+        return self._size
+
+    def _set(self, size):
+        self._size = max(self.minimum, min(self.maximum, int(size)))
+
+    def success(self, variants, seconds, response_bytes = None):
+        """
+        Adapt to a successful request.
+
+        Args:
+            variants (int):       the number of variants in the request
+            seconds (float):      the latency of the request
+            response_bytes (int): the size of the response, if known. Default: None
+        """
+        ## How far over its targets the request was: shrink the chunk size to match
+        overshoot = seconds / self.target_latency if self.target_latency else 0
+        if response_bytes is not None and self.max_response_bytes:
+            overshoot = max(overshoot, response_bytes / self.max_response_bytes)
+        with self._lock:
+            if overshoot > 1:
+                self._set(min(self._size, variants / overshoot))
+            elif overshoot < 0.5 and variants >= self._size:
+                ## Only grow on requests that were full sized, not short tail chunks
+                self._set(self._size + self.step)
+
+    def failure(self):
+        "Adapt to a failed request (a server error or timeout), by halving the chunk size"
+        with self._lock:
+            self._set(self._size // 2)
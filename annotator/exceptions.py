@@ -7,3 +7,6 @@ class MalformedDataError(Exception):
 
 class RequestError(Exception):
     "Raise this exception when an API call returns a non-200 code"
+
+class BadRequestError(RequestError):
+    "Raise this exception when an API call is rejected as malformed (a 400 code)"
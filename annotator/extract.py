@@ -0,0 +1,337 @@
+"""
+This module builds output lines from variants and their VEP annotations. The annotation columns are
+described by a declarative list of fields, which an Extractor compiles once; every annotation is
+then walked a single time, however many columns are requested.
+
+A field reads one of three parts of a VEP annotation, its scope:
+    annotation: a top-level key of the annotation, e.g. variant_class
+    feature:    a key of each transcript (or intergenic) consequence. One output line is written
+                per consequence
+    colocated:  an aggregate over the colocated (known) variants: "dbsnp" for dbSNP IDs, "cosmic"
+                for COSMIC IDs, "frequency" for the population allele frequency of the alt allele,
+                or any other key, whose distinct values are collected
+Lists are joined with semicolons, and missing values are written as "NA".
+
+For speed, the fields are compiled once into a list of column getters, each bound to its key and
+the way its value is formatted, so that building a line does no per-field dispatch.
+"""
+import typing
+
+## The leading output columns, which come from the variant itself rather than its annotation
+VARIANT_COLUMNS = [
+    "CHROM", "POS", "REF", "ALT", "FILTER", "N_VARIANT_READS", "TOTAL_READS",
+    "VARIANT_READ_FRACTION"
+]
+
+SCOPES = ("annotation", "feature", "colocated")
+
+class Field(typing.NamedTuple):
+    """
+    An annotation output column.
+
+    name:   the output column name
+    scope:  the part of the annotation to read the value from, one of SCOPES
+    key:    the key to read within that scope
+    params: extra VEP query parameters needed for VEP to return the value, or None
+    kind:   the kind of value VEP returns for a feature key: "value" for a single value, written as
+            is, "list" for a list, joined with semicolons, or "any" if not known
+    """
+    name: str
+    scope: str
+    key: str
+    params: typing.Optional[dict] = None
+    kind: str = "any"
+
+## Fields that can be requested by name
+FIELDS = {field.name: field for field in [
+    Field("VARIANT_TYPE", "annotation", "variant_class"),
+    Field("MOST_SEVERE_CONSEQUENCE", "annotation", "most_severe_consequence"),
+    Field("GENE_ID", "feature", "gene_id", kind = "value"),
+    Field("GENE_SYMBOL", "feature", "gene_symbol", kind = "value"),
+    Field("TRANSCRIPT_ID", "feature", "transcript_id", kind = "value"),
+    Field("IMPACT", "feature", "impact", kind = "value"),
+    Field("CONSEQUENCE_TERMS", "feature", "consequence_terms", kind = "list"),
+    Field("HGVSP", "feature", "hgvsp", kind = "value"),
+    Field("HGVSC", "feature", "hgvsc", kind = "value"),
+    Field("BIOTYPE", "feature", "biotype", kind = "value"),
+    Field("SIFT", "feature", "sift_prediction", kind = "value"),
+    Field("SIFT_SCORE", "feature", "sift_score", kind = "value"),
+    Field("POLYPHEN", "feature", "polyphen_prediction", kind = "value"),
+    Field("POLYPHEN_SCORE", "feature", "polyphen_score", kind = "value"),
+    Field("CANONICAL", "feature", "canonical", {"canonical": "1"}, kind = "value"),
+    Field("DBSNP_ID", "colocated", "dbsnp"),
+    Field("COSMIC_ID", "colocated", "cosmic"),
+    Field("POP_AF", "colocated", "frequency"),
+    Field("CLIN_SIG", "colocated", "clin_sig")
+]}
+
+## The annotation columns written by default
+DEFAULT_FIELDS = [
+    "VARIANT_TYPE", "GENE_ID", "GENE_SYMBOL", "TRANSCRIPT_ID", "IMPACT", "CONSEQUENCE_TERMS",
+    "HGVSP", "DBSNP_ID", "COSMIC_ID", "POP_AF"
+]
+
+## The annotation keys that hold the consequences of a variant, one output line per consequence
+CONSEQUENCE_KEYS = ["transcript_consequences", "intergenic_consequences"]
+
+def parse_field(spec) -> Field:
+    """
+    Parse a field specification: either the name of a field in FIELDS, or SCOPE:KEY for any other
+    key of an annotation, optionally named with SCOPE:KEY=NAME (the column name defaults to the key
+    in upper case).
+
+    Args:
+        spec (str): the field specification, e.g. "SIFT" or "feature:amino_acids=AA"
+
+    Returns:
+        A Field.
+
+    Excepts:
+        ValueError: If spec is not a known field name or a valid SCOPE:KEY specification
+    """
+    if spec in FIELDS:
+        return FIELDS[spec]
+    if ":" not in spec:
+        raise ValueError(
+            f"Unknown field {spec}. Use one of {', '.join(FIELDS)}, or SCOPE:KEY[=NAME]"
+        )
+    scope, key = spec.split(":", 1)
+    key, _, name = key.partition("=")
+    if scope not in SCOPES or not key:
+        raise ValueError(f"Invalid field {spec}, the scope must be one of {', '.join(SCOPES)}")
+    return Field(name or key.upper(), scope, key)
+
+def parse_fields(specs) -> list:
+    """
+    Parse a comma-separated list of field specifications, as by parse_field(). The name "default"
+    stands for DEFAULT_FIELDS, so that "default,SIFT" adds a column to the default ones.
+
+    Args:
+        specs (str or list): the field specifications
+
+    Returns:
+        A list of Fields.
+
+    Excepts:
+        ValueError: If a specification is invalid, or two fields have the same name
+    """
+    if isinstance(specs, str):
+        specs = specs.split(",")
+    fields = []
+    for spec in specs:
+        spec = spec.strip()
+        if spec == "default":
+            fields.extend(FIELDS[name] for name in DEFAULT_FIELDS)
+        elif spec:
+            fields.append(parse_field(spec))
+    names = [field.name for field in fields]
+    if len(set(names)) != len(names) or set(names) & set(VARIANT_COLUMNS):
+        raise ValueError(f"Duplicate output column names in fields: {', '.join(names)}")
+    return fields
+
+def format_value(value) -> str:
+    "Format an annotation value for output"
+    if value is None or value == []:
+        return "NA"
+    if isinstance(value, list):
+        return ";".join(map(str, value))
+    return value if isinstance(value, str) else str(value)
+
+def _column_getter(is_feature, index, feature_fields):
+    """
+    Build the function that reads the value of one column of an output line.
+
+    Args:
+        is_feature (bool):     whether the value is read from each consequence, or from the values
+                               shared by all the lines of a variant
+        index (int):           the index of the value's field in feature_fields, or of the value
+                               in the shared values
+        feature_fields (list): the Fields read from each consequence
+
+    Returns:
+        A function of (shared, feature), returning the column's value.
+    """
+    if not is_feature:
+        return lambda shared, feature: shared[index]
+    field = feature_fields[index]
+    key = field.key
+    if field.kind == "value":
+        return lambda shared, feature: feature.get(key, "NA")
+    if field.kind == "list":
+        return lambda shared, feature: ";".join(feature.get(key) or ["NA"])
+    return lambda shared, feature: format_value(feature.get(key))
+
+def _compile_line_function(layout, feature_fields):
+    """
+    Build the function that builds the output lines of a variant from its variant columns
+    (prefix), the values shared by all its lines (shared) and its consequences (features).
+
+    Args:
+        layout (list):         for each field, a tuple of (is_feature, index): the index of its
+                               value in feature_fields or in shared
+        feature_fields (list): the Fields read from each consequence
+
+    Returns:
+        A function of (prefix, shared, features), returning one output line per feature.
+    """
+    getters = [_column_getter(is_feature, index, feature_fields) for is_feature, index in layout]
+    def lines(prefix, shared, features):
+        return [prefix + [getter(shared, feature) for getter in getters] for feature in features]
+    return lines
+
+class Extractor:
+    """
+    Builds output lines from variants and their VEP annotations, according to a list of fields.
+    The fields are compiled once, when the extractor is created.
+
+    Args:
+        fields (list):           the annotation columns, as Fields or field specifications (see
+                                 parse_fields()). Default: None (DEFAULT_FIELDS)
+        consequence_keys (list): the annotation keys holding the consequences to write one line
+                                 each for. Default: None (CONSEQUENCE_KEYS)
+    """
+    def __init__(self, fields = None, consequence_keys = None):
+        if fields is None:
+            fields = DEFAULT_FIELDS
+        self.fields = [
+            field if isinstance(field, Field) else parse_field(field) for field in fields
+        ]
+        if not self.fields:
+            raise ValueError("At least one field must be given")
+        self.consequence_keys = list(consequence_keys or CONSEQUENCE_KEYS)
+        self.columns = VARIANT_COLUMNS + [field.name for field in self.fields]
+
+        ## Compile the fields: the keys to read in each scope, and for each column where its value
+        ## ends up. Values shared by all the lines of a variant (annotation and colocated fields)
+        ## go in one list, and per-consequence values in another.
+        self._annotation_keys = []
+        self._colocated_keys = []
+        self._feature_fields = []
+        layout = []
+        self.params = {}
+        for field in self.fields:
+            if field.scope == "annotation":
+                layout.append((False, len(self._annotation_keys)))
+                self._annotation_keys.append(field.key)
+            elif field.scope == "colocated":
+                layout.append((False, None))
+                self._colocated_keys.append(field.key)
+            elif field.scope == "feature":
+                layout.append((True, len(self._feature_fields)))
+                self._feature_fields.append(field)
+            else:
+                raise ValueError(f"Invalid scope {field.scope} of field {field.name}")
+            self.params.update(field.params or {})
+        ## Colocated values are stored after the annotation values
+        colocated = iter(range(len(self._annotation_keys), len(self.fields)))
+        layout = [
+            (is_feature, next(colocated) if index is None else index)
+            for is_feature, index in layout
+        ]
+        self._lines = _compile_line_function(layout, self._feature_fields)
+        self._other_colocated_keys = [
+            key for key in self._colocated_keys if key not in ("dbsnp", "cosmic", "frequency")
+        ]
+
+    @property
+    def prune_fields(self) -> dict:
+        """
+        The parts of a VEP annotation that this extractor reads, in the format taken by
+        vep.prune_annotation().
+        """
+        feature_keys = sorted(set(field.key for field in self._feature_fields))
+        colocated = set()
+        for key in self._colocated_keys:
+            if key == "dbsnp":
+                colocated.add("id")
+            elif key == "cosmic":
+                colocated.update(("id", "allele_string"))
+            elif key == "frequency":
+                colocated.add("frequencies")
+            else:
+                colocated.add(key)
+        fields = {key: None for key in ["input"] + self._annotation_keys}
+        if feature_keys:
+            fields.update({key: tuple(feature_keys) for key in self.consequence_keys})
+        if colocated:
+            fields["colocated_variants"] = tuple(sorted(colocated))
+        return fields
+
+    def _colocated_values(self, colocated_data, alt) -> list:
+        "Aggregate the colocated fields over the colocated variants, in one pass"
+        dbsnp = []
+        cosmic = []
+        frequencies = None
+        other = {key: [] for key in self._other_colocated_keys}
+        for element in colocated_data or ():
+            element_id = element.get("id")
+            if element_id:
+                ## VEP doesn't match COSMIC IDs with the actual allele of interest, so all the
+                ## COSMIC variants at the locus are returned
+                if element.get("allele_string") == "COSMIC_MUTATION":
+                    cosmic.append(element_id)
+                if element_id.startswith("rs"):
+                    dbsnp.append(element_id)
+            ## Population allele frequencies should be the same for every colocated variant that
+            ## has them, so the first is used
+            if frequencies is None and element.get("frequencies"):
+                frequencies = element["frequencies"]
+            for key, values in other.items():
+                value = element.get(key)
+                if value is None:
+                    continue
+                for v in value if isinstance(value, list) else [value]:
+                    if v not in values:
+                        values.append(v)
+
+        values = []
+        for key in self._colocated_keys:
+            if key == "dbsnp":
+                values.append(format_value(dbsnp))
+            elif key == "cosmic":
+                values.append(format_value(cosmic))
+            elif key == "frequency":
+                ## Use the "af" frequency of our alt allele, falling back to "gnomade"
+                af_dict = (frequencies or {}).get(alt, {})
+                values.append(format_value(af_dict.get("af", af_dict.get("gnomade"))))
+            else:
+                values.append(format_value(other[key]))
+        return values
+
+    def extract(self, variant, annotation) -> list:
+        """
+        Build the output lines of a variant and its annotation.
+
+        Args:
+            variant (list):    a variant, as output by vcf.parse_vcf()
+            annotation (dict): the VEP annotation of the variant
+
+        Returns:
+            A list of output lines, one per consequence (gene/transcript), or a single line with
+            "NA" consequence fields if the annotation has none. Each line is the variant, its
+            variant read fraction ("NA" if it has no reads, as samples of joint-called VCFs may),
+            and the fields in order.
+        """
+        total_reads = int(variant[6])
+        if total_reads:
+            vaf = str(round(int(variant[5]) / total_reads, ndigits = 5))
+        else:
+            vaf = "NA"
+        prefix = list(variant) + [vaf]
+
+        shared = [format_value(annotation.get(key)) for key in self._annotation_keys]
+        if self._colocated_keys:
+            shared += self._colocated_values(annotation.get("colocated_variants"), variant[3])
+
+        ## One line per consequence, in order of consequence_keys
+        features = None
+        for consequence_key in self.consequence_keys:
+            consequences = annotation.get(consequence_key)
+            if consequences:
+                features = consequences if features is None else features + consequences
+        if features is None:
+            features = ({},)
+        return self._lines(prefix, shared, features)
+
+## The extractor of the default output columns
+DEFAULT_EXTRACTOR = Extractor()
@@ -0,0 +1,178 @@
+"""
+This module implements filtering of parsed variants before annotation, so that calls that would be
+thrown away downstream (failed filters, low depth, near-zero variant allele fractions, unwanted
+variant types) are never sent to VEP.
+"""
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+## Variant types, named as VEP's variant_class
+VARIANT_TYPES = ["SNV", "substitution", "insertion", "deletion", "indel", "sequence_alteration"]
+
+def variant_type(ref, alt) -> str:
+    """
+    Classify a variant from its alleles, as VEP's variant_class would for most variants.
+
+    Args:
+        ref (str): the reference allele
+        alt (str): the alternate allele
+
+    Returns:
+        One of VARIANT_TYPES: "sequence_alteration" for symbolic or breakend alleles.
+    """
+    if not alt.isalpha() or not ref.isalpha():
+        return "sequence_alteration"
+    if len(ref) == len(alt):
+        return "SNV" if len(ref) == 1 else "substitution"
+    if len(alt) > len(ref) and alt.startswith(ref):
+        return "insertion"
+    if len(ref) > len(alt) and ref.startswith(alt):
+        return "deletion"
+    return "indel"
+
+def parse_filter_values(spec):
+    """
+    Parse a FILTER expression: a comma-separated list of FILTER values to keep, and/or values to
+    drop, prefixed with "!". For example "PASS" keeps only passing calls, and "!badReads" drops
+    calls that failed badReads.
+
+    Args:
+        spec (str): the expression
+
+    Returns:
+        A tuple of the set of values to keep (None for any) and the set of values to drop.
+
+    Excepts:
+        ValueError: If the expression is empty
+    """
+    keep = set()
+    drop = set()
+    for value in spec.split(","):
+        value = value.strip()
+        if value.startswith("!") and len(value) > 1:
+            drop.add(value[1:])
+        elif value and value != "!":
+            keep.add(value)
+    if not keep and not drop:
+        raise ValueError(f"Empty FILTER expression: {spec!r}")
+    return keep or None, drop
+
+class VariantFilter:
+    """
+    A filter of parsed variants. A variant is kept only if it passes every criterion given; by
+    default, everything is kept. The reasons variants were dropped for are counted.
+
+    Args:
+        filter_values (str):     a FILTER expression, as for parse_filter_values(). A variant's
+                                 FILTER may hold several values, separated by ";": it is kept if
+                                 all of them are kept and none is dropped. Default: None (any)
+        min_total_reads (int):   the minimum TOTAL_READS. Default: None
+        min_variant_reads (int): the minimum N_VARIANT_READS. Default: None
+        min_vaf (float):         the minimum variant read fraction. Default: None
+        max_vaf (float):         the maximum variant read fraction. Default: None
+        variant_types (list):    the variant types to keep, among VARIANT_TYPES. Default: None
+                                 (any)
+
+    Excepts:
+        ValueError: If a variant type is unknown, or the read fraction range is empty
+    """
+    def __init__(self, filter_values = None, min_total_reads = None, min_variant_reads = None,
+                 min_vaf = None, max_vaf = None, variant_types = None):
+        if variant_types is not None:
+            unknown = set(variant_types) - set(VARIANT_TYPES)
+            if unknown:
+                raise ValueError(f"Unknown variant types {', '.join(sorted(unknown))}. Known "
+                                 f"types are {', '.join(VARIANT_TYPES)}")
+        if min_vaf is not None and max_vaf is not None and min_vaf > max_vaf:
+            raise ValueError("The minimum variant read fraction is above the maximum")
+        self.dropped = collections.Counter()
+        self.kept = 0
+
+        ## Build the list of checks up front, so that each variant only runs those that apply
+        checks = []
+        if filter_values is not None:
+            keep, drop = parse_filter_values(filter_values)
+            def check_filter(v):
+                values = v.filter.split(";")
+                return (keep is None or all(value in keep for value in values)) \
+                    and not any(value in drop for value in values)
+            checks.append(("FILTER", check_filter))
+        if min_total_reads is not None:
+            checks.append(("TOTAL_READS", lambda v: v.total_reads >= min_total_reads))
+        if min_variant_reads is not None:
+            checks.append(("N_VARIANT_READS", lambda v: v.var_reads >= min_variant_reads))
+        if min_vaf is not None or max_vaf is not None:
+            low = 0.0 if min_vaf is None else min_vaf
+            high = 1.0 if max_vaf is None else max_vaf
+            checks.append((
+                "VARIANT_READ_FRACTION",
+                lambda v: v.total_reads > 0 and low <= v.var_reads / v.total_reads <= high
+            ))
+        if variant_types is not None:
+            types = frozenset(variant_types)
+            checks.append(("VARIANT_TYPE", lambda v: variant_type(v.ref, v.alt) in types))
+        self.checks = checks
+
+    def __bool__(self):
+        "Whether the filter can drop anything"
+        return bool(self.checks)
+
+    def reject_reason(self, variant):
+        """
+        Check a variant against the filter.
+
+        Args:
+            variant (Variant): the variant
+
+        Returns:
+            The name of the first criterion the variant fails, or None if it is kept.
+        """
+        for name, check in self.checks:
+            if not check(variant):
+                return name
+        return None
+
+    def apply(self, variants, record = None):
+        """
+        Lazily filter variants (or records holding them), counting what is kept and dropped.
+
+        Args:
+            variants (iterable): the variants, as output by vcf.iter_parse_vcf()
+            record (int):        for records that hold a variant, such as the (sample, variant)
+                                 tuples of vcf.iter_parse_vcf_samples(), the index of the variant.
+                                 Default: None (the items are variants)
+
+        Yields:
+            The variants (or records) that pass the filter, in order.
+        """
+        if not self.checks:
+            yield from variants
+            return
+        reject_reason = self.reject_reason
+        dropped = self.dropped
+        for variant in variants:
+            reason = reject_reason(variant if record is None else variant[record])
+            if reason is None:
+                self.kept += 1
+                yield variant
+            else:
+                dropped[reason] += 1
+
+    def log_summary(self, name = "variants"):
+        """
+        Log how many variants were kept, and how many were dropped for each reason, since the last
+        summary. The counts are then reset.
+
+        Args:
+            name (str): what was filtered, for the log message. Default: "variants"
+        """
+        if not self.checks:
+            return
+        total = self.kept + sum(self.dropped.values())
+        logger.info("Filtering kept %s of %s %s; dropped: %s", self.kept, total, name,
+                    ", ".join(f"{count} on {reason}" for reason, count in
+                              self.dropped.most_common()) or "none")
+        self.kept = 0
+        self.dropped.clear()
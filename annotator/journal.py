@@ -0,0 +1,112 @@
+"""
+This module implements a checkpoint journal for long annotation runs. Every chunk that comes back
+from VEP is appended to the journal along with its boundaries (the queries it was made of), so that
+a run that fails part way can be resumed without re-querying the chunks that were already done.
+"""
+import json
+import os
+import threading
+
+import annotator.backends
+import annotator.jsonutil
+
+class Journal:
+    """
+    An append-only JSON lines journal of completed VEP chunks. Each line records one chunk: its
+    query parameters, the query strings of its variants in order, and the raw VEP responses.
+
+    Args:
+        path (str):       path to the journal file
+        resume (boolean): whether to load the chunks of an existing journal and keep appending to
+                          it. Otherwise any existing journal is discarded. Default: False
+    """
+    def __init__(self, path, resume = False):
+        self.path = path
+        self.chunks_skipped = 0
+        self.chunks_recorded = 0
+        self._responses = {}
+        self._lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            with open(path, "r", encoding = "utf-8") as f:
+                for l in f:
+                    try:
+                        entry = annotator.jsonutil.loads(l)
+                    except annotator.jsonutil.JSONDecodeError:
+                        ## A crash can leave the last line half-written. Drop it; the chunk will be
+                        ## re-queried.
+                        continue
+                    params_key = self._params_key(entry["params"])
+                    for query, response in zip(entry["queries"], entry["responses"]):
+                        self._responses[(query, params_key)] = response
+        self._f = open(path, "a" if resume else "w", encoding = "utf-8")
+
+    @staticmethod
+    def _params_key(params):
+        return json.dumps(params, sort_keys = True)
+
+    def __len__(self):
+        return len(self._responses)
+
+    def lookup(self, vcf_lines, params):
+        """
+        Look up a chunk in the journal.
+
+        Args:
+            vcf_lines (list): the chunk's variants, as output by vcf.parse_vcf()
+            params (dict):    the VEP query parameters, as returned by vep.vep_parameters()
+
+        Returns:
+            The journaled responses, one per variant, if every variant of the chunk was completed
+            in a previous run. Otherwise None.
+        """
+        params_key = self._params_key(params)
+        responses = [
+            self._responses.get((annotator.backends.variant_query(line), params_key))
+            for line in vcf_lines
+        ]
+        if any(response is None for response in responses):
+            return None
+        with self._lock:
+            self.chunks_skipped += 1
+        return responses
+
+    def record(self, vcf_lines, params, responses):
+        """
+        Append a completed chunk to the journal, and flush it to disk.
+
+        Args:
+            vcf_lines (list): the chunk's variants, as output by vcf.parse_vcf()
+            params (dict):    the VEP query parameters, as returned by vep.vep_parameters()
+            responses (list): the VEP responses, one per variant
+        """
+        entry = {
+            "params": params,
+            "queries": [annotator.backends.variant_query(line) for line in vcf_lines],
+            "responses": responses
+        }
+        line = annotator.jsonutil.dumps(entry) + "\n"
+        ## Chunks may complete on several threads at once
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self.chunks_recorded += 1
+
+    def close(self, remove = False):
+        """
+        Close the journal.
+
+        Args:
+            remove (boolean): whether to delete the journal file, e.g. once the run has completed.
+                              Default: False
+        """
+        self._f.close()
+        if remove:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
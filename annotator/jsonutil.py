@@ -0,0 +1,58 @@
+"""
+This module implements JSON encoding and decoding for VEP requests and responses. If the optional
+orjson package is installed it is used, since it decodes large VEP responses several times faster
+than the standard library and allocates less while doing so. Otherwise the standard library json
+module is used. Both produce the same Python objects.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+## Raised by loads() on malformed input. orjson's decode error is a subclass of the standard one.
+JSONDecodeError = json.JSONDecodeError
+
+def loads(data):
+    """
+    Decode a JSON document.
+
+    Args:
+        data (str or bytes): the JSON document
+
+    Returns:
+        The decoded object.
+
+    Excepts:
+        JSONDecodeError: If data is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps_bytes(obj) -> bytes:
+    """
+    Encode an object as compact, UTF-8 encoded JSON, e.g. for a request body.
+
+    Args:
+        obj (object): the object to encode
+
+    Returns:
+        The JSON document, as bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators = (",", ":"), ensure_ascii = False).encode("utf-8")
+
+def dumps(obj) -> str:
+    """
+    Encode an object as compact JSON.
+
+    Args:
+        obj (object): the object to encode
+
+    Returns:
+        The JSON document, as a string.
+    """
+    return dumps_bytes(obj).decode("utf-8")
@@ -1,18 +1,174 @@
 """ This module contains the main runner function, run_annotator"""
-import os
+import itertools
+import logging
 
+import annotator.backends
+import annotator.cache
+import annotator.chunking
+import annotator.extract
+import annotator.journal
+import annotator.metrics
+import annotator.output
+import annotator.shards
+import annotator.sort
+import annotator.store
 import annotator.vcf
 import annotator.vep
 
+logger = logging.getLogger(__name__)
+
+def iter_batches(iterable, batch_size, key = None):
+    """
+    Lazily split an iterable into lists of batch_size elements. The last batch may be shorter.
+
+    Args:
+        iterable (iterable): the elements to batch
+        batch_size (int):    the maximum number of elements per batch
+        key (function):      if given, batches hold up to batch_size distinct keys rather than
+                             batch_size elements, e.g. so that a batch of per-sample records holds
+                             batch_size distinct variants. Default: None
+
+    Yields:
+        Lists of at most batch_size elements (or distinct keys), in input order.
+    """
+    iterator = iter(iterable)
+    if key is None:
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    batch = []
+    keys = set()
+    for element in iterator:
+        element_key = key(element)
+        if element_key not in keys and len(keys) == batch_size:
+            yield batch
+            batch = []
+            keys = set()
+        keys.add(element_key)
+        batch.append(element)
+    if batch:
+        yield batch
+
+def sort_variants(vcf_lines, vcf_path, record = None, memory_mb = 512, threads = 1):
+    """
+    Sort the variants parsed from a VCF in genomic order, in the order of the VCF's ##contig lines
+    or else in natural order, unless the VCF is already sorted.
+
+    Args:
+        vcf_lines (iterable): the variants (or records holding them) parsed from the VCF
+        vcf_path (str):       path to the VCF
+        record (int):         for records holding a variant, the index of the variant, as for
+                              sort.variant_key(). Default: None
+        memory_mb (float):    the memory budget of sorting, in MB. Default: 512
+        threads (int):        the number of threads used to decompress BGZF input. Default: 1
+
+    Returns:
+        An iterable of the variants, in sorted order.
+    """
+    contigs = annotator.sort.read_contigs(vcf_path)
+    if annotator.sort.vcf_is_sorted(vcf_path, contigs, threads = threads):
+        logger.info("%s is already sorted", vcf_path)
+        return vcf_lines
+    logger.info("Sorting the variants of %s", vcf_path)
+    return annotator.sort.iter_sorted(vcf_lines,
+                                      annotator.sort.variant_key(contigs, record = record),
+                                      memory_mb = memory_mb)
+
+def iter_records(vcf_path, total_cov_field, var_cov_field, sample_name = None, samples = None,
+                 decompress_threads = 1, parse_processes = 1):
+    """
+    Lazily read and parse the records of a VCF, as run_annotator() does. With several parse
+    processes, the VCF is split into shards that are parsed in parallel.
+
+    Args:
+        vcf_path (str):        path to the VCF
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference)
+                               coverage.
+        sample_name (str):     the sample to parse in single sample mode. Default: None
+        samples (list):        the samples to parse in multi-sample mode, or "all". Default: None
+        decompress_threads (int): the number of threads used to decompress BGZF input. Default: 1
+        parse_processes (int): the number of processes to parse the VCF with. None for one per
+                               CPU. Default: 1
+
+    Returns:
+        An iterator of variant lines, as output by vcf.parse_vcf(), or in multi-sample mode of
+        (sample, variant line) tuples.
+    """
+    if parse_processes != 1:
+        return annotator.shards.iter_parse_vcf_parallel(vcf_path,
+                                                        total_cov_field,
+                                                        var_cov_field,
+                                                        sample_name = sample_name,
+                                                        samples = samples,
+                                                        processes = parse_processes,
+                                                        threads = decompress_threads)
+    if samples:
+        return annotator.vcf.iter_parse_vcf_samples(
+            annotator.vcf.iter_vcf(vcf_path, threads = decompress_threads),
+            total_cov_field,
+            var_cov_field,
+            samples = None if samples == "all" else samples
+            )
+    ## Uncompressed VCFs are scanned from a memory map
+    return annotator.vcf.iter_scan_vcf(
+        vcf_path,
+        total_cov_field,
+        var_cov_field,
+        sample_name = sample_name,
+        threads = decompress_threads
+        )
+
+def count_records(records, variant_filter = None, record = None) -> int:
+    """
+    Count the records that a filter keeps, without counting them in its summary.
+
+    Args:
+        records (iterable):      the variants, or records holding them
+        variant_filter (object): an annotator.filters.VariantFilter. Default: None (every record)
+        record (int):            for records that hold a variant, the index of the variant.
+                                 Default: None (the records are variants)
+
+    Returns:
+        The number of records kept.
+    """
+    if not variant_filter:
+        return sum(1 for _ in records)
+    reject_reason = variant_filter.reject_reason
+    return sum(1 for r in records if reject_reason(r if record is None else r[record]) is None)
+
 def run_annotator(vcf_path, output, total_cov_field, var_cov_field, sample_name = None,
-                  by_gene = False, chunk_size = 200):
+                  by_gene = False, chunk_size = 200, max_workers = 1, cache_path = None,
+                  cache_max_entries = None, cache_max_age = None, decompress_threads = 1,
+                  backend = None, checkpoint = False, resume = False, samples = None,
+                  output_format = None, fields = None, metrics = None, sort = False,
+                  sort_memory = 512, variant_filter = None, parse_processes = 1,
+                  store_path = None) -> int:
     """
-    Reads and parses the input VCF, makes an API call to Ensembl VEP, annotates variants and 
-    returns the resulting JSON
+    Reads and parses the input VCF, makes API calls to Ensembl VEP, annotates variants and writes
+    them to a tab-separated (optionally compressed), Parquet or Arrow file.
+
+    This runs as a streaming pipeline: read -> parse -> batch -> annotate -> write. Variants are
+    read and parsed lazily, and annotated chunk_size * max_workers variants at a time; each batch's
+    rows are flushed to the output as soon as it is done. Memory use therefore does not depend on
+    the size of the input, and the output holds every finished batch if the run is interrupted.
+    The input is parsed once more up front, only to count its variants, so that progress is logged
+    with an estimate of the time left.
+    Variants are written in input order, which for a VCF is usually sorted by position, or in
+    genomic order if sort is set. Variants that VEP
+    rejects as malformed, or returns no result for, are logged, and written with NA annotations,
+    rather than failing the run.
+
+    In multi-sample mode (samples is given), each site is annotated once and written once per
+    sample, in long format: a SAMPLE column is added in front, and N_VARIANT_READS, TOTAL_READS and
+    VARIANT_READ_FRACTION are those of the sample.
     
     Args:
-        vcf_path (str):        path to the input VCF
-        output (str):          path to the output tab-separated variants file
+        vcf_path (str):        path to the input VCF, optionally gzip or BGZF (bgzip) compressed
+        output (str):          path to the output variants file
         total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
         var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference) 
                                coverage.
@@ -20,40 +176,195 @@ def run_annotator(vcf_path, output, total_cov_field, var_cov_field, sample_name
                                the program will take the first column after FORMAT. Default: None
         by_gene (boolean):     whether to query for impact by transcript (default, False) or the 
                                highest impact per gene (True). Default: False
-        chunk_size (int):      the maximum number of variants to submit per VEP API call. 
-                               Default: 200
+        chunk_size (int):      the maximum number of variants to submit per VEP API call. Fewer
+                               are sent while requests are slow or failing. Default: 200
+        max_workers (int):     the maximum number of VEP API calls to have in flight at once.
+                               Default: 1
+        cache_path (str):      path to a persistent annotation cache (SQLite database). Variants
+                               found in the cache are not sent to the API. Default: None (no cache)
+        cache_max_entries (int): the maximum number of entries to keep in the cache. 
+                               Default: None (unbounded)
+        cache_max_age (float): the maximum age in seconds of a cache entry. Default: None (never
+                               expires)
+        decompress_threads (int): the number of threads used to decompress BGZF input.
+                               Default: 1
+        backend (object):      the annotator.backends.AnnotationBackend to send queries to.
+                               Default: None (the public Ensembl REST API)
+        checkpoint (boolean):  whether to journal every completed VEP chunk to OUTPUT.journal, so
+                               that a failed run can be resumed. The journal is removed once the
+                               run completes. Default: False
+        resume (boolean):      whether to resume from the journal of a previous failed run. Chunks
+                               completed in the journal are not queried again; the output is
+                               rewritten in full. Implies checkpoint. Default: False
+        samples (list):        the names of the samples to annotate in multi-sample mode, or "all"
+                               for every sample column. Overrides sample_name. Default: None
+                               (single sample mode)
+        output_format (str):   the output format, one of output.OUTPUT_FORMATS. Default: None
+                               (detected from the extension of output, plain TSV if unknown)
+        fields (list):         the annotation output columns, as field names or specifications
+                               (see extract.parse_fields()). Default: None (extract.DEFAULT_FIELDS)
+        metrics (object):      an annotator.metrics.Metrics to record the time spent in each stage
+                               (parse, annotate, merge, write), the VEP requests and the number of
+                               variants and rows in. Default: None (no instrumentation)
+        sort (boolean):        whether to annotate and write the variants in genomic order: by
+                               chromosome, in the order of the VCF's ##contig lines or else in
+                               natural order, then by position. Sorting is skipped if the VCF is
+                               already sorted. Otherwise no output is written until the whole VCF
+                               has been read. Default: False (input order)
+        sort_memory (float):   the memory budget of sorting, in MB. Larger inputs are sorted in
+                               runs spilled to temporary files. Default: 512
+        variant_filter (object): an annotator.filters.VariantFilter. Variants it drops are
+                               neither annotated nor written; in multi-sample mode, it applies to
+                               each sample's variant. Default: None (every variant)
+        parse_processes (int): the number of processes to read and parse the VCF with, in shards
+                               of the file. None for one per CPU. gzip (but not BGZF) compressed
+                               VCFs are always parsed by a single process. Default: 1
+        store_path (str):      path to a local annotation store, as built by annotator.store.
+                               Variants found in it are neither looked up in the cache nor sent to
+                               the API. Default: None (no store)
 
     Returns:
-        a list of lists, each corresponding to an variant:genetic feature combination. For example,
-        a variant affecting five transcripts/genes would have five corresponding lines.
+        the number of rows written, each corresponding to a variant:genetic feature combination. For
+        example, a variant affecting five transcripts/genes would have five corresponding lines.
+
+    Excepts:
+        ValueError: If chunk_size or max_workers is not an integer > 0
     """
-    ## Call the VCF reading function
-    vcf = annotator.vcf.read_vcf(vcf_path)
+    ## Batches hold chunk_size * max_workers variants, so both must be positive
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise ValueError("Provided chunk size must be an integer > 0")
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise ValueError("Provided max_workers must be an integer > 0")
+    ## Compile the output columns once, up front
+    extractor = annotator.extract.Extractor(fields)
 
-    ## Call the parsing function
-    vcf_lines = annotator.vcf.parse_vcf(
-        vcf,
-        total_cov_field,
-        var_cov_field,
-        sample_name = sample_name
-        )
+    ## Read and parse the VCF lazily. Nothing is read until the first batch is requested.
+    ## In multi-sample mode, the parser yields (sample, variant line) tuples.
+    def parse():
+        return iter_records(vcf_path, total_cov_field, var_cov_field, sample_name = sample_name,
+                            samples = samples, decompress_threads = decompress_threads,
+                            parse_processes = parse_processes)
+    vcf_lines = parse()
+    if samples:
+        if metrics is not None:
+            vcf_lines = metrics.timed_iter("parse", vcf_lines)
+        if variant_filter:
+            vcf_lines = variant_filter.apply(vcf_lines, record = 1)
+        if sort:
+            vcf_lines = sort_variants(vcf_lines, vcf_path, record = 1, memory_mb = sort_memory,
+                                      threads = decompress_threads)
+        batches = iter_batches(vcf_lines, chunk_size * max_workers,
+                               key = lambda record: annotator.backends.variant_query(record[1]))
+        columns = ["SAMPLE"] + extractor.columns
+    else:
+        if metrics is not None:
+            vcf_lines = metrics.timed_iter("parse", vcf_lines)
+        if variant_filter:
+            vcf_lines = variant_filter.apply(vcf_lines)
+        if sort:
+            vcf_lines = sort_variants(vcf_lines, vcf_path, memory_mb = sort_memory,
+                                      threads = decompress_threads)
+        batches = iter_batches(vcf_lines, chunk_size * max_workers)
+        columns = extractor.columns
 
-    ## Annotate the VCF lines using the received annotations
-    out_list = annotator.vep.annotate_variants(vcf_lines,
-                                               chunk_size = chunk_size,
-                                               by_gene = by_gene)
+    ## Record the requests sent to the backend
+    if metrics is not None:
+        backend = metrics.instrument(backend if backend is not None
+                                     else annotator.vep.default_backend())
 
-    ## Create output path if it does not exist
-    os.makedirs(os.path.dirname(output), exist_ok = True)
+    ## Open the annotation cache, if requested
+    if cache_path:
+        cache = annotator.cache.AnnotationCache(cache_path,
+                                                max_entries = cache_max_entries,
+                                                max_age = cache_max_age)
+    else:
+        cache = None
 
-    ## Write the tsv to output
-    with open(output, "w", encoding = "UTF-8") as f:
-        f.write(
-            "CHROM\tPOS\tREF\tALT\tFILTER\tN_VARIANT_READS\tTOTAL_READS\tVARIANT_READ_FRACTION\t"
-            "VARIANT_TYPE\tGENE_ID\tGENE_SYMBOL\tTRANSCRIPT_ID\tIMPACT\tCONSEQUENCE_TERMS\tHGVSP\t"
-            "DBSNP_ID\tCOSMIC_ID\tPOP_AF\n"
-            )
-        for line in out_list:
-            f.write("%s\n" % "\t".join(line))
+    ## Open the local annotation store, if requested
+    store = annotator.store.AnnotationStore(store_path) if store_path else None
+
+    ## Adapt the number of variants per request over the whole run
+    chunk_sizer = annotator.chunking.AdaptiveChunkSize(chunk_size)
+
+    ## Open the checkpoint journal next to the output, if requested
+    if checkpoint or resume:
+        journal = annotator.journal.Journal(output + ".journal", resume = resume)
+        if resume:
+            logger.info("Resuming from %s completed variants in %s", len(journal), journal.path)
+    else:
+        journal = None
+
+    ## Count the variants to annotate up front, so that progress is logged with the share done and
+    ## an estimate of the time left over the whole run
+    progress = metrics.progress if metrics is not None else annotator.metrics.Progress()
+    progress.add_total(count_records(parse(), variant_filter, record = 1 if samples else None))
+
+    ## Annotate one batch at a time, and write each batch out as soon as it's done. Batches are
+    ## large enough to keep every worker busy with a full chunk.
+    completed = False
+    try:
+        with annotator.output.open_writer(output,
+                                          columns = columns,
+                                          output_format = output_format) as writer:
+            for batch in batches:
+                done = progress.done
+                if samples:
+                    ## Sites shared by several samples are only queried once, since
+                    ## annotate_variants deduplicates them
+                    grouped = annotator.vep.annotate_variants([line for _, line in batch],
+                                                              chunk_size = chunk_size,
+                                                              by_gene = by_gene,
+                                                              max_workers = max_workers,
+                                                              cache = cache,
+                                                              backend = backend,
+                                                              journal = journal,
+                                                              flatten = False,
+                                                              extractor = extractor,
+                                                              metrics = metrics,
+                                                              chunk_sizer = chunk_sizer,
+                                                              progress = progress,
+                                                              store = store)
+                    rows = [
+                        [sample] + line
+                        for (sample, _), lines in zip(batch, grouped) for line in lines
+                    ]
+                else:
+                    rows = annotator.vep.annotate_variants(batch,
+                                                           chunk_size = chunk_size,
+                                                           by_gene = by_gene,
+                                                           max_workers = max_workers,
+                                                           cache = cache,
+                                                           backend = backend,
+                                                           journal = journal,
+                                                           extractor = extractor,
+                                                           metrics = metrics,
+                                                           chunk_sizer = chunk_sizer,
+                                                           progress = progress,
+                                                           store = store)
+                with annotator.metrics.stage(metrics, "write"):
+                    writer.write_rows(rows)
+                ## The variants sent to VEP are counted as they are annotated, and the rest (stored,
+                ## cached or duplicate ones) once the batch is written
+                progress.update(len(batch) - (progress.done - done))
+                if metrics is not None:
+                    metrics.count("variants", len(batch))
+                    metrics.count("rows", len(rows))
+        completed = True
+    finally:
+        if variant_filter:
+            if metrics is not None:
+                metrics.count("filtered_variants", sum(variant_filter.dropped.values()))
+            variant_filter.log_summary("sample variants" if samples else "variants")
+        if cache is not None:
+            logger.info("Annotation cache statistics: %s", cache.stats())
+            cache.close()
+        if store is not None:
+            logger.info("Annotation store statistics: %s", store.stats())
+            store.close()
+        ## Keep the journal around for --resume unless the run completed
+        if journal is not None:
+            logger.info("Checkpoint journal: %s chunks skipped, %s chunks recorded",
+                        journal.chunks_skipped, journal.chunks_recorded)
+            journal.close(remove = completed)
 
-    return out_list
+    return writer.rows_written
@@ -0,0 +1,404 @@
+"""
+This module implements opt-in instrumentation of annotation runs. A Metrics object collects the
+wall and CPU time of each pipeline stage, the peak resident memory, throughput, and histograms of
+the latency, size and response size of every VEP request. Its report is a JSON-serializable dict.
+
+Hooks can be registered to follow a run as it happens: each is called with an event name and a
+dict of data, for the events:
+    "stage":    a stage finished one of its steps (stage, wall_seconds, cpu_seconds)
+    "request":  a VEP request completed or failed (variants, seconds, response_bytes, error)
+    "progress": progress was logged (done, total, rate, eta_seconds)
+
+Progress logs the number of variants annotated so far, their rate and, when the total is known, an
+estimate of the time remaining.
+"""
+import contextlib
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import annotator.backends
+
+logger = logging.getLogger(__name__)
+
+## Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+## Upper bounds of the request size histogram buckets, in variants
+CHUNK_SIZE_BUCKETS = (1, 10, 25, 50, 100, 150, 200, 300)
+## Upper bounds of the response size histogram buckets, in bytes
+RESPONSE_BYTES_BUCKETS = (1 << 10, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24)
+
+def peak_rss_mb() -> float:
+    "The peak resident set size of this process so far, in MB, or None if it can't be measured"
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 2)
+
+def stage(metrics, name):
+    """
+    Time a step of a stage if metrics are being collected, as a context manager.
+
+    Args:
+        metrics (object): a Metrics, or None to do nothing
+        name (str):       the stage
+
+    Returns:
+        A context manager.
+    """
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name)
+
+class Histogram:
+    """
+    A histogram with fixed bucket bounds, along with the count, sum, minimum and maximum of the
+    observed values. Not thread-safe; Metrics guards its histograms with a lock.
+
+    Args:
+        bounds (tuple): the upper bounds of the buckets, in increasing order. Values above the last
+                        bound fall into a final, unbounded bucket
+    """
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        "Add a value to the histogram"
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in (the maximum, for the last
+        bucket).
+
+        Args:
+            q (float): the quantile, between 0 and 1
+
+        Returns:
+            The estimate, or None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return round(min(bound, self.max), 6)
+        return round(self.max, 6)
+
+    def report(self) -> dict:
+        "The histogram, as a JSON-serializable dict"
+        buckets = [{"le": bound, "count": count} for bound, count in zip(self.bounds, self.counts)]
+        buckets.append({"le": None, "count": self.counts[-1]})
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "min": round(self.min, 6) if self.count else None,
+            "max": round(self.max, 6) if self.count else None,
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": buckets
+        }
+
+class Progress:
+    """
+    A thread-safe progress counter that logs how many variants are done, their rate and, if the
+    total is known, an estimate of the time remaining. Logs at most once per interval, so short
+    runs are not logged at all.
+
+    Args:
+        total (int):      the total number of variants, if known. Default: None
+        interval (float): the minimum number of seconds between two log messages. Default: 10
+        label (str):      what is being counted. Default: "variants annotated"
+        metrics (object): a Metrics whose hooks to send "progress" events to. Default: None
+    """
+    def __init__(self, total = None, interval = 10.0, label = "variants annotated",
+                 metrics = None):
+        self.total = total
+        self.interval = interval
+        self.label = label
+        self.metrics = metrics
+        self.done = 0
+        self._start = time.monotonic()
+        self._logged = self._start
+        self._lock = threading.Lock()
+
+    def add_total(self, n):
+        "Add n variants to the total, for totals that are discovered as the run goes"
+        with self._lock:
+            self.total = (self.total or 0) + n
+
+    def update(self, n):
+        "Count n more variants as done, and log progress if the interval has elapsed"
+        now = time.monotonic()
+        with self._lock:
+            self.done += n
+            if now - self._logged < self.interval:
+                return
+            self._logged = now
+            done, total = self.done, self.total
+        rate = done / (now - self._start)
+        eta = (total - done) / rate if total and rate else None
+        if total:
+            logger.info("%s/%s %s (%.1f%%), %.1f/s, ETA %s", done, total, self.label,
+                        100 * done / total, rate,
+                        datetime.timedelta(seconds = round(eta)) if eta is not None else "unknown")
+        else:
+            logger.info("%s %s, %.1f/s", done, self.label, rate)
+        if self.metrics is not None:
+            self.metrics.emit("progress", {"done": done, "total": total, "rate": rate,
+                                           "eta_seconds": eta})
+
+class Metrics:
+    """
+    Collects the metrics of one or more annotation runs. Pass it to main.run_annotator() (or
+    batch.run_batch()), then call report() or write().
+
+    Args:
+        hooks (list):              callables to call with (event, data) for every event. See
+                                   add_hook(). Default: None
+        progress_interval (float): the minimum number of seconds between two progress log
+                                   messages. Default: 10
+    """
+    def __init__(self, hooks = None, progress_interval = 10.0):
+        self.hooks = list(hooks or [])
+        self.progress = Progress(interval = progress_interval, metrics = self)
+        self.stages = {}
+        self.counters = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.chunk_sizes = Histogram(CHUNK_SIZE_BUCKETS)
+        self.response_bytes = Histogram(RESPONSE_BYTES_BUCKETS)
+        self.request_errors = 0
+        self._start = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """
+        Register a hook, called with (event, data) for every event: "stage", "request" or
+        "progress". Hooks may be called from worker threads, and should return quickly.
+
+        Args:
+            hook (callable): the hook
+        """
+        self.hooks.append(hook)
+
+    def emit(self, event, data):
+        "Call every hook with an event"
+        for hook in self.hooks:
+            hook(event, data)
+
+    def count(self, name, n = 1):
+        "Add n to a counter, such as the number of variants or rows"
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_stage(self, name, wall, cpu):
+        """
+        Add a step of a stage. Stages are made of many steps in a streaming run, one per batch.
+
+        Args:
+            name (str):   the stage
+            wall (float): the wall time of the step, in seconds
+            cpu (float):  the CPU time of the process during the step, in seconds
+        """
+        with self._lock:
+            stage = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                  "steps": 0})
+            stage["wall_seconds"] += wall
+            stage["cpu_seconds"] += cpu
+            stage["steps"] += 1
+        self.emit("stage", {"stage": name, "wall_seconds": wall, "cpu_seconds": cpu})
+
+    def stage(self, name):
+        """
+        Time a step of a stage, as a context manager:
+
+            with metrics.stage("write"):
+                writer.write_rows(rows)
+
+        Args:
+            name (str): the stage
+        """
+        return _StageTimer(self, name)
+
+    def timed_iter(self, name, iterable):
+        """
+        Lazily iterate, timing the production of each item as part of a stage. This times the
+        stages of a streaming pipeline, whose work happens as items are pulled through.
+
+        Args:
+            name (str):          the stage
+            iterable (iterable): the iterable to time
+
+        Yields:
+            The items of iterable.
+        """
+        iterator = iter(iterable)
+        wall = cpu = 0.0
+        steps = 0
+        try:
+            while True:
+                start, start_cpu = time.perf_counter(), time.process_time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    wall += time.perf_counter() - start
+                    cpu += time.process_time() - start_cpu
+                steps += 1
+                ## Record in batches, rather than take the lock for every item
+                if steps % 1000 == 0:
+                    self.record_stage(name, wall, cpu)
+                    wall = cpu = 0.0
+                yield item
+        finally:
+            if wall or cpu:
+                self.record_stage(name, wall, cpu)
+
+    def record_request(self, variants, seconds, response_bytes = None, error = None):
+        """
+        Add a VEP request.
+
+        Args:
+            variants (int):       the number of variants in the request
+            seconds (float):      the latency of the request, retries included
+            response_bytes (int): the size of the response body, if known. Default: None
+            error (str):          the error the request failed with, if it did. Default: None
+        """
+        with self._lock:
+            if error is None:
+                self.latency.observe(seconds)
+                self.chunk_sizes.observe(variants)
+                if response_bytes is not None:
+                    self.response_bytes.observe(response_bytes)
+            else:
+                self.request_errors += 1
+        self.emit("request", {"variants": variants, "seconds": seconds,
+                              "response_bytes": response_bytes, "error": error})
+
+    def instrument(self, backend):
+        """
+        Wrap an annotation backend so that its requests are recorded.
+
+        Args:
+            backend (AnnotationBackend): the backend
+
+        Returns:
+            An InstrumentedBackend. Backends that are already instrumented are returned as is.
+        """
+        if isinstance(backend, InstrumentedBackend) and backend.metrics is self:
+            return backend
+        return InstrumentedBackend(backend, self)
+
+    def report(self) -> dict:
+        "The metrics collected so far, as a JSON-serializable dict"
+        wall = time.perf_counter() - self._start
+        with self._lock:
+            variants = self.counters.get("variants", 0)
+            return {
+                "wall_seconds": round(wall, 4),
+                "cpu_seconds": round(time.process_time() - self._start_cpu, 4),
+                "peak_rss_mb": peak_rss_mb(),
+                "variants_per_second": round(variants / wall, 2) if wall else None,
+                "counters": dict(self.counters),
+                "stages": {
+                    name: {
+                        "wall_seconds": round(stage["wall_seconds"], 4),
+                        "cpu_seconds": round(stage["cpu_seconds"], 4),
+                        "steps": stage["steps"]
+                    }
+                    for name, stage in self.stages.items()
+                },
+                "requests": {
+                    "count": self.latency.count,
+                    "errors": self.request_errors,
+                    "latency_seconds": self.latency.report(),
+                    "chunk_size": self.chunk_sizes.report(),
+                    "response_bytes": self.response_bytes.report()
+                }
+            }
+
+    def write(self, path):
+        """
+        Write the report as JSON.
+
+        Args:
+            path (str): the path to write to
+        """
+        with open(path, "w", encoding = "utf-8") as f:
+            json.dump(self.report(), f, indent = 2)
+            f.write("\n")
+
+class _StageTimer:
+    "Context manager timing one step of a stage, returned by Metrics.stage()"
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record_stage(self.name, time.perf_counter() - self.start,
+                                  time.process_time() - self.start_cpu)
+
+class InstrumentedBackend(annotator.backends.AnnotationBackend):
+    """
+    Wraps another backend and records the latency, size and response size of every request to a
+    Metrics object.
+
+    Args:
+        backend (AnnotationBackend): the backend to instrument
+        metrics (Metrics):           the metrics to record to
+    """
+    def __init__(self, backend, metrics):
+        super().__init__()
+        self.backend = backend
+        self.metrics = metrics
+
+    @property
+    def last_response_bytes(self):
+        return self.backend.last_response_bytes
+
+    @property
+    def retry_listeners(self) -> list:
+        return self.backend.retry_listeners
+
+    def annotate(self, vcf_lines, params) -> list:
+        start = time.perf_counter()
+        try:
+            responses = self.backend.annotate(vcf_lines, params)
+        except Exception as e:
+            self.metrics.record_request(len(vcf_lines), time.perf_counter() - start,
+                                        error = repr(e))
+            raise
+        self.metrics.record_request(len(vcf_lines), time.perf_counter() - start,
+                                    response_bytes = self.backend.last_response_bytes)
+        return responses
@@ -0,0 +1,257 @@
+"""
+This module handles writing annotated variants. It implements output writers that can be fed one
+batch of annotated rows at a time: a tab-separated writer, optionally gzip or zstd compressed, and a
+columnar writer for Parquet and Arrow IPC files. zstd output requires the optional zstandard
+package, and columnar output the optional pyarrow package.
+"""
+import gzip
+import io
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## Output column names, in order
+COLUMNS = [
+    "CHROM", "POS", "REF", "ALT", "FILTER", "N_VARIANT_READS", "TOTAL_READS",
+    "VARIANT_READ_FRACTION", "VARIANT_TYPE", "GENE_ID", "GENE_SYMBOL", "TRANSCRIPT_ID", "IMPACT",
+    "CONSEQUENCE_TERMS", "HGVSP", "DBSNP_ID", "COSMIC_ID", "POP_AF"
+]
+
+## Supported output formats, and the file extensions they are detected from
+OUTPUT_FORMATS = ["tsv", "tsv.gz", "tsv.zst", "parquet", "arrow"]
+FORMAT_EXTENSIONS = {
+    ".gz": "tsv.gz",
+    ".bgz": "tsv.gz",
+    ".zst": "tsv.zst",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow"
+}
+
+## Column types of the columnar formats. Columns not listed are plain strings. Columns with few
+## distinct values are dictionary-encoded.
+INT_COLUMNS = ["POS", "N_VARIANT_READS", "TOTAL_READS"]
+FLOAT_COLUMNS = ["VARIANT_READ_FRACTION", "POP_AF"]
+DICTIONARY_COLUMNS = [
+    "SAMPLE", "CHROM", "FILTER", "VARIANT_TYPE", "GENE_SYMBOL", "IMPACT", "CONSEQUENCE_TERMS"
+]
+
+def detect_format(path) -> str:
+    """
+    Detect the output format of a path from its file extension.
+
+    Args:
+        path (str): path to the output file
+
+    Returns:
+        One of OUTPUT_FORMATS. Paths with an unknown extension are written as plain TSV.
+    """
+    return FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower(), "tsv")
+
+def format_extension(output_format) -> str:
+    """
+    Get the file extension to name output files of a format with.
+
+    Args:
+        output_format (str): one of OUTPUT_FORMATS
+
+    Returns:
+        The extension, e.g. ".tsv.gz".
+    """
+    return "." + output_format
+
+def open_writer(path, columns = None, output_format = None):
+    """
+    Open an output writer for a path.
+
+    Args:
+        path (str):          path to the output file
+        columns (list):      the column names. Default: COLUMNS
+        output_format (str): one of OUTPUT_FORMATS. Default: None (detected from the extension of
+                             path, as by detect_format())
+
+    Returns:
+        A TsvWriter or ColumnarWriter.
+
+    Excepts:
+        ValueError: If output_format is not supported
+    """
+    if output_format is None:
+        output_format = detect_format(path)
+    if output_format == "tsv":
+        return TsvWriter(path, columns = columns)
+    if output_format == "tsv.gz":
+        return TsvWriter(path, columns = columns, compression = "gzip")
+    if output_format == "tsv.zst":
+        return TsvWriter(path, columns = columns, compression = "zstd")
+    if output_format in ("parquet", "arrow"):
+        return ColumnarWriter(path, columns = columns, output_format = output_format)
+    raise ValueError(
+        f"Unsupported output format {output_format}, must be one of {', '.join(OUTPUT_FORMATS)}"
+    )
+
+class TsvWriter:
+    """
+    Writes annotated variant rows to a tab-separated file. The header is written on opening, and
+    every call to write_rows() is flushed to disk immediately, so the output is usable (and survives
+    a crash) while a run is still going. Compressed output is flushed at the end of a compressed
+    block, so it can be decompressed up to the last batch written.
+
+    Args:
+        path (str):        path to the output file. Its directory is created if it does not exist.
+        columns (list):    the column names to write in the header. Default: COLUMNS
+        compression (str): None for plain text, "gzip" or "zstd". Default: None
+    """
+    def __init__(self, path, columns = None, compression = None):
+        ## Create output path if it does not exist
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.path = path
+        self.rows_written = 0
+        if compression is None:
+            self._f = open(path, "w", encoding = "UTF-8")
+        elif compression == "gzip":
+            self._f = gzip.open(path, "wt", encoding = "UTF-8", compresslevel = 6)
+        elif compression == "zstd":
+            if zstandard is None:
+                raise ImportError("zstd compressed output requires the zstandard package")
+            self._f = io.TextIOWrapper(
+                zstandard.ZstdCompressor().stream_writer(open(path, "wb")),
+                encoding = "UTF-8"
+            )
+        else:
+            raise ValueError(f"Unsupported compression {compression}, must be gzip or zstd")
+        self._f.write("%s\n" % "\t".join(columns or COLUMNS))
+        self._f.flush()
+
+    def write_rows(self, rows):
+        """
+        Write and flush a batch of rows.
+
+        Args:
+            rows (list): a list of lists, one per output line, as returned by
+                         vep.annotate_variants()
+        """
+        self._f.writelines("%s\n" % "\t".join(map(str, line)) for line in rows)
+        self._f.flush()
+        self.rows_written += len(rows)
+
+    def close(self):
+        "Close the output file"
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ColumnarWriter:
+    """
+    Writes annotated variant rows to a Parquet or Arrow IPC file, with typed columns: POS and read
+    counts as integers, VARIANT_READ_FRACTION and POP_AF as floats, low-cardinality columns
+    (DICTIONARY_COLUMNS) dictionary-encoded and everything else as strings. "NA" values are written
+    as nulls.
+
+    Every call to write_rows() writes one row group (Parquet) or record batch (Arrow). The file is
+    only readable once the writer is closed.
+
+    Args:
+        path (str):          path to the output file. Its directory is created if it does not exist.
+        columns (list):      the column names. Default: COLUMNS
+        output_format (str): "parquet" or "arrow". Default: "parquet"
+    """
+    def __init__(self, path, columns = None, output_format = "parquet"):
+        if pyarrow is None:
+            raise ImportError(f"{output_format} output requires the pyarrow package")
+        if output_format not in ("parquet", "arrow"):
+            raise ValueError(f"Unsupported columnar format {output_format}")
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.path = path
+        self.columns = columns or COLUMNS
+        self.rows_written = 0
+        ## The dictionaries of dictionary-encoded columns only ever grow, so that every batch's
+        ## dictionary extends the previous one. The Arrow file format can't replace a dictionary,
+        ## and can't extend an empty one either, so there each dictionary starts with an (unused)
+        ## "NA" entry.
+        self._dictionaries = {
+            column: {"NA": 0} if output_format == "arrow" else {}
+            for column in self.columns if column in DICTIONARY_COLUMNS
+        }
+
+        self.schema = pyarrow.schema([
+            pyarrow.field(column, self._column_type(column)) for column in self.columns
+        ])
+        if output_format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas = True)
+            self._writer = pyarrow.ipc.new_file(path, self.schema, options = options)
+
+    @staticmethod
+    def _column_type(column):
+        "Get the Arrow type of a column"
+        if column in INT_COLUMNS:
+            return pyarrow.int64()
+        if column in FLOAT_COLUMNS:
+            return pyarrow.float64()
+        if column in DICTIONARY_COLUMNS:
+            return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        return pyarrow.string()
+
+    def _column_array(self, column, values):
+        "Convert one column of a batch of rows to an Arrow array"
+        if column in INT_COLUMNS:
+            return pyarrow.array([None if v == "NA" else int(v) for v in values], pyarrow.int64())
+        if column in FLOAT_COLUMNS:
+            return pyarrow.array([None if v == "NA" else float(v) for v in values],
+                                 pyarrow.float64())
+        if column in self._dictionaries:
+            dictionary = self._dictionaries[column]
+            indices = [
+                None if v == "NA" else dictionary.setdefault(str(v), len(dictionary))
+                for v in values
+            ]
+            return pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(indices, pyarrow.int32()),
+                pyarrow.array(list(dictionary), pyarrow.string())
+            )
+        return pyarrow.array([None if v == "NA" else str(v) for v in values], pyarrow.string())
+
+    def write_rows(self, rows):
+        """
+        Write a batch of rows.
+
+        Args:
+            rows (list): a list of lists, one per output line, as returned by
+                         vep.annotate_variants()
+        """
+        if not rows:
+            return
+        arrays = [
+            self._column_array(column, values) for column, values in zip(self.columns, zip(*rows))
+        ]
+        self._writer.write_batch(pyarrow.record_batch(arrays, schema = self.schema))
+        self.rows_written += len(rows)
+
+    def close(self):
+        "Close the output file"
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
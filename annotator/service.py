@@ -0,0 +1,375 @@
+"""
+This module implements a long-running annotation service, for pipelines that run the annotator on
+many small VCFs. Each run on its own starts with a cold connection to VEP, and sends chunks of only
+as many variants as its VCF has. The service instead stays up between runs: it keeps its
+connections to VEP alive, holds the annotations it has fetched in memory, and coalesces the
+variants of concurrent requests into full VEP requests.
+
+The service answers POST requests to /vep/<species>/region like the VEP REST API, so runs use it
+as a self-hosted mirror, with --backend http://HOST:PORT. Variants are answered from the in-memory
+cache, or queued. A queue is sent to VEP as soon as it holds a full batch (200 variants by
+default), or once its oldest variant has waited for the batching window (50 ms by default),
+whichever comes first. Variants that are already queued or in flight for another request are only
+queried once. GET /stats returns the service's counters.
+
+Usage:
+    python -m annotator.service [--host HOST] [--port PORT] [--backend BACKEND] [-j JOBS]
+                                [--batch-size N] [--window SECONDS] [--cache-size N]
+"""
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.parse
+
+import annotator.backends
+import annotator.exceptions
+import annotator.jsonutil
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+## The number of variants per VEP request, the most the VEP REST API accepts
+BATCH_SIZE = 200
+## The longest a queued variant waits for others to fill its batch, in seconds
+WINDOW = 0.05
+
+def _query_line(query) -> list:
+    "Parse a VEP region query string back into the variant fields that backends read"
+    fields = str(query).split(" ")
+    if len(fields) < 5:
+        raise annotator.exceptions.BadRequestError(f"Could not parse variant {query}")
+    return [fields[0], fields[1], fields[3], fields[4]]
+
+class _Queue:
+    "The variants waiting to be sent to VEP with the same query parameters"
+    def __init__(self, params, deadline):
+        self.params = params
+        self.deadline = deadline
+        self.items = []
+
+class MicroBatcher:
+    """
+    Coalesces the variants of concurrent annotate() calls into batches for a backend, and caches
+    their annotations in memory. Variants that VEP rejects are isolated by bisecting their batch,
+    so that only the calls that queried them fail.
+
+    Args:
+        backend (object):  the annotator.backends.AnnotationBackend to send batches to
+        batch_size (int):  the number of variants per batch. Default: BATCH_SIZE
+        window (float):    the longest a variant waits for its batch to fill, in seconds.
+                           Default: WINDOW
+        max_workers (int): the maximum number of batches to have in flight at once. Default: 4
+        cache_size (int):  the maximum number of annotations to keep in memory. The least recently
+                           used are evicted first. Default: 100000
+    """
+    def __init__(self, backend, batch_size = BATCH_SIZE, window = WINDOW, max_workers = 4,
+                 cache_size = 100000):
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("Provided batch_size must be an integer > 0")
+        if window < 0:
+            raise ValueError("Provided window must be >= 0")
+        self.backend = backend
+        self.batch_size = batch_size
+        self.window = window
+        self.cache_size = cache_size
+        self.requests = 0
+        self.variants = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.batched_variants = 0
+
+        self._cache = collections.OrderedDict()
+        ## The futures of the variants that are queued or in flight, so each is only queried once
+        self._inflight = {}
+        self._queues = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+        self._thread = threading.Thread(target = self._dispatch, daemon = True)
+        self._thread.start()
+
+    def annotate(self, queries, params) -> list:
+        """
+        Annotate a list of variants, waiting for their batches to complete.
+
+        Args:
+            queries (list): the variant query strings, as built by backends.variant_query()
+            params (dict):  the VEP query parameters
+
+        Returns:
+            A list of VEP annotations (dicts), in the order of queries. Like VEP, variants that the
+            backend returned no annotation for are left out.
+
+        Excepts:
+            BadRequestError: If a variant is malformed, or VEP rejects it
+            RequestError: If the backend fails
+        """
+        params_key = json.dumps(params, sort_keys = True)
+        lines = [_query_line(query) for query in queries]
+        results = []
+        with self._cond:
+            if self._closed:
+                raise annotator.exceptions.RequestError("The annotation service is shutting down")
+            self.requests += 1
+            self.variants += len(queries)
+            for query, line in zip(queries, lines):
+                key = (params_key, query)
+                annotation = self._cache.get(key)
+                if annotation is not None:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                    results.append(annotation)
+                    continue
+                future = self._inflight.get(key)
+                if future is None:
+                    future = concurrent.futures.Future()
+                    self._inflight[key] = future
+                    queue = self._queues.get(params_key)
+                    if queue is None:
+                        queue = _Queue(params, time.monotonic() + self.window)
+                        self._queues[params_key] = queue
+                    queue.items.append((query, line, future))
+                results.append(future)
+            self._cond.notify()
+        results = [r.result() if isinstance(r, concurrent.futures.Future) else r for r in results]
+        return [annotation for annotation in results if annotation is not None]
+
+    def _dispatch(self):
+        "Send every full or expired queue to the backend, until closed"
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                for params_key, queue in list(self._queues.items()):
+                    while len(queue.items) >= self.batch_size or (
+                            queue.items and (queue.deadline <= now or self._closed)):
+                        batch = queue.items[:self.batch_size]
+                        del queue.items[:self.batch_size]
+                        self.batches += 1
+                        self.batched_variants += len(batch)
+                        self._executor.submit(self._annotate_batch, params_key, queue.params,
+                                              batch)
+                    if not queue.items:
+                        del self._queues[params_key]
+                if self._closed:
+                    return
+                timeout = min((q.deadline for q in self._queues.values()), default = None)
+                self._cond.wait(None if timeout is None else max(0, timeout - now))
+
+    def _annotate_batch(self, params_key, params, batch):
+        "Annotate a batch with the backend, and resolve the futures of its variants"
+        try:
+            responses = self.backend.annotate([line for _, line, _ in batch], params)
+        except annotator.exceptions.BadRequestError as e:
+            if len(batch) == 1:
+                self._finish(params_key, batch, error = e)
+            else:
+                ## Bisect the batch to find the rejected variants, and annotate the rest
+                self._annotate_batch(params_key, params, batch[:len(batch) // 2])
+                self._annotate_batch(params_key, params, batch[len(batch) // 2:])
+            return
+        except Exception as e:
+            ## The calls waiting on the batch get the error, rather than the worker
+            self._finish(params_key, batch, error = e)
+            return
+        by_input = {response.get("input"): response for response in responses}
+        self._finish(params_key, batch, [by_input.get(query) for query, _, _ in batch])
+
+    def _finish(self, params_key, batch, responses = None, error = None):
+        "Cache the annotations of a batch, and resolve the futures of its variants"
+        with self._cond:
+            for i, (query, _, _) in enumerate(batch):
+                key = (params_key, query)
+                del self._inflight[key]
+                annotation = responses[i] if responses is not None else None
+                if annotation is not None and "error" not in annotation:
+                    self._cache[key] = annotation
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last = False)
+        for i, (_, _, future) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(responses[i])
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            A dict of the request, variant, cache hit and batch counters, the mean batch size and
+            the number of cached annotations.
+        """
+        with self._cond:
+            return {
+                "requests": self.requests,
+                "variants": self.variants,
+                "cache_hits": self.cache_hits,
+                "cached": len(self._cache),
+                "batches": self.batches,
+                "mean_batch_size": round(self.batched_variants / self.batches, 2)
+                                   if self.batches else 0.0
+            }
+
+    def close(self):
+        "Send the queued variants, and wait for every batch in flight"
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._executor.shutdown(wait = True)
+
+class AnnotationService:
+    """
+    An HTTP server that answers VEP REST region requests through a MicroBatcher. Use it as a
+    context manager to run it in a background thread, or call serve_forever().
+
+    Args:
+        backend (object): the annotator.backends.AnnotationBackend to send batches to. Default:
+                          None (the public Ensembl REST API)
+        host (str):       the address to listen on. Default: "127.0.0.1"
+        port (int):       the port to listen on. Default: DEFAULT_PORT (0 for any free port)
+        **kwargs:         passed to MicroBatcher()
+    """
+    def __init__(self, backend = None, host = "127.0.0.1", port = DEFAULT_PORT, **kwargs):
+        if backend is None:
+            backend = annotator.backends.RestBackend()
+        ## Only the species of the backend can be annotated
+        self.species = getattr(backend, "species", "homo_sapiens")
+        self.batcher = MicroBatcher(backend, **kwargs)
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        "The base URL of the service, to give runs as their backend"
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        service = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            "Request handler of the annotation service"
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, message, *args):
+                logger.debug(message, *args)
+
+            def _reply(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _error(self, status, message):
+                self._reply(status, annotator.jsonutil.dumps_bytes({"error": message}))
+
+            def do_GET(self):
+                if urllib.parse.urlsplit(self.path).path.rstrip("/") != "/stats":
+                    self._error(404, "Not found")
+                    return
+                self._reply(200, annotator.jsonutil.dumps_bytes(service.batcher.stats()))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                url = urllib.parse.urlsplit(self.path)
+                if url.path.rstrip("/") != f"/vep/{service.species}/region":
+                    self._error(404, "Not found")
+                    return
+                try:
+                    queries = annotator.jsonutil.loads(body)["variants"]
+                except (annotator.jsonutil.JSONDecodeError, KeyError, TypeError):
+                    self._error(400, "Malformed request body")
+                    return
+                params = dict(urllib.parse.parse_qsl(url.query))
+                try:
+                    annotations = service.batcher.annotate(queries, params)
+                except annotator.exceptions.BadRequestError as e:
+                    self._error(400, str(e))
+                    return
+                except Exception as e:
+                    ## A failure of VEP itself, which clients retry
+                    logger.warning("Annotation failed: %s", e)
+                    self._error(502, str(e))
+                    return
+                self._reply(200, annotator.jsonutil.dumps_bytes(annotations))
+        return Handler
+
+    def serve_forever(self):
+        "Serve requests until shutdown() is called from another thread"
+        self._server.serve_forever()
+
+    def start(self):
+        "Start serving in a background thread"
+        self._thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        "Stop serving, finish the batches in flight and close the socket"
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self.batcher.close()
+        logger.info("Annotation service statistics: %s", self.batcher.stats())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    "Runs the annotation service from the command line, until interrupted"
+    parser = argparse.ArgumentParser(
+        prog = "python -m annotator.service",
+        description = "Runs a long-lived VEP annotation service, for annotator.py --backend URL."
+    )
+    parser.add_argument("--host", help = "Address to listen on. Default: 127.0.0.1", type = str,
+                        default = "127.0.0.1")
+    parser.add_argument("--port", help = f"Port to listen on. Default: {DEFAULT_PORT}", type = int,
+                        default = DEFAULT_PORT)
+    parser.add_argument("--backend", help = "Where to send VEP queries, as for annotator.py "
+                        "--backend. Default: ensembl", type = str, default = None)
+    parser.add_argument("--record", help = "A JSON lines file to record every VEP response to.",
+                        type = str, default = None)
+    parser.add_argument("--rate-limit", help = "Maximum number of VEP REST requests per second.",
+                        type = float, default = None)
+    parser.add_argument("--max-retries", help = "Maximum number of retries of a failed VEP "
+                        "request. Default: 5", type = int, default = 5)
+    parser.add_argument("-j", "--jobs", help = "Maximum number of VEP requests to have in flight "
+                        "at once. Default: 4", type = int, default = 4)
+    parser.add_argument("--batch-size", help = "Number of variants per VEP request. "
+                        f"Default: {BATCH_SIZE}", type = int, default = BATCH_SIZE)
+    parser.add_argument("--window", help = "Longest a variant waits for its VEP request to fill, "
+                        f"in seconds. Default: {WINDOW}", type = float, default = WINDOW)
+    parser.add_argument("--cache-size", help = "Maximum number of annotations to keep in memory. "
+                        "Default: 100000", type = int, default = 100000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(name)s: %(message)s")
+    backend = annotator.backends.get_backend(args.backend, record = args.record,
+                                             rate_limit = args.rate_limit,
+                                             max_retries = args.max_retries)
+    try:
+        service = AnnotationService(backend, host = args.host, port = args.port,
+                                    batch_size = args.batch_size, window = args.window,
+                                    max_workers = args.jobs, cache_size = args.cache_size)
+    except ValueError as e:
+        parser.error(str(e))
+    logger.info("Serving VEP annotations at %s, for annotator.py --backend %s", service.url,
+                service.url)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+
+if __name__ == "__main__":
+    main()
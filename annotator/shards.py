@@ -0,0 +1,183 @@
+"""
+This module implements parallel parsing of large VCFs. The body of the file is split into shards of
+about the same number of bytes: arbitrary byte ranges of plain VCFs, or runs of whole blocks of BGZF
+(bgzip) compressed ones, which can be decompressed independently. Each shard is read, split into
+lines and parsed in a process pool, with the same column and FORMAT semantics as vcf.iter_vcf() and
+vcf.iter_parse_vcf(). The lines that straddle two shards are stitched back together and parsed
+when the shards are merged, in input order.
+
+Plain gzip can only be decompressed from its start, so gzip compressed VCFs are parsed serially.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import logging
+import os
+
+import annotator.bgzf
+import annotator.vcf
+
+logger = logging.getLogger(__name__)
+
+## The target size of a shard, in bytes of the (compressed) file
+SHARD_BYTES = 16 << 20
+
+def _parse_lines(lines, columns, total_cov_field, var_cov_field, sample_name, samples) -> list:
+    "Parse VCF data lines (strings) as vcf.iter_parse_vcf() or vcf.iter_parse_vcf_samples() would"
+    rows = annotator.vcf.split_lines((l for l in lines if not l.startswith("#")), len(columns))
+    vcf = itertools.chain([columns], rows)
+    if samples:
+        return list(annotator.vcf.iter_parse_vcf_samples(
+            vcf, total_cov_field, var_cov_field, samples = None if samples == "all" else samples
+        ))
+    return list(annotator.vcf.iter_parse_vcf(vcf, total_cov_field, var_cov_field,
+                                             sample_name = sample_name))
+
+def parse_shard(vcf_path, compression, start, end, columns, total_cov_field, var_cov_field,
+                sample_name = None, samples = None) -> tuple:
+    """
+    Read and parse the complete lines of a shard of a VCF. This runs in a worker process.
+
+    Args:
+        vcf_path (str):        path to the VCF, plain or BGZF compressed
+        compression (str):     "bgzf" or None, as detected by bgzf.detect_compression()
+        start (int):           the byte offset of the shard in the file. For BGZF, a block offset
+        end (int):             the byte offset of the end of the shard. For BGZF, a block offset
+        columns (list):        the column names of the VCF
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT coverage.
+        sample_name (str):     the sample to parse in single sample mode. Default: None
+        samples (list):        the samples to parse in multi-sample mode, or "all". Default: None
+
+    Returns:
+        A tuple of the bytes before the first newline of the shard, the parsed variants of the
+        lines after it, and the bytes after the last newline. If the shard has no newline, the
+        first element holds all of it, and the last is None.
+    """
+    with open(vcf_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if compression == "bgzf":
+        data = b"".join(map(annotator.bgzf.decompress_block,
+                            annotator.bgzf.iter_bgzf_blocks(io.BytesIO(data))))
+    first = data.find(b"\n")
+    if first == -1:
+        return data, [], None
+    last = data.rfind(b"\n")
+    lines = data[first + 1:last].decode("utf-8").split("\n") if last > first else []
+    return (data[:first],
+            _parse_lines(lines, columns, total_cov_field, var_cov_field, sample_name, samples),
+            data[last + 1:])
+
+def shard_ranges(vcf_path, compression, shard_bytes = SHARD_BYTES) -> list:
+    """
+    Split a VCF into shards of about shard_bytes bytes.
+
+    Args:
+        vcf_path (str):    path to the VCF, plain or BGZF compressed
+        compression (str): "bgzf" or None, as detected by bgzf.detect_compression()
+        shard_bytes (int): the target size of a shard, in bytes of the file. Default: SHARD_BYTES
+
+    Returns:
+        A list of (start, end) byte offsets, covering the whole file in order. BGZF shards start
+        and end on block boundaries.
+    """
+    if compression != "bgzf":
+        size = os.path.getsize(vcf_path)
+        return [(start, min(start + shard_bytes, size)) for start in range(0, size, shard_bytes)]
+    offsets = annotator.bgzf.block_offsets(vcf_path)
+    ranges = []
+    start = offsets[0]
+    for offset in offsets[1:]:
+        if offset - start >= shard_bytes or offset == offsets[-1]:
+            ranges.append((start, offset))
+            start = offset
+    return ranges
+
+def iter_parse_vcf_parallel(vcf_path, total_cov_field, var_cov_field, sample_name = None,
+                            samples = None, processes = None, shard_bytes = None, threads = 1):
+    """
+    Lazily read and parse a VCF in a process pool, yielding the same variants in the same order as
+    vcf.iter_parse_vcf(vcf.iter_vcf()), or vcf.iter_parse_vcf_samples() in multi-sample mode. At
+    most two shards per process are parsed ahead of the consumer, which bounds memory use.
+
+    VCFs that fit in a single shard, and plain gzip compressed VCFs, are parsed serially.
+
+    Args:
+        vcf_path (str):        path to the input VCF, optionally gzip or BGZF compressed
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference)
+                               coverage.
+        sample_name (str):     the sample to parse in single sample mode. Default: None (the first
+                               column after FORMAT)
+        samples (list):        the samples to parse in multi-sample mode, or "all". Default: None
+                               (single sample mode)
+        processes (int):       the number of worker processes. Default: None (one per CPU)
+        shard_bytes (int):     the target size of a shard, in bytes of the file.
+                               Default: None (SHARD_BYTES)
+        threads (int):         the number of threads used to decompress BGZF input, when it is
+                               parsed serially. Default: 1
+
+    Yields:
+        Variants, or (sample name, Variant) tuples in multi-sample mode.
+
+    Excepts:
+        ValueError: If a sample that is not in the VCF is specified
+        MalformedDataError: If the VCF is empty, is missing header fields, has no genotype
+                            column, or has a truncated line
+    """
+    ## Validate the header, and the samples against it, before starting any worker
+    with contextlib.closing(annotator.vcf.iter_vcf(vcf_path, threads = threads)) as vcf:
+        columns = next(vcf)
+    _parse_lines([], columns, total_cov_field, var_cov_field, sample_name, samples)
+
+    compression = annotator.bgzf.detect_compression(vcf_path)
+    ranges = [] if compression == "gzip" else shard_ranges(vcf_path, compression,
+                                                           shard_bytes or SHARD_BYTES)
+    if processes == 1 or len(ranges) <= 1:
+        if compression == "gzip":
+            logger.info("%s is gzip rather than BGZF compressed, so it is parsed serially",
+                        vcf_path)
+        if samples:
+            yield from annotator.vcf.iter_parse_vcf_samples(
+                annotator.vcf.iter_vcf(vcf_path, threads = threads), total_cov_field,
+                var_cov_field, samples = None if samples == "all" else samples
+            )
+        else:
+            yield from annotator.vcf.iter_scan_vcf(vcf_path, total_cov_field, var_cov_field,
+                                                   sample_name = sample_name, threads = threads)
+        return
+
+    processes = processes or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers = processes) as executor:
+        def submit(shard):
+            return executor.submit(parse_shard, vcf_path, compression, shard[0], shard[1],
+                                   columns, total_cov_field, var_cov_field,
+                                   sample_name = sample_name, samples = samples)
+        shards = iter(ranges)
+        pending = collections.deque(map(submit, itertools.islice(shards, processes * 2)))
+        try:
+            ## The bytes of the line that straddles the previous shards
+            carry = b""
+            while pending:
+                head, parsed, tail = pending.popleft().result()
+                shard = next(shards, None)
+                if shard is not None:
+                    pending.append(submit(shard))
+                carry += head
+                if tail is None:
+                    continue
+                yield from _parse_lines([carry.decode("utf-8")], columns, total_cov_field,
+                                        var_cov_field, sample_name, samples)
+                yield from parsed
+                carry = tail
+            ## The last line may not end with a newline
+            if carry:
+                yield from _parse_lines([carry.decode("utf-8")], columns, total_cov_field,
+                                        var_cov_field, sample_name, samples)
+        finally:
+            ## Don't parse the rest of the file if the consumer stopped early or failed
+            for future in pending:
+                future.cancel()
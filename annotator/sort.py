@@ -0,0 +1,216 @@
+"""
+This module implements sorting of variants in genomic order: by chromosome, in the order of the
+VCF's ##contig header lines or else in natural order (1, 2, ..., 10, ..., 22, X, Y, MT, then any
+other contigs), and then by position. Inputs larger than a memory budget are sorted externally:
+sorted runs are spilled to disk and merged. Inputs that are already sorted are detected, so that
+sorting them can be skipped entirely.
+"""
+import functools
+import heapq
+import itertools
+import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+
+import annotator.bgzf
+
+## Rank of the sex and mitochondrial chromosomes, after the autosomes
+SPECIAL_CHROMOSOMES = {"X": 1, "Y": 2, "M": 3, "MT": 3}
+## Records are spilled to and read back from disk this many at a time
+SPILL_BATCH_SIZE = 10000
+
+@functools.lru_cache(maxsize = None)
+def natural_key(chrom) -> tuple:
+    """
+    The natural sort key of a chromosome name: autosomes in numeric order, then X, Y and the
+    mitochondrial chromosome, then any other contig in natural order (numbers in names compared as
+    numbers). A "chr" prefix is ignored.
+
+    Args:
+        chrom (str): the chromosome name
+
+    Returns:
+        A sort key (tuple).
+    """
+    name = chrom[3:] if chrom[:3].lower() == "chr" else chrom
+    if name.isdigit():
+        return (0, int(name), ())
+    rank = SPECIAL_CHROMOSOMES.get(name.upper())
+    if rank is not None:
+        return (rank, 0, ())
+    tokens = tuple((0, int(t), "") if t.isdigit() else (1, 0, t)
+                   for t in re.findall(r"\d+|\D+", name))
+    return (4, 0, tokens)
+
+def read_contigs(vcf_path) -> list:
+    """
+    Read the contig names of a VCF's ##contig header lines, in order.
+
+    Args:
+        vcf_path (str): path to the VCF, optionally gzip or BGZF compressed
+
+    Returns:
+        A list of contig names, empty if the header has none.
+    """
+    contigs = []
+    with annotator.bgzf.open_text(vcf_path) as f:
+        for l in f:
+            if not l.startswith("##"):
+                break
+            if l.startswith("##contig=<"):
+                match = re.search(r"[<,]ID=([^,>]+)", l)
+                if match:
+                    contigs.append(match.group(1))
+    return contigs
+
+def chromosome_key(contigs = None):
+    """
+    Build the sort key function of chromosome names.
+
+    Args:
+        contigs (list): the contig names in order, as read by read_contigs(). Contigs that are not
+                        in the list sort after those that are, in natural order. Default: None
+                        (natural order)
+
+    Returns:
+        A function of a chromosome name that returns its sort key.
+    """
+    if not contigs:
+        return natural_key
+    ranks = {contig: i for i, contig in enumerate(contigs)}
+    @functools.lru_cache(maxsize = None)
+    def key(chrom):
+        rank = ranks.get(chrom)
+        return (0, rank, ()) if rank is not None else (1,) + natural_key(chrom)
+    return key
+
+def variant_key(contigs = None, record = None):
+    """
+    Build the sort key function of variants, by chromosome and position.
+
+    Args:
+        contigs (list):  the contig order, as for chromosome_key(). Default: None (natural order)
+        record (int):    for records that hold a variant, such as the (sample, variant) tuples of
+                         vcf.iter_parse_vcf_samples(), the index of the variant. Default: None
+                         (the records are variants)
+
+    Returns:
+        A function of a variant (or record) that returns its sort key.
+    """
+    chrom_key = chromosome_key(contigs)
+    if record is None:
+        return lambda variant: (chrom_key(variant[0]), variant[1])
+    return lambda item: (chrom_key(item[record][0]), item[record][1])
+
+def is_sorted(items, key) -> bool:
+    """
+    Check whether items are in sorted order, stopping at the first that isn't.
+
+    Args:
+        items (iterable): the items
+        key (function):   the sort key function
+
+    Returns:
+        True if the items are sorted.
+    """
+    keys = map(key, items)
+    previous = next(keys, None)
+    for current in keys:
+        if current < previous:
+            return False
+        previous = current
+    return True
+
+def vcf_is_sorted(vcf_path, contigs = None, threads = 1) -> bool:
+    """
+    Check whether the data lines of a VCF are sorted by chromosome and position, without parsing
+    them any further.
+
+    Args:
+        vcf_path (str): path to the VCF, optionally gzip or BGZF compressed
+        contigs (list): the contig order, as for chromosome_key(). Default: None (natural order)
+        threads (int):  the number of threads used to decompress BGZF input. Default: 1
+
+    Returns:
+        True if the VCF is sorted.
+    """
+    chrom_key = chromosome_key(contigs)
+    with annotator.bgzf.open_text(vcf_path, threads = threads) as f:
+        lines = (l for l in f if not l.startswith("#"))
+        return is_sorted(lines, lambda l: (chrom_key(l[:l.index("\t")]),
+                                           int(l.split("\t", 2)[1])))
+
+def _record_size(record) -> int:
+    "Estimate the memory used by a record, a tuple of (tuples of) scalars, in bytes"
+    size = sys.getsizeof(record)
+    for field in record:
+        size += _record_size(field) if isinstance(field, tuple) else sys.getsizeof(field)
+    return size
+
+def _spill(records, directory) -> str:
+    "Write a sorted run to a temporary file, in batches, and return its path"
+    fd, path = tempfile.mkstemp(suffix = ".run", dir = directory)
+    with os.fdopen(fd, "wb") as f:
+        for start in range(0, len(records), SPILL_BATCH_SIZE):
+            pickle.dump(records[start:start + SPILL_BATCH_SIZE], f,
+                        protocol = pickle.HIGHEST_PROTOCOL)
+    return path
+
+def _read_run(path):
+    "Lazily read back a sorted run written by _spill()"
+    with open(path, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+def iter_sorted(items, key, memory_mb = 512, tmpdir = None):
+    """
+    Lazily sort items, within a memory budget. Items are sorted in memory if they fit in the
+    budget. Otherwise sorted runs of items that fit are spilled to temporary files, which are then
+    merged (k-way). The sort is stable.
+
+    Args:
+        items (iterable):  the items to sort: tuples (e.g. Variants) of strings and numbers
+        key (function):    the sort key function, e.g. from variant_key()
+        memory_mb (float): the memory budget, in MB. The size of items is estimated from the
+                           first few. Default: 512
+        tmpdir (str):      the directory to spill sorted runs to. Default: None (the system
+                           temporary directory)
+
+    Yields:
+        The items, in sorted order.
+    """
+    iterator = iter(items)
+    ## Estimate how many items fit in the budget from the first ones
+    head = list(itertools.islice(iterator, 100))
+    if not head:
+        return
+    item_size = sum(map(_record_size, head)) / len(head)
+    run_length = max(len(head), int(memory_mb * 2**20 // item_size))
+
+    run = head + list(itertools.islice(iterator, run_length - len(head)))
+    run.sort(key = key)
+    following = next(iterator, None)
+    if following is None:
+        ## Everything fits in memory
+        yield from run
+        return
+
+    iterator = itertools.chain([following], iterator)
+    directory = tempfile.mkdtemp(prefix = "annotator-sort-", dir = tmpdir)
+    try:
+        paths = []
+        while run:
+            paths.append(_spill(run, directory))
+            run = list(itertools.islice(iterator, run_length))
+            run.sort(key = key)
+        ## heapq.merge prefers earlier runs on ties, so the merge is stable too
+        yield from heapq.merge(*map(_read_run, paths), key = key)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
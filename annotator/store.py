@@ -0,0 +1,474 @@
+"""
+This module implements a local, read-only store of VEP annotations, for answering repeated runs
+over overlapping cohorts without querying VEP. A store is built once from past results (checkpoint
+journals, annotation caches, recorded VEP responses, or TSV outputs of this tool) and is then
+opened as a memory map: only the pages that lookups touch are read from disk, and opening a store
+costs the same whatever its size.
+
+A store holds the annotations of a single set of VEP parameters (per-gene or per-transcript, and
+the output columns they were pruned for), like the annotation cache. It is a single file:
+
+    header:      b"VEPSTORE", then the offsets of the metadata and the index, and the number of
+                 entries, as unsigned 64-bit little-endian integers
+    annotations: for each variant, its VEP query string, a newline, and its annotation as JSON
+    index:       one fixed-size entry per variant, sorted by chromosome and position: the index of
+                 the chromosome in the metadata, the position, and the offset and size of the
+                 annotation
+    metadata:    JSON of the format version, the parameters and the chromosome names in order
+
+Lookups binary search the index, so they take O(log n) time.
+
+Usage:
+    python -m annotator.store -o STORE [-g] [--fields FIELDS] SOURCE [SOURCE ...]
+"""
+import argparse
+import bisect
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+
+import annotator.backends
+import annotator.bgzf
+import annotator.extract
+import annotator.jsonutil
+import annotator.sort
+import annotator.vep
+
+logger = logging.getLogger(__name__)
+
+## Consequence terms, e.g. "intron_variant;NMD_transcript_variant". HGVSp notations never match,
+## as they always hold a colon
+CONSEQUENCE_TERMS = re.compile(r"\w+_\w+(;\w+_\w+)*")
+
+MAGIC = b"VEPSTORE"
+VERSION = 1
+## The metadata offset, index offset and number of entries, after the magic number
+HEADER = struct.Struct("<QQQ")
+## An index entry: chromosome index, position, annotation offset and annotation size
+ENTRY = struct.Struct("<IQQI")
+## The leading part of an index entry that it is sorted by
+ENTRY_KEY = struct.Struct("<IQ")
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+class _IndexKeys:
+    "A read-only sequence view of the (chromosome, position) keys of a store's index, to bisect"
+    def __init__(self, buffer, offset, count):
+        self._buffer = buffer
+        self._offset = offset
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return ENTRY_KEY.unpack_from(self._buffer, self._offset + i * ENTRY.size)
+
+class AnnotationStore:
+    """
+    A memory-mapped, read-only store of VEP annotations, as written by build_store(). Hits and
+    misses are counted over the lifetime of the object.
+
+    Args:
+        path (str): path to the store
+
+    Excepts:
+        ValueError: If the file is not an annotation store, or of an unknown version
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._warned = False
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self._mm.close()
+            raise ValueError(f"{path} is not an annotation store.")
+        meta_offset, self._index_offset, self._count = HEADER.unpack_from(self._mm, len(MAGIC))
+        meta = annotator.jsonutil.loads(self._mm[meta_offset:])
+        if meta.get("version") != VERSION:
+            self._mm.close()
+            raise ValueError(f"{path} is an annotation store of unknown version "
+                             f"{meta.get('version')}.")
+        self.params = meta["params"]
+        self._params_key = json.dumps(self.params, sort_keys = True)
+        self._chromosomes = {chrom: i for i, chrom in enumerate(meta["chromosomes"])}
+        self._keys = _IndexKeys(self._mm, self._index_offset, self._count)
+
+    def __len__(self):
+        return self._count
+
+    def lookup(self, line):
+        """
+        Look up the annotation of a single variant.
+
+        Args:
+            line (list): a variant, as output by vcf.parse_vcf()
+
+        Returns:
+            The stored VEP annotation (dict), or None if the variant is not in the store.
+        """
+        chrom = self._chromosomes.get(str(line[0]))
+        if chrom is None:
+            return None
+        pos = int(line[1])
+        prefix = annotator.backends.variant_query(line).encode("utf-8") + b"\n"
+        ## Several variants may share a position, so check each entry at it
+        i = bisect.bisect_left(self._keys, (chrom, pos))
+        while i < self._count:
+            entry_chrom, entry_pos, offset, size = ENTRY.unpack_from(
+                self._mm, self._index_offset + i * ENTRY.size
+            )
+            if entry_chrom != chrom or entry_pos != pos:
+                return None
+            if self._mm[offset:offset + len(prefix)] == prefix:
+                return annotator.jsonutil.loads(self._mm[offset + len(prefix):offset + size])
+            i += 1
+        return None
+
+    def get_many(self, vcf_lines, params) -> list:
+        """
+        Look up the stored annotations of a list of variants. A store built for other parameters
+        has none of them.
+
+        Args:
+            vcf_lines (list): a list of variants, as output by vcf.parse_vcf()
+            params (dict):    the parameters the annotations are for, as returned by
+                              vep.storage_parameters()
+
+        Returns:
+            A list with one element per input variant: the stored VEP annotation (dict), or None if
+            the variant is not in the store.
+        """
+        if json.dumps(params, sort_keys = True) != self._params_key:
+            if not self._warned:
+                logger.warning("The annotation store %s was built for other VEP parameters or "
+                               "output fields, so it is not used", self.path)
+                self._warned = True
+            self.misses += len(vcf_lines)
+            return [None] * len(vcf_lines)
+        out = [self.lookup(line) for line in vcf_lines]
+        found = sum(annotation is not None for annotation in out)
+        self.hits += found
+        self.misses += len(out) - found
+        return out
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            A dict of the hit/miss counters, the hit rate and the number of entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 5) if lookups else 0.0,
+            "entries": self._count
+        }
+
+    def close(self):
+        "Unmap the store"
+        self._keys = None
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _rows_annotation(extractor, rows) -> dict:
+    """
+    Rebuild the parts of a VEP annotation that an extractor reads from the output lines it wrote
+    for one variant, so that extracting it again gives the same lines.
+    """
+    alt = rows[0][3]
+    annotation = {"input": annotator.backends.variant_query(rows[0])}
+    features = [{} for _ in rows]
+    colocated = []
+    n_variant = len(annotator.extract.VARIANT_COLUMNS)
+    for i, field in enumerate(extractor.fields):
+        values = [row[n_variant + i] for row in rows]
+        if field.scope == "feature":
+            for feature, value in zip(features, values):
+                if value != "NA":
+                    feature[field.key] = value.split(";") if field.kind == "list" else value
+            continue
+        value = values[0]
+        if value == "NA":
+            continue
+        if field.scope == "annotation":
+            annotation[field.key] = value
+        elif field.key == "dbsnp":
+            colocated += [{"id": element_id} for element_id in value.split(";")]
+        elif field.key == "cosmic":
+            colocated += [{"id": element_id, "allele_string": "COSMIC_MUTATION"}
+                          for element_id in value.split(";")]
+        elif field.key == "frequency":
+            colocated.append({"frequencies": {alt: {"af": value}}})
+        else:
+            colocated.append({field.key: value.split(";")})
+    annotation[extractor.consequence_keys[0]] = features
+    if colocated:
+        annotation["colocated_variants"] = colocated
+    return annotation
+
+def _legacy_columns(extractor):
+    """
+    The indices, in an output line, of the CONSEQUENCE_TERMS and HGVSP columns of an extractor, or
+    None if it doesn't write both. Outputs of older versions of this tool have the values of each
+    under the other's header.
+    """
+    indices = {}
+    for i, field in enumerate(extractor.fields):
+        if field.scope == "feature" and field.key in ("consequence_terms", "hgvsp"):
+            indices[field.key] = len(annotator.extract.VARIANT_COLUMNS) + i
+    if len(indices) < 2:
+        return None
+    return indices["consequence_terms"], indices["hgvsp"]
+
+def _iter_tsv(path, extractor):
+    "Yield (query, annotation) pairs from a TSV output of this tool"
+    with annotator.bgzf.open_text(path) as f:
+        columns = f.readline().rstrip("\n").split("\t")
+        sample = columns[:1] == ["SAMPLE"]
+        if columns[int(sample):] != extractor.columns:
+            raise ValueError(f"The columns of {path} are not the output columns the store is built "
+                             "for. Use --fields to give the columns it was written with.")
+        legacy_columns = _legacy_columns(extractor)
+        legacy = False
+        seen = set()
+        group_key = None
+        rows = []
+        n_variant = len(annotator.extract.VARIANT_COLUMNS)
+        for l in f:
+            values = l.rstrip("\n").split("\t")
+            row = values[int(sample):]
+            ## Put the values of legacy outputs back under their headers
+            if legacy_columns is not None and \
+                    CONSEQUENCE_TERMS.fullmatch(row[legacy_columns[1]]):
+                if not legacy:
+                    logger.warning("%s has the legacy layout, with the HGVSP and "
+                                   "CONSEQUENCE_TERMS values swapped; reading them swapped back",
+                                   path)
+                    legacy = True
+                terms = row[legacy_columns[1]]
+                row[legacy_columns[1]] = row[legacy_columns[0]]
+                row[legacy_columns[0]] = terms
+            ## The lines of a variant are written together, once per sample in multi-sample mode
+            key = tuple(values[:5]) if sample else tuple(values[:4])
+            if key != group_key and rows:
+                yield from _finish_group(rows, extractor, seen)
+                rows = []
+            group_key = key
+            ## Repeated records of a variant repeat its lines, which would duplicate its features
+            if not rows or (row[:n_variant] == rows[0][:n_variant] and row not in rows):
+                rows.append(row)
+        if rows:
+            yield from _finish_group(rows, extractor, seen)
+
+def _finish_group(rows, extractor, seen):
+    "Yield the rebuilt annotation of the lines of a variant, unless it was seen or has none"
+    query = annotator.backends.variant_query(rows[0])
+    if query in seen:
+        return
+    seen.add(query)
+    ## A single line with no annotation at all is a variant that VEP rejected or didn't return
+    n_variant = len(annotator.extract.VARIANT_COLUMNS)
+    if len(rows) == 1 and all(value == "NA" for value in rows[0][n_variant:]):
+        return
+    yield query, _rows_annotation(extractor, rows)
+
+def _iter_cache(path, params_key):
+    "Yield (query, annotation) pairs from an annotation cache, for the given parameters"
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri = True)
+    try:
+        for chrom, pos, ref, alt, params, response in conn.execute(
+                "SELECT chrom, pos, ref, alt, params, response FROM annotations"):
+            if params == params_key:
+                yield (annotator.backends.variant_query((chrom, pos, ref, alt)),
+                       annotator.jsonutil.loads(response))
+    finally:
+        conn.close()
+
+def _iter_json(path, params_keys):
+    """
+    Yield (query, annotation) pairs from a JSON list of VEP responses, or JSON lines of checkpoint
+    journal chunks, recorded {"params": ..., "response": ...} records or bare VEP responses. Records
+    with parameters are skipped unless they are among params_keys.
+    """
+    with annotator.bgzf.open_text(path) as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        records = annotator.jsonutil.loads(text)
+    else:
+        records = (annotator.jsonutil.loads(l) for l in text.splitlines() if l.strip())
+    for record in records:
+        if "params" in record and json.dumps(record["params"], sort_keys = True) \
+                not in params_keys:
+            continue
+        if "queries" in record:
+            yield from zip(record["queries"], record["responses"])
+        elif "response" in record:
+            yield record["response"].get("input"), record["response"]
+        else:
+            yield record.get("input"), record
+
+def iter_source_annotations(path, by_gene = False, extractor = None):
+    """
+    Read the VEP annotations of past results, detecting the kind of source from its contents.
+
+    Args:
+        path (str):         path to a checkpoint journal, an annotation cache (SQLite), recorded VEP
+                            responses (as written with --record, or a JSON list), or a TSV output,
+                            optionally gzip compressed
+        by_gene (boolean):  whether the annotations are per gene (True) or per transcript (False).
+                            Only annotations with matching parameters are read. Default: False
+        extractor (object): the annotator.extract.Extractor of the output columns. Annotations
+                            pruned for other columns are not read. Default: None (the default
+                            output columns)
+
+    Yields:
+        Tuples of (VEP query string, annotation).
+
+    Excepts:
+        ValueError: If a TSV output has other columns than the extractor's
+    """
+    if extractor is None:
+        extractor = annotator.extract.DEFAULT_EXTRACTOR
+    vep_params = annotator.vep.vep_parameters(by_gene, extractor)
+    params = annotator.vep.storage_parameters(vep_params, extractor)
+    with open(path, "rb") as f:
+        start = f.read(len(SQLITE_MAGIC))
+    if start == SQLITE_MAGIC:
+        yield from _iter_cache(path, json.dumps(params, sort_keys = True))
+        return
+    with annotator.bgzf.open_text(path) as f:
+        first = f.readline()
+    if first.startswith(("CHROM\t", "SAMPLE\tCHROM\t")):
+        yield from _iter_tsv(path, extractor)
+    else:
+        ## Journals hold pruned annotations, and recordings raw responses
+        yield from _iter_json(path, {json.dumps(p, sort_keys = True) for p in (params, vep_params)})
+
+def build_store(sources, output, by_gene = False, fields = None, memory_mb = 512) -> int:
+    """
+    Build an annotation store from past results. Annotations are pruned to the parts the output
+    columns need, as in the annotation cache. Where several sources annotate the same variant, the
+    last one wins. Rejected variants (error annotations) are left out, so that they are queried
+    again.
+
+    Args:
+        sources (list):    paths to the past results, as read by iter_source_annotations()
+        output (str):      path to write the store to. It is replaced once complete
+        by_gene (boolean): whether to store per gene (True) or per transcript (False) annotations.
+                           Default: False
+        fields (list):     the output columns the store is for, as field names or specifications
+                           (see extract.parse_fields()). Default: None (extract.DEFAULT_FIELDS)
+        memory_mb (float): the memory budget of sorting the annotations, in MB. Default: 512
+
+    Returns:
+        The number of variants in the store.
+    """
+    extractor = annotator.extract.Extractor(fields)
+    params = annotator.vep.storage_parameters(annotator.vep.vep_parameters(by_gene, extractor),
+                                              extractor)
+    prune_fields = extractor.prune_fields
+
+    def records():
+        for path in sources:
+            n = 0
+            for query, annotation in iter_source_annotations(path, by_gene, extractor):
+                if not query or "error" in annotation:
+                    continue
+                chrom, pos = query.split(" ", 2)[:2]
+                payload = annotator.jsonutil.dumps_bytes(
+                    annotator.vep.prune_annotation(annotation, prune_fields)
+                )
+                n += 1
+                yield chrom, int(pos), query, payload
+            logger.info("Read %s annotations from %s", n, path)
+
+    ## Chromosomes with the same natural key (e.g. "1" and "chr1") are kept apart by name
+    ordered = annotator.sort.iter_sorted(
+        records(), lambda r: (annotator.sort.natural_key(r[0]), r[0], r[1], r[2]),
+        memory_mb = memory_mb
+    )
+
+    directory = os.path.dirname(os.path.abspath(output))
+    fd, tmp_path = tempfile.mkstemp(prefix = ".store-", dir = directory)
+    chromosomes = []
+    count = 0
+    try:
+        with os.fdopen(fd, "wb") as f, tempfile.TemporaryFile() as index:
+            f.write(MAGIC + HEADER.pack(0, 0, 0))
+            previous = None
+            ## Sorting is stable, so the last of the records of a variant is the latest
+            for record in ordered:
+                if previous is not None and previous[2] != record[2]:
+                    count += _write_record(f, index, previous, chromosomes)
+                previous = record
+            if previous is not None:
+                count += _write_record(f, index, previous, chromosomes)
+
+            index_offset = f.tell()
+            index.seek(0)
+            shutil.copyfileobj(index, f)
+            meta_offset = f.tell()
+            f.write(annotator.jsonutil.dumps_bytes(
+                {"version": VERSION, "params": params, "chromosomes": chromosomes}
+            ))
+            f.seek(len(MAGIC))
+            f.write(HEADER.pack(meta_offset, index_offset, count))
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logger.info("Wrote %s annotations to %s", count, output)
+    return count
+
+def _write_record(f, index, record, chromosomes) -> int:
+    "Append a sorted (chrom, pos, query, payload) record to a store and its index"
+    chrom, pos, query, payload = record
+    if not chromosomes or chromosomes[-1] != chrom:
+        chromosomes.append(chrom)
+    data = query.encode("utf-8") + b"\n" + payload
+    index.write(ENTRY.pack(len(chromosomes) - 1, pos, f.tell(), len(data)))
+    f.write(data)
+    return 1
+
+def main():
+    "Builds an annotation store from the command line"
+    parser = argparse.ArgumentParser(
+        prog = "python -m annotator.store",
+        description = "Builds a local annotation store from past VEP results, for --store."
+    )
+    parser.add_argument("sources", nargs = "+",
+                        help = "Checkpoint journals, annotation caches, recorded VEP responses "
+                               "(--record) or TSV outputs to read annotations from.")
+    parser.add_argument("-o", "--output", help = "Path to write the store to.", required = True)
+    parser.add_argument("-g", "--per-gene", help = "Store per gene rather than per transcript "
+                        "annotations, for runs with --per-gene.", action = "store_true")
+    parser.add_argument("--fields", help = "The output columns the store is for, as for "
+                        "annotator.py --fields. Default: the default columns", type = str,
+                        default = None)
+    parser.add_argument("--sort-memory", help = "The memory budget of sorting, in MB. "
+                        "Default: 512", type = float, default = 512)
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO, format = "%(asctime)s %(name)s: %(message)s")
+    try:
+        fields = annotator.extract.parse_fields(args.fields) if args.fields else None
+        build_store(args.sources, args.output, by_gene = args.per_gene, fields = fields,
+                    memory_mb = args.sort_memory)
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+This module implements the HTTP transport used by the REST annotation backend: a connection-pooled
+session, a client-side token-bucket rate limiter and a POST that retries throttled and failed
+requests with exponential backoff, honouring the server's Retry-After header.
+"""
+import email.utils
+import random
+import socket
+import threading
+import time
+
+import requests
+import requests.adapters
+
+## Ensembl's published REST limits are 55,000 requests per hour, averaging 15 requests per second
+ENSEMBL_RATE_LIMIT = 15
+## HTTP statuses worth retrying: throttling and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class TokenBucket:
+    """
+    A thread-safe token-bucket rate limiter. Tokens are added at rate per second, up to capacity,
+    and each request takes one, blocking until one is available.
+
+    Args:
+        rate (float):   the sustained number of requests per second
+        capacity (int): the maximum burst size. Default: None (same as rate, at least 1)
+    """
+    def __init__(self, rate, capacity = None):
+        if rate <= 0:
+            raise ValueError("Provided rate must be > 0")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        "Take a token, sleeping until one is available"
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Hand out no tokens for the given number of seconds, e.g. when the server says to back off.
+        This holds back every thread sharing the bucket, not just the one that was throttled.
+
+        Args:
+            seconds (float): how long to pause for
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+def create_session(pool_size = 10) -> requests.Session:
+    """
+    Create a requests session that keeps up to pool_size connections alive per host, so that chunks
+    reuse connections instead of reconnecting for every request.
+
+    Args:
+        pool_size (int): the number of connections to keep alive. This should be at least the
+                         number of concurrent requests. Default: 10
+
+    Returns:
+        A requests.Session.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = pool_size,
+                                            pool_maxsize = pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def retry_after(response):
+    """
+    Parse the Retry-After header of a response.
+
+    Args:
+        response (requests.Response): the response
+
+    Returns:
+        The number of seconds to wait, or None if the header is missing or malformed.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    ## Retry-After can also be an HTTP date
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def is_name_resolution_error(error) -> bool:
+    """
+    Check whether a connection failure was caused by the host name not resolving, which retrying
+    won't fix.
+
+    Args:
+        error (Exception): the exception raised by the request
+
+    Returns:
+        True if a DNS lookup failed anywhere in the chain of causes of the error.
+    """
+    seen = set()
+    pending = [error]
+    while pending:
+        e = pending.pop()
+        if e is None or id(e) in seen:
+            continue
+        seen.add(id(e))
+        if isinstance(e, socket.gaierror) or type(e).__name__ == "NameResolutionError":
+            return True
+        ## requests wraps urllib3's MaxRetryError, which holds the original error as its reason
+        pending += [e.__cause__, e.__context__, getattr(e, "reason", None)]
+        pending += [arg for arg in getattr(e, "args", ()) if isinstance(arg, BaseException)]
+    return False
+
+def post(session, url, rate_limiter = None, max_retries = 5, backoff = 1.0, max_backoff = 60,
+         on_retry = None, **kwargs) -> requests.Response:
+    """
+    POST a request, retrying throttled requests (429), transient server errors (5xx) and connection
+    failures with exponential backoff. When the server sends a Retry-After header it is honoured
+    instead, up to max_backoff, and the rate limiter is paused for that long so other threads back
+    off too. Host names that don't resolve are not retried.
+
+    Args:
+        session (requests.Session): the session to send the request with
+        url (str):                  the URL to post to
+        rate_limiter (TokenBucket): a rate limiter to take a token from before every attempt.
+                                    Default: None (no rate limiting)
+        max_retries (int):          the maximum number of retries. Default: 5
+        backoff (float):            the delay before the first retry, in seconds. It doubles with
+                                    every retry. Default: 1.0
+        max_backoff (float):        the maximum delay between retries, in seconds. Default: 60
+        on_retry (function):        a function to call, without arguments, before every retry,
+                                    e.g. to send smaller requests. Default: None
+        **kwargs:                   passed to session.post()
+
+    Returns:
+        The last requests.Response. It is only non-retryable or out of retries if not a 200.
+
+    Excepts:
+        requests.RequestException: If the last attempt failed to connect or timed out, or the host
+                                   name does not resolve
+    """
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            response = session.post(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries or is_name_resolution_error(e):
+                raise
+            response = None
+
+        if response is not None and response.status_code not in RETRY_STATUSES:
+            return response
+        if response is not None and attempt >= max_retries:
+            return response
+
+        if on_retry is not None:
+            on_retry()
+
+        ## Wait as long as the server asks for, or back off exponentially with some jitter so that
+        ## concurrent requests don't retry in lockstep
+        delay = retry_after(response) if response is not None else None
+        if delay is not None:
+            ## A bad header must not stall every thread sharing the rate limiter indefinitely
+            delay = min(max_backoff, delay)
+            if rate_limiter is not None:
+                rate_limiter.pause(delay)
+        else:
+            delay = min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1)
+        time.sleep(delay)
+        attempt += 1
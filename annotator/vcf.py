@@ -1,78 +1,361 @@
 """
 This module handles VCF loading and parsing. It implements functions for reading and parsing VCFs
 """
+import contextlib
+import mmap
+import typing
+
+import annotator.bgzf
 import annotator.exceptions
+import annotator.sort
 
-def read_vcf(vcf_path) -> list:
+class Variant(typing.NamedTuple):
     """
-    Read a VCF specified by the path to a list and strip the header. Enforce format compliance. 
+    A single parsed variant allele. This is a tuple, so it is compact (no per-instance dict) and can
+    be indexed like the lists it replaces: [CHROM, POS, REF, ALT, FILTER, N_VARIANT_READS,
+    TOTAL_READS].
+    """
+    chrom: str
+    pos: int
+    ref: str
+    alt: str
+    filter: str
+    var_reads: int
+    total_reads: int
+
+class _FieldCache:
+    """
+    Per-parse caches shared by the parsing functions: the indices of the coverage fields for each
+    distinct FORMAT string, and one shared copy of each distinct CHROM/FILTER string, since both
+    repeat on nearly every line.
+    """
+    def __init__(self, total_cov_field, var_cov_field):
+        self.total_cov_field = total_cov_field
+        self.var_cov_field = var_cov_field
+        self._formats = {}
+        self._strings = {}
+
+    def format_indices(self, fmt):
+        "Return the (variant, total) coverage indices of a FORMAT string"
+        indices = self._formats.get(fmt)
+        if indices is None:
+            fields = fmt.split(":")
+            indices = (fields.index(self.var_cov_field), fields.index(self.total_cov_field))
+            self._formats[fmt] = indices
+        return indices
+
+    def shared(self, string):
+        "Return the shared copy of a repeated string"
+        return self._strings.setdefault(string, string)
+
+    def variant(self, v, chrom_ind, pos_ind, ref_ind, filt_ind, allele, var, total) -> Variant:
+        "Build a Variant from a VCF line, converting positions and read counts to integers"
+        try:
+            return Variant(self.shared(v[chrom_ind]), int(v[pos_ind]), v[ref_ind], allele,
+                           self.shared(v[filt_ind]), int(var), int(total))
+        except ValueError as e:
+            raise annotator.exceptions.MalformedDataError(
+                f"Non-integer position or read count in VCF line:\n{v}"
+            ) from e
+
+def iter_vcf(vcf_path, threads = 1):
+    """
+    Lazily read a VCF specified by the path, skipping the header. Enforce format compliance. The
+    column names line is validated before anything is yielded, and every following line is checked
+    for truncation as it is read, so memory use does not depend on the size of the file.
+    gzip and BGZF (bgzip) compressed VCFs are detected and decompressed on the fly.
 
     Args:
-        vcf_path (str): path to input VCF.
+        vcf_path (str): path to input VCF, optionally gzip or BGZF compressed.
+        threads (int):  the number of threads used to decompress BGZF input. Default: 1
     
-    Returns:
-        A list of lists, each with the contents of a VCF line. Line 1 contains column names.
+    Yields:
+        Lists, each with the contents of a VCF line. The first contains column names.
 
     Excepts:
         MalformedDataError: If the VCF is completely empty
         MalformedDataError: If the VCF is missing fields in the header
         MalformedDataError: If the VCF has an inconsistent number of columns
     """
-    ## Read the VCF, skipping header lines. Strip whitespace and split by tab.
-    with open(vcf_path, "r", encoding = "utf-8") as f:
-        vcf = [l for l in f.readlines() if not l.startswith("##")]
-    vcf = [l.strip().split("\t") for l in vcf]
-
-    ## Throw a useful error if VCF is completely empty with no header line
-    if len(vcf) == 0:
-        raise annotator.exceptions.MalformedDataError(
-            f"File {vcf_path} is completely empty (it must have a header at least)"
-            )
+    with annotator.bgzf.open_text(vcf_path, threads = threads) as f:
+        ## Skip header lines, up to the column names line
+        header = None
+        for l in f:
+            if not l.startswith("##"):
+                header = l.strip().split("\t")
+                break
 
-    ## Enforce that all the VCF ver.4 fixed fields are present in line 1
-    vcf_fields = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
-    for field in vcf_fields:
-        if field not in vcf[0]:
+        ## Throw a useful error if VCF is completely empty with no header line
+        if header is None:
             raise annotator.exceptions.MalformedDataError(
-                f"Field {field} not found in the VCF! Are you sure this is a format compliant VCF?"
+                f"File {vcf_path} is completely empty (it must have a header at least)"
                 )
-    ## If the file is format-compliant, but empty, it should run without errors. So we won't check
-    ## for length at this stage.
 
-    ## Verify that the VCF is not truncated.
-    expected_length = len(vcf[0])
-    for sublist in vcf:
+        ## Enforce that all the VCF ver.4 fixed fields are present in line 1
+        vcf_fields = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"]
+        for field in vcf_fields:
+            if field not in header:
+                raise annotator.exceptions.MalformedDataError(
+                    f"Field {field} not found in the VCF! Are you sure this is a format compliant "
+                    "VCF?"
+                    )
+        ## If the file is format-compliant, but empty, it should run without errors. So we won't
+        ## check for length at this stage.
+        yield header
+
+        yield from split_lines(f, len(header))
+
+def split_lines(lines, expected_length):
+    """
+    Lazily split VCF data lines by tab, skipping any stray header lines, and verify that none is
+    truncated.
+
+    Args:
+        lines (iterable):      the data lines of a VCF, as strings
+        expected_length (int): the number of columns of the VCF
+
+    Yields:
+        Lists, each with the contents of a VCF line.
+
+    Excepts:
+        MalformedDataError: If a line does not have expected_length columns
+    """
+    ## Strip whitespace, split by tab and verify that the VCF is not truncated.
+    for l in lines:
+        if l.startswith("##"):
+            continue
+        sublist = l.strip().split("\t")
         if len(sublist) != expected_length:
             raise annotator.exceptions.MalformedDataError(
                 "One of your VCF rows has fewer columns than expected. Possible truncation."
                 f"Problematic column:\n{sublist}"
                 )
-    return vcf
+        yield sublist
 
-def parse_vcf(vcf, total_cov_field, var_cov_field, sample_name = None) -> list:
+def read_vcf(vcf_path, threads = 1) -> list:
+    """
+    Read a VCF specified by the path to a list and strip the header. Enforce format compliance. 
+    This holds the whole file in memory; use iter_vcf() to stream it instead.
+
+    Args:
+        vcf_path (str): path to input VCF, optionally gzip or BGZF compressed.
+        threads (int):  the number of threads used to decompress BGZF input. Default: 1
+    
+    Returns:
+        A list of lists, each with the contents of a VCF line. Line 1 contains column names.
+
+    Excepts:
+        MalformedDataError: If the VCF is completely empty
+        MalformedDataError: If the VCF is missing fields in the header
+        MalformedDataError: If the VCF has an inconsistent number of columns
+    """
+    return list(iter_vcf(vcf_path, threads = threads))
+
+def _column_indices(vcf_colnames, sample_name = None) -> tuple:
+    """
+    Find the indices of the columns parsed in single sample mode: CHROM, POS, REF, ALT, FILTER,
+    FORMAT and the sample's, which is sample_name or else the first column after FORMAT.
+    """
+    ## Extract indices of the fixed VCF fields
+    chrom_ind = vcf_colnames.index("#CHROM")
+    pos_ind = vcf_colnames.index("POS")
+    ref_ind = vcf_colnames.index("REF")
+    alt_ind = vcf_colnames.index("ALT")
+    filt_ind = vcf_colnames.index("FILTER")
+    fmt_ind = vcf_colnames.index("FORMAT")
+
+    ## If the sample name is specified, then check that it exists and use it. Otherwise, use the
+    ## first column after FORMAT
+    if sample_name:
+        if sample_name not in vcf_colnames:
+            raise ValueError(
+                (
+                f"Sample {sample_name} was specified, but not found in the VCF! VCF columns:"
+                f"{vcf_colnames}"
+                )
+            )
+        samp_ind = vcf_colnames.index(sample_name)
+    else:
+        samp_ind = fmt_ind + 1
+        ## Throw an error if the field after FORMAT doesn't exist
+        if len(vcf_colnames) <= samp_ind:
+            raise annotator.exceptions.MalformedDataError(
+                "Input VCF does not contain any genotype fields!"
+                )
+    return chrom_ind, pos_ind, ref_ind, alt_ind, filt_ind, fmt_ind, samp_ind
+
+def iter_parse_vcf(vcf, total_cov_field, var_cov_field, sample_name = None):
     """
-    Takes in a list of VCF lines, parses and outputs as a list of lists, one per line of data.
-    Multiallelic sites are split into one list per alt allele.
+    Takes in an iterable of VCF lines and lazily parses them in a single pass, yielding one Variant
+    per line of data in input order. Multiallelic sites are split into one Variant per alt allele.
+    Only one VCF line is held in memory at a time.
 
     Args:
-        vcf (list):            list of VCF lines, split by tab. 
+        vcf (iterable):        VCF lines, split by tab, as yielded by iter_vcf(). The first line
+                               must contain the column names.
         total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
         var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference) 
                                coverage.
         sample_name (str):     the name of the sample to be processed in the VCF. If not specified, 
                                the program will take the first column after FORMAT. Default: None
 
-    Returns:
-        A list of lists, in this format: 
+    Yields:
+        Variants (named tuples), in this format, with POS and read counts as integers: 
         [CHROM, POS, REF, ALT, FILTER, N_VARIANT_READS, TOTAL_READS]
     
     Excepts:
         ValueError: If a sample that is not in the VCF is specified by sample_name
         MalformedDataError: If the VCF has no genotype (sample) column
+        MalformedDataError: If a position or read count is not an integer
+    """
+    ## Extract VCF column names
+    vcf = iter(vcf)
+    vcf_colnames = next(vcf)
+    chrom_ind, pos_ind, ref_ind, alt_ind, filt_ind, fmt_ind, samp_ind = _column_indices(
+        vcf_colnames, sample_name
+    )
+
+    cache = _FieldCache(total_cov_field, var_cov_field)
+    for v in vcf:
+        ## We get the variant/total coverage fields by getting the matching index for the
+        ## var/total_cov_field and indexing the genotype fields by that index. The indices are only
+        ## looked up once per distinct FORMAT string.
+        var_ind, total_ind = cache.format_indices(v[fmt_ind])
+        geno = v[samp_ind].split(":")
+        var = geno[var_ind]
+        total = geno[total_ind]
+
+        alt = v[alt_ind]
+        if "," not in alt:
+            yield cache.variant(v, chrom_ind, pos_ind, ref_ind, filt_ind, alt, var, total)
+        else:
+            ## Multiallelic site: split by comma and create a new Variant for each allele
+            for allele, allele_var, allele_total in zip(alt.split(","),
+                                                        var.split(","),
+                                                        total.split(",")):
+                yield cache.variant(v, chrom_ind, pos_ind, ref_ind, filt_ind,
+                                    allele, allele_var, allele_total)
+
+def iter_scan_vcf(vcf_path, total_cov_field, var_cov_field, sample_name = None, threads = 1):
+    """
+    Lazily read and parse a VCF, yielding the same Variants as iter_parse_vcf(iter_vcf()), but
+    scanning uncompressed VCFs from a memory map, as bytes. Header lines are skipped without being
+    decoded, and only the columns that are parsed are decoded, so wide INFO columns and unused
+    sample columns cost little more than a memory copy. Compressed VCFs can't be memory mapped, and
+    are read with iter_vcf().
+
+    Args:
+        vcf_path (str):        path to the input VCF, optionally gzip or BGZF compressed.
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference)
+                               coverage.
+        sample_name (str):     the name of the sample to be processed in the VCF. If not specified,
+                               the program will take the first column after FORMAT. Default: None
+        threads (int):         the number of threads used to decompress BGZF input. Default: 1
+
+    Yields:
+        Variants (named tuples), as iter_parse_vcf().
+
+    Excepts:
+        ValueError: If a sample that is not in the VCF is specified by sample_name
+        MalformedDataError: If the VCF is empty, or is missing fields in the header
+        MalformedDataError: If the VCF has an inconsistent number of columns
+        MalformedDataError: If the VCF has no genotype (sample) column
+        MalformedDataError: If a position or read count is not an integer
+    """
+    if annotator.bgzf.detect_compression(vcf_path) is not None:
+        yield from iter_parse_vcf(iter_vcf(vcf_path, threads = threads), total_cov_field,
+                                  var_cov_field, sample_name = sample_name)
+        return
+
+    ## Validate the header as iter_vcf() does
+    with contextlib.closing(iter_vcf(vcf_path)) as vcf:
+        vcf_colnames = next(vcf)
+    chrom_ind, pos_ind, ref_ind, alt_ind, filt_ind, fmt_ind, samp_ind = _column_indices(
+        vcf_colnames, sample_name
+    )
+    expected_length = len(vcf_colnames)
+    var_cov_field = var_cov_field.encode("utf-8")
+    total_cov_field = total_cov_field.encode("utf-8")
+
+    ## Decode each distinct CHROM and FILTER once, and look up the coverage indices once per
+    ## distinct FORMAT, as _FieldCache does for text
+    strings = {}
+    formats = {}
+    with open(vcf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+        for line in iter(mm.readline, b""):
+            if line.startswith(b"#"):
+                continue
+            v = line.split(b"\t")
+            v[-1] = v[-1].rstrip()
+            if len(v) != expected_length:
+                sublist = line.decode("utf-8", "replace").strip().split("\t")
+                raise annotator.exceptions.MalformedDataError(
+                    "One of your VCF rows has fewer columns than expected. Possible truncation."
+                    f"Problematic column:\n{sublist}"
+                    )
+            fmt = v[fmt_ind]
+            indices = formats.get(fmt)
+            if indices is None:
+                fields = fmt.split(b":")
+                indices = (fields.index(var_cov_field), fields.index(total_cov_field))
+                formats[fmt] = indices
+            geno = v[samp_ind].split(b":")
+            var = geno[indices[0]]
+            total = geno[indices[1]]
+
+            chrom = strings.get(v[chrom_ind])
+            if chrom is None:
+                chrom = strings[v[chrom_ind]] = v[chrom_ind].decode("utf-8")
+            filt = strings.get(v[filt_ind])
+            if filt is None:
+                filt = strings[v[filt_ind]] = v[filt_ind].decode("utf-8")
+            ref = v[ref_ind].decode("utf-8")
+            alt = v[alt_ind].decode("utf-8")
+            try:
+                pos = int(v[pos_ind])
+                if "," not in alt:
+                    yield Variant(chrom, pos, ref, alt, filt, int(var), int(total))
+                else:
+                    ## Multiallelic site: split by comma and create a new Variant for each allele
+                    for allele, allele_var, allele_total in zip(alt.split(","),
+                                                                var.split(b","),
+                                                                total.split(b",")):
+                        yield Variant(chrom, pos, ref, allele, filt, int(allele_var),
+                                      int(allele_total))
+            except ValueError as e:
+                raise annotator.exceptions.MalformedDataError(
+                    f"Non-integer position or read count in VCF line:\n{line.decode('utf-8')}"
+                ) from e
+
+def iter_parse_vcf_samples(vcf, total_cov_field, var_cov_field, samples = None):
+    """
+    Takes in an iterable of VCF lines from a multi-sample VCF and lazily parses them, yielding one
+    Variant per line of data and sample, in input order. Multiallelic sites are split into one
+    Variant per alt allele, and each allele is yielded for every sample in turn. Samples with no
+    coverage data at a site (e.g. a "./." no-call) are skipped for that site.
+
+    Args:
+        vcf (iterable):        VCF lines, split by tab, as yielded by iter_vcf(). The first line
+                               must contain the column names.
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference) 
+                               coverage.
+        samples (list):        the names of the samples to be processed in the VCF. If not
+                               specified, every column after FORMAT is processed. Default: None
+
+    Yields:
+        Tuples of (sample name, Variant), the Variant in this format:
+        [CHROM, POS, REF, ALT, FILTER, N_VARIANT_READS, TOTAL_READS]
+    
+    Excepts:
+        ValueError: If a sample that is not in the VCF is specified in samples
+        MalformedDataError: If the VCF has no genotype (sample) column
+        MalformedDataError: If a position or read count is not an integer
     """
     ## Extract VCF column names
-    vcf_colnames = vcf[0]
-    vcf = vcf[1:]
+    vcf = iter(vcf)
+    vcf_colnames = next(vcf)
 
     ## Extract indices of the fixed VCF fields
     chrom_ind = vcf_colnames.index("#CHROM")
@@ -82,81 +365,81 @@ def parse_vcf(vcf, total_cov_field, var_cov_field, sample_name = None) -> list:
     filt_ind = vcf_colnames.index("FILTER")
     fmt_ind = vcf_colnames.index("FORMAT")
 
-    ## indices of the values in the output file
-    out_chrom = 0
-    out_pos = 1
-    out_ref = 2
-    out_alt = 3
-    out_filt = 4
-    out_var_cov = 5
-    out_tot_cov = 6
-
-
-    ## If the sample name is specified, then check that it exists and use it. Otherwise, use the
-    ## first column after FORMAT
-    if sample_name:
-        if sample_name not in vcf_colnames:
+    ## Use the specified samples, checking that they exist. Otherwise use every column after FORMAT
+    if samples:
+        missing = [sample for sample in samples if sample not in vcf_colnames]
+        if missing:
             raise ValueError(
                 (
-                f"Sample {sample_name} was specified, but not found in the VCF! VCF columns:"
+                f"Samples {missing} were specified, but not found in the VCF! VCF columns:"
                 f"{vcf_colnames}"
                 )
             )
-        samp_ind = vcf_colnames.index(sample_name)
+        samp_inds = [vcf_colnames.index(sample) for sample in samples]
     else:
-        samp_ind = fmt_ind + 1
-        ## Throw an error if the field after FORMAT doesn't exist
-        if len(vcf_colnames) < samp_ind:
+        samp_inds = list(range(fmt_ind + 1, len(vcf_colnames)))
+        ## Throw an error if there are no fields after FORMAT
+        if not samp_inds:
             raise annotator.exceptions.MalformedDataError(
                 "Input VCF does not contain any genotype fields!"
                 )
 
-    ## Split the genotype and format columns by colons
-    genotype_column = [l[samp_ind].split(":") for l in vcf]
-    fmt_column = [l[fmt_ind].split(":") for l in vcf]
-
-    ## Zip the vcf, genotype, and format lists. Get the required fields from vcf by indexing
-    ## using the prior extracted indices.
-    ## We get the variant/total coverage fields by getting the matching index for the
-    ## var/total_cov_field and indexing the genotype fields by that index.
-    tbl = [
-        [
-            v[chrom_ind],
-            v[pos_ind],
-            v[ref_ind],
-            v[alt_ind],
-            v[filt_ind],
-            geno[fmt.index(var_cov_field)],
-            geno[fmt.index(total_cov_field)]
-        ]
-            for (v, geno, fmt) in zip(vcf, genotype_column, fmt_column)
-    ]
-    ## Separate multiallelic variants from non-multiallelic variants
-    tbl_nonmultiallelic = [element for element in tbl if "," not in element[out_alt]]
-    tbl_multiallelic = [element for element in tbl if "," in element[out_alt]]
-
-    ## Loop over multiallelic sites, split by comma and create a new sublist for each allele
-    tbl_multiallelic = [
-        [
-            [
-                element[out_chrom],
-                element[out_pos],
-                element[out_ref],
-                allele,
-                element[out_filt],
-                var,
-                total
-            ]
-            for allele, var, total in zip(element[out_alt].split(","),
-                                          element[out_var_cov].split(","),
-                                          element[out_tot_cov].split(","))
-        ] for element in tbl_multiallelic
-    ]
-
-    ## Flatten the list of lists of lists
-    tbl_multiallelic = [element for sublist in tbl_multiallelic for element in sublist]
-
-    ## Concatenate the list back together and sort by chrom, pos
-    tbl = tbl_nonmultiallelic + tbl_multiallelic
-    tbl.sort(key = lambda x: (x[0], int(x[1])))
+    cache = _FieldCache(total_cov_field, var_cov_field)
+    for v in vcf:
+        ## Find the coverage fields once per line, since FORMAT is shared by all samples
+        var_ind, total_ind = cache.format_indices(v[fmt_ind])
+        alleles = v[alt_ind].split(",")
+
+        ## Collect the coverage of every sample with data at this site
+        coverage = []
+        for samp_ind in samp_inds:
+            geno = v[samp_ind].split(":")
+            ## Trailing FORMAT fields may be dropped, and missing values are "."
+            if len(geno) <= max(var_ind, total_ind) or "." in (geno[var_ind], geno[total_ind]):
+                continue
+            coverage.append(
+                (vcf_colnames[samp_ind], geno[var_ind].split(","), geno[total_ind].split(","))
+            )
+
+        ## Yield every allele for every sample. Like zip() in iter_parse_vcf, alleles without
+        ## per-allele coverage values are dropped.
+        for i, allele in enumerate(alleles):
+            for sample, var, total in coverage:
+                if i >= len(var) or i >= len(total):
+                    continue
+                yield (
+                    sample,
+                    cache.variant(v, chrom_ind, pos_ind, ref_ind, filt_ind,
+                                  allele, var[i], total[i])
+                )
+
+def parse_vcf(vcf, total_cov_field, var_cov_field, sample_name = None) -> list:
+    """
+    Takes in a list of VCF lines, parses and outputs as a list of Variants, one per line of data.
+    Multiallelic sites are split into one Variant per alt allele. The output is sorted by chromosome
+    and position, with chromosomes in natural order (see sort.natural_key()), so it is held in
+    memory in full; use iter_parse_vcf() to stream it instead, and sort.iter_sorted() to sort a
+    stream within a memory budget.
+
+    Args:
+        vcf (iterable):        VCF lines, split by tab, as returned by read_vcf() or yielded by
+                               iter_vcf(). 
+        total_cov_field (str): the name of the FORMAT field that contains TOTAL coverage.
+        var_cov_field (str):   the name of the FORMAT field that contains VARIANT (non-reference) 
+                               coverage.
+        sample_name (str):     the name of the sample to be processed in the VCF. If not specified, 
+                               the program will take the first column after FORMAT. Default: None
+
+    Returns:
+        A list of Variants (named tuples), in this format, with POS and read counts as integers: 
+        [CHROM, POS, REF, ALT, FILTER, N_VARIANT_READS, TOTAL_READS]
+    
+    Excepts:
+        ValueError: If a sample that is not in the VCF is specified by sample_name
+        MalformedDataError: If the VCF has no genotype (sample) column
+    """
+    tbl = list(iter_parse_vcf(vcf, total_cov_field, var_cov_field, sample_name = sample_name))
+
+    ## Sort by chrom, in natural order, then pos
+    tbl.sort(key = annotator.sort.variant_key())
     return tbl
@@ -1,12 +1,134 @@
 """ 
 This module handles VEP API calls. It implements functions for querying the Ensembl VEP API with
-variants processed by the vcf module.
+variants processed by the vcf module. The queries themselves are sent through one of the backends
+in the backends module.
 """
 
-import requests
+import concurrent.futures
+import functools
+import logging
+import time
+
+
+import annotator.backends
+import annotator.chunking
 import annotator.exceptions
+import annotator.extract
+import annotator.metrics
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize = None)
+def default_backend():
+    """
+    The backend used when none is given: the public Ensembl REST API. It is created on first use,
+    so that importing this module opens no HTTP session, and shared afterwards.
+    """
+    return annotator.backends.RestBackend()
+
+def vep_parameters(by_gene = False, extractor = None) -> dict:
+    """
+    Build the query parameters for a VEP API call.
+
+    Args:
+        by_gene (boolean): whether to query for impact by transcript (default, False) or the
+                           highest impact per gene (True). Default: False
+        extractor (object): the annotator.extract.Extractor the annotations are for. Any extra
+                           parameters its fields need are added. Default: None (the default
+                           output columns)
+
+    Returns:
+        A dict of VEP query parameters.
+    """
+    if by_gene:
+        per_gene = "true"
+    else:
+        per_gene = "false"
+    params = {"variant_class": "true", "hgvs": "true", "per_gene":per_gene}
+    if extractor is not None:
+        params.update(extractor.params)
+    return params
+
+def storage_parameters(params, extractor = None) -> dict:
+    """
+    Build the parameters that annotations are cached and journaled under: the VEP query parameters
+    and the parts of the annotation that pruning kept, so that an annotation pruned for one set of
+    output columns is never reused for another.
+
+    Args:
+        params (dict):      the VEP query parameters, as returned by vep_parameters()
+        extractor (object): the annotator.extract.Extractor the annotations are for.
+                            Default: None (the default output columns)
+
+    Returns:
+        A dict of parameters.
+    """
+    if extractor is None:
+        extractor = annotator.extract.DEFAULT_EXTRACTOR
+    return dict(params, fields = extractor.prune_fields)
 
-def get_variant_annotations(vcf_lines, by_gene = False) -> list:
+def prune_annotation(annotation, fields = None) -> dict:
+    """
+    Drop the parts of a VEP annotation that are not needed to build output lines. Per-transcript
+    annotations carry dozens of keys per transcript, of which only a handful are used, so pruning
+    them early shrinks what is held in memory, cached and journaled.
+
+    Args:
+        annotation (dict): a VEP annotation, as returned by get_variant_annotations()
+        fields (dict):     the parts to keep: for each top-level key, None to keep its value whole,
+                           or the keys to keep of each dict in its list, as in
+                           extract.Extractor.prune_fields. Default: None (the parts read for the
+                           default output columns)
+
+    Returns:
+        The pruned annotation (dict).
+    """
+    if fields is None:
+        fields = annotator.extract.DEFAULT_EXTRACTOR.prune_fields
+    pruned = {}
+    for key, subfields in fields.items():
+        value = annotation.get(key)
+        if value is None:
+            continue
+        if subfields is not None:
+            value = [
+                {subkey: element[subkey] for subkey in subfields if subkey in element}
+                for element in value
+            ]
+        pruned[key] = value
+    return pruned
+
+def match_annotations(vcf_lines, annotations) -> list:
+    """
+    Match VEP annotations back to the variants they are for, through the query string VEP echoes
+    in their "input" field, rather than by position. VEP may drop or reorder results, which would
+    otherwise misalign every following variant.
+
+    Args:
+        vcf_lines (list):   the variants that were queried, as output by vcf.parse_vcf()
+        annotations (list): the VEP annotations returned for them, in any order
+
+    Returns:
+        A list of VEP annotations, one per variant, in the order of vcf_lines. Variants that VEP
+        returned no annotation for get {"input": ..., "error": ...} instead, so they are output
+        with NA annotations, and are not cached.
+    """
+    by_input = {annotation.get("input"): annotation for annotation in annotations}
+    out = []
+    missing = []
+    for line in vcf_lines:
+        query = annotator.backends.variant_query(line)
+        annotation = by_input.get(query)
+        if annotation is None:
+            missing.append(query)
+            annotation = {"input": query, "error": "No result returned by VEP"}
+        out.append(annotation)
+    if missing:
+        logger.warning("VEP returned no result for %s of %s variants, which are output without "
+                       "annotation: %s", len(missing), len(vcf_lines), ", ".join(missing[:10]))
+    return out
+
+def get_variant_annotations(vcf_lines, by_gene = False, backend = None, extractor = None) -> list:
     """
     Takes in a list of parsed variant lines in the format returned by vcf.parse_vcf(), performs a
     VEP API call and returns the resulting JSON for each variant. 
@@ -18,68 +140,72 @@ def get_variant_annotations(vcf_lines, by_gene = False) -> list:
                            vcf.parse_vcf(). Use other data sources at your own risk.
         by_gene (boolean): whether to query for impact by transcript (default, False) or the
                            highest impact per gene (True). Default: False
+        backend (object):  the annotator.backends.AnnotationBackend to send the query to.
+                           Default: None (the public Ensembl REST API)
+        extractor (object): the annotator.extract.Extractor the annotations are for. Its query
+                           parameters are sent, and the annotations are pruned to the parts it
+                           reads. Default: None (the default output columns)
 
     Returns:
-        A list of API returns, one per input element. 
+        A list of API returns, one per input element in the same order, pruned by 
+        prune_annotation(). They are matched to the input by match_annotations().
     """
     ## Error handling of empty VCFs is not this function's job, so we return an empty list for empty
     ## variants
     if len(vcf_lines) == 0:
         return []
-    ## hardcoded REST API URL/headers
-    url = "https://rest.ensembl.org"
-    ext = "/vep/homo_sapiens/region"
-    headers={ "Content-Type" : "application/json", "Accept" : "application/json"}
-    ## Build the query string. Per VEP documentation, format is same as VCF 4.0: CHROM POS ID REF
-    ## ALT QUAL FILTER INFO.
-    ## Query string is JSON formatted and space-separated. Sub a period in for ID, QUAL, FILTER,
-    ## INFO. Concatenate the resulting list elements with a ", ", and then add the head and tail
-    ## of the json with string addition.
-    query_string = '", "'.join(
-        [
-            f"{line[0]} {line[1]} . {line[2]} {line[3]} . . ." 
-            for line in vcf_lines
-        ]
-    )
-    query_string = '{ "variants" : ["' + query_string + '" ] }'
-
-    if by_gene:
-        per_gene = "true"
-    else:
-        per_gene = "false"
-
-    ## Parameters for the API call
-    params = {"variant_class": "true", "hgvs": "true", "per_gene":per_gene}
-
-    ## Post the request
-    r = requests.post(url+ext,
-                      headers = headers,
-                      data = query_string,
-                      params = params,
-                      timeout = 60
-                      )
-
-    ## Throw an error if the request is an error
-    if r.status_code != 200:
-        raise annotator.exceptions.RequestError(
-            (
-                f"API request failed with status {r.status_code}!"
-                f"See below for the data given to the API:\n{query_string}"
-            )
-            )
-    return r.json()
-
-def get_chunked_annotations(variant_lines, chunk_size = 200, by_gene = False):
+    if backend is None:
+        backend = default_backend()
+    if extractor is None:
+        extractor = annotator.extract.DEFAULT_EXTRACTOR
+    annotations = match_annotations(vcf_lines,
+                                    backend.annotate(vcf_lines, vep_parameters(by_gene, extractor)))
+    fields = extractor.prune_fields
+    return [
+        annotation if "error" in annotation else prune_annotation(annotation, fields)
+        for annotation in annotations
+    ]
+
+def get_chunked_annotations(variant_lines, chunk_size = 200, by_gene = False, max_workers = 1,
+                            backend = None, journal = None, extractor = None, metrics = None,
+                            chunk_sizer = None, progress = None):
     """
     Runs the get_variant_annotations() function on sublists of variant_lines, 
-    chunk_size elements at a time.
+    at most chunk_size elements at a time.
     Ostensibly this exists because the VEP API has a limit of 200 items per request. 
 
+    The chunk size adapts to the server (see chunking.AdaptiveChunkSize): it shrinks when requests
+    are slow, responses are large or the backend retries a throttled or failed request, and grows
+    back to chunk_size when they aren't. A chunk rejected as malformed (400) is bisected until the
+    offending variants are isolated; the rest are annotated as usual, and each rejected variant is
+    logged and given an empty annotation, {"input": ..., "error": ...}, so that it is output with
+    NA annotations.
+
     Args:
         variant_lines (list): list of variant lines (lists), as returned from vcf.parse_vcf()
-        chunk_size (int):     number of elements in each batch API request
+        chunk_size (int):     the maximum number of elements in each batch API request
         by_gene (boolean):    whether to query for impact by transcript (default, False) or the 
                               highest impact per gene (True). Default: False
+        max_workers (int):    the maximum number of chunks to have in flight at once. Chunks are
+                              posted from a thread pool, since the runtime is dominated by waiting
+                              on the network. Results are returned in input order regardless.
+                              Default: 1 (sequential)
+        backend (object):     the annotator.backends.AnnotationBackend to send queries to.
+                              Default: None (the public Ensembl REST API)
+        journal (object):     an annotator.journal.Journal to checkpoint completed chunks to.
+                              Chunks already completed in the journal are not queried again.
+                              Default: None (no checkpointing)
+        extractor (object):   the annotator.extract.Extractor the annotations are for.
+                              Default: None (the default output columns)
+        metrics (object):     an annotator.metrics.Metrics to count progress in. Progress is
+                              logged periodically either way, with an estimate of the time left.
+                              Default: None
+        chunk_sizer (object): an annotator.chunking.AdaptiveChunkSize to size chunks with, to keep
+                              what it learned across calls. Overrides chunk_size. Default: None (a
+                              new one, starting at chunk_size)
+        progress (object):    an annotator.metrics.Progress to count the annotated variants in, to
+                              log progress across calls. Default: None (the progress of metrics if
+                              given, otherwise one for this call only)
     
     Returns:
         A list of API returns, one per input element.
@@ -90,23 +216,106 @@ def get_chunked_annotations(variant_lines, chunk_size = 200, by_gene = False):
     ## Verify that the chunk size is a positive integer
     if chunk_size < 1:
         raise ValueError("Provided chunk size must be an integer > 0")
-
-    ## Run get_variant_annotations on chunk_size length sublists of the variants
-    ret = [
-            get_variant_annotations(variant_lines[sublist:sublist+chunk_size], by_gene = by_gene)
-            for sublist in range(0, len(variant_lines), chunk_size)
-          ]
-
-    ## Flatten the resulting list of chunk-size lists
-    ret = [element for sublist in ret for element in sublist]
-    return ret
+    ## Same for the number of concurrent requests
+    if not isinstance(max_workers, int) or max_workers < 1:
+        raise ValueError("Provided max_workers must be an integer > 0")
+    if backend is None:
+        backend = default_backend()
+    if chunk_sizer is None:
+        chunk_sizer = annotator.chunking.AdaptiveChunkSize(chunk_size)
+
+    ## Halve the chunk size whenever the backend retries a throttled or failed request, so that the
+    ## chunks sent after it are smaller
+    backend.retry_listeners.append(chunk_sizer.failure)
+    try:
+        ## Log progress across calls if given a progress or metrics, otherwise for this call only
+        if progress is None and metrics is not None:
+            progress = metrics.progress
+        elif progress is None:
+            progress = annotator.metrics.Progress(total = len(variant_lines))
+
+        ## Annotate a chunk, and adapt the chunk size to how the request went. A rejected chunk is
+        ## split in two until the variants the server rejects are on their own.
+        def annotate_lines(chunk):
+            start = time.perf_counter()
+            try:
+                annotations = get_variant_annotations(chunk, by_gene = by_gene, backend = backend,
+                                                      extractor = extractor)
+            except annotator.exceptions.BadRequestError as e:
+                if len(chunk) > 1:
+                    half = len(chunk) // 2
+                    return annotate_lines(chunk[:half]) + annotate_lines(chunk[half:])
+                query = annotator.backends.variant_query(chunk[0])
+                logger.warning("VEP rejected variant %s, which is output without annotation: %s",
+                               query, e)
+                if metrics is not None:
+                    metrics.count("rejected_variants")
+                return [{"input": query, "error": str(e)}]
+            chunk_sizer.success(len(chunk), time.perf_counter() - start,
+                                backend.last_response_bytes)
+            return annotations
+
+        ## Annotate a chunk, unless it was already completed in the journal, and journal the result.
+        ## Rejected variants aren't journaled, so a resumed run tries them again.
+        def annotate_chunk(chunk):
+            if journal is None:
+                annotations = annotate_lines(chunk)
+            else:
+                params = storage_parameters(vep_parameters(by_gene, extractor), extractor)
+                annotations = journal.lookup(chunk, params)
+                if annotations is None:
+                    annotations = annotate_lines(chunk)
+                    done = [(line, annotation) for line, annotation in zip(chunk, annotations)
+                            if "error" not in annotation]
+                    if done:
+                        journal.record([line for line, _ in done], params,
+                                       [annotation for _, annotation in done])
+            progress.update(len(chunk))
+            return annotations
+
+        ## Split the variants into chunks as they are sent, so each gets the chunk size of the
+        ## moment
+        def iter_chunks():
+            start = 0
+            while start < len(variant_lines):
+                chunk = variant_lines[start:start + chunk_sizer.size]
+                start += len(chunk)
+                yield chunk
+
+        ## Run annotate_chunk on each chunk. With a single worker (or a single chunk) there's no
+        ## point in spinning up a thread pool.
+        if max_workers == 1 or len(variant_lines) <= chunk_sizer.size:
+            ret = [annotate_chunk(chunk) for chunk in iter_chunks()]
+            return [element for sublist in ret for element in sublist]
+
+        ## Otherwise chunks are submitted a few at a time, rather than all at once, so that later
+        ## chunks are sized by what earlier ones showed. Chunks are collected as they complete, in
+        ## any order, into an index from query string to annotation, and put back in input order at
+        ## the end.
+        results = {}
+        chunks = {}
+        def collect(futures):
+            for future in futures:
+                chunk = chunks.pop(future)
+                results.update(zip(map(annotator.backends.variant_query, chunk), future.result()))
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max_workers) as executor:
+            for chunk in iter_chunks():
+                chunks[executor.submit(annotate_chunk, chunk)] = chunk
+                if len(chunks) >= 2 * max_workers:
+                    done, _ = concurrent.futures.wait(
+                        chunks, return_when = concurrent.futures.FIRST_COMPLETED
+                    )
+                    collect(done)
+            collect(concurrent.futures.as_completed(list(chunks)))
+        return [results[annotator.backends.variant_query(line)] for line in variant_lines]
+    finally:
+        backend.retry_listeners.remove(chunk_sizer.failure)
 
 def merge_variant_annotation(variant, annotation, consequences_list) -> list:
     """
-    Parse a single variant and its associated annotations, extracting annotations according to a 
-    list of possible consequences keys.
-    This function is intended to be used ie. by looping on a zip of the full list of 
-    variants/annotations.
+    Parse a single variant and its associated annotations, extracting the default output columns
+    according to a list of possible consequences keys.
+    The annotator.extract.Extractor for each consequences list is compiled once and reused.
 
     Args:
         variant (list):          a list corresponding to a single variant from the list returned 
@@ -120,131 +329,179 @@ def merge_variant_annotation(variant, annotation, consequences_list) -> list:
         a list of variant annotations for the provided variant. One element per annotated 
         gene/transcript. 
     """
-    ## Compute allele frequency in the variant calls
-    var_af = str(round(int(variant[5])/int(variant[6]), ndigits = 5))
-
-    ## Extract variant class
-    variant_class = annotation.get("variant_class", "NA")
-
-    ## Get each consequence entry if it exists
-    features = [annotation.get(consequence) for consequence in consequences_list]
-    features = [feature for feature in features if feature is not None]
-
-    ## If we have transcript_consequences or intergenic_consequences, loop through and extract
-    ## gene_id, gene_symbol, transcript_id, impact, and consequence_terms
-    if features:
-        ## Flatten the list
-        features = [element for sublist in features for element in sublist]
-
-        ## Extract the desired annotations, returning "NA" if they do not exist
-        extracted = [
-            [
-                feature.get("gene_id", "NA"),
-                feature.get("gene_symbol", "NA"),
-                feature.get("transcript_id", "NA"),
-                feature.get("impact", "NA"),
-                feature.get("hgvsp", "NA"),
-                ";".join(feature.get("consequence_terms", "NA"))
-            ] for feature in features
-        ]
-    else:
-        ## If there's nothing, then we simply return NAs
-        extracted = ["NA"] * 6
-
-    ## Allele frequency data is contained within colocated_variants.
-    ## colocated_variants is a list of dicts, as multiple variant databases are used
-    ## (ie. HGMD, COSMIC, dbSNP).
-    ## if population allele frequencies are available, they are a key named "frequencies"
-    colocated_data = annotation.get("colocated_variants")
-
-    ## If there's annotated variants at this position (colocated variants), pull COSMIC
-    ## IDs and minor allele frequencies
-    if colocated_data:
-        ## Check for COSMIC IDs. VEP doesn't match COSMIC ID with the actual allele of interest,
-        ## so in this case we return the list of all COSMIC variants at this locus.
-        cosmic_strings = [
-                            element.get("id")
-                            for element in colocated_data if
-                                element.get("allele_string") == "COSMIC_MUTATION"
-                        ]
-        if cosmic_strings:
-            ## Concatenate with semicolons for a single output field
-            cosmic_strings = ";".join(cosmic_strings)
-        else:
-            ## If there's no COSMIC IDs, then set it to None
-            cosmic_strings = "NA"
-
-        ## Check for dbSNP (rs) IDs. There should only be one dbSNP ID per variant.
-        ## Need to do two loops here, first to get all the "id" values, second to select those
-        ## starting with "rs"
-        rs_strings = [element.get("id") for element in colocated_data if element.get("id")]
-        rs_strings = [rs for rs in rs_strings if rs.startswith("rs")]
-
-        ## Extract rs IDs
-        if rs_strings:
-            ## Concatenate with semicolons for a single output field
-            rs_string = ";".join(rs_strings)
-        else:
-            ## If no dbSNP IDs, set to None
-            rs_string = "NA"
-
-        ## Check for allele frequency data. Frequency is a dict, each key is an alt allele, which
-        ## is another dict of allele frequencies from various sources, such as gnomAD
-        af_data = [element for element in colocated_data if element.get("frequencies")]
-
-        if af_data:
-            ## Get the frequencies dict for the variant matching our alt allele
-            ## We use the first instance of frequencies because population allele frequencies
-            ## should be the same for multiple colocated_data entries
-            af_dict = af_data[0].get("frequencies", {}).get(variant[3], {})
-            ## Get the allele frequency. We first try the "af" key, and if it isn't found, we fall
-            ## back to "gnomade", finally returning "NA" if neither
-            af = str(af_dict.get("af", af_dict.get("gnomade", "NA")))
-        else:
-            af = "NA"
-    else: ## There's no annotated variant here
-        af = "NA"
-        cosmic_strings = "NA"
-        rs_string = "NA"
-
-    result = [
-        variant + [var_af, variant_class] + e + [rs_string, cosmic_strings, af] for e in extracted
-        ]
+    return _consequences_extractor(tuple(consequences_list)).extract(variant, annotation)
+
+@functools.lru_cache(maxsize = None)
+def _consequences_extractor(consequences_list):
+    "The Extractor of the default output columns for a tuple of consequences keys"
+    if list(consequences_list) == annotator.extract.DEFAULT_EXTRACTOR.consequence_keys:
+        return annotator.extract.DEFAULT_EXTRACTOR
+    return annotator.extract.Extractor(consequence_keys = consequences_list)
+
+def get_cached_annotations(variant_lines, cache, by_gene = False, extractor = None,
+                           **kwargs) -> list:
+    """
+    Looks variants up in an annotation cache, runs get_chunked_annotations() on the cache misses
+    only, and stores the fetched annotations in the cache.
+
+    Args:
+        variant_lines (list): list of variant lines (lists), as returned from vcf.parse_vcf()
+        cache (object):       the annotator.cache.AnnotationCache to use
+        by_gene (boolean):    whether to query for impact by transcript (default, False) or the 
+                              highest impact per gene (True). Default: False
+        extractor (object):   the annotator.extract.Extractor the annotations are for.
+                              Default: None (the default output columns)
+        **kwargs:             passed to get_chunked_annotations()
 
-    return result
+    Returns:
+        A list of API returns, one per input element.
+    """
+    params = storage_parameters(vep_parameters(by_gene, extractor), extractor)
+    annotations = cache.get_many(variant_lines, params)
+    misses = [line for line, annotation in zip(variant_lines, annotations) if annotation is None]
+    fetched = get_chunked_annotations(misses, by_gene = by_gene, extractor = extractor, **kwargs)
+    ## Don't cache the variants VEP rejected, so that they are tried again next time
+    done = [(line, annotation) for line, annotation in zip(misses, fetched)
+            if "error" not in annotation]
+    cache.put_many([line for line, _ in done], [annotation for _, annotation in done], params)
+
+    ## Slot the fetched annotations back into the gaps, in order
+    fetched = iter(fetched)
+    return [next(fetched) if annotation is None else annotation for annotation in annotations]
+
+def deduplicate_variants(vcf_lines):
+    """
+    Find the distinct alleles in a list of variants, so that each is only queried once. Variants
+    are distinct if they differ in CHROM, POS, REF or ALT (i.e. in their VEP query).
 
-def annotate_variants(vcf_lines, chunk_size = 200, by_gene = False) -> list:
+    Args:
+        vcf_lines (list): a list of variants, as output by vcf.parse_vcf()
+
+    Returns:
+        A tuple of (unique_lines, index): the first variant line of each distinct allele, in order
+        of first appearance, and for every input variant the index of its allele in unique_lines.
+    """
+    first_seen = {}
+    unique_lines = []
+    index = []
+    for line in vcf_lines:
+        query = annotator.backends.variant_query(line)
+        if query not in first_seen:
+            first_seen[query] = len(unique_lines)
+            unique_lines.append(line)
+        index.append(first_seen[query])
+    return unique_lines, index
+
+def annotate_variants(vcf_lines, chunk_size = 200, by_gene = False, max_workers = 1,
+                      cache = None, backend = None, journal = None, flatten = True,
+                      extractor = None, metrics = None, chunk_sizer = None, store = None,
+                      progress = None) -> list:
     """
     Annotates variants and outputs a list of lists containing variant information, variant
     annotation, and variant impact, one list per genetic feature that each variant impacts.
+    Each distinct allele is only queried once, and its annotation is shared by every input variant
+    with the same CHROM, POS, REF and ALT.
 
     Args:
-        vcf_lines (list): a list of variants, as output by vcf.parse_vcf(), formatted: 
-                          [CHROM, POS, REF, ALT, FILTER, N_VARIANT_READS, TOTAL_READS].
-                          We explicitly trust this object to be correct by being created by
-                          vcf.parse_vcf(). Use other data sources at your own risk.
-        chunk_size (int): number of elements in each batch API request
+        vcf_lines (list):  a list of variants, as output by vcf.parse_vcf(), formatted: 
+                           [CHROM, POS, REF, ALT, FILTER, N_VARIANT_READS, TOTAL_READS].
+                           We explicitly trust this object to be correct by being created by
+                           vcf.parse_vcf(). Use other data sources at your own risk.
+        chunk_size (int):  number of elements in each batch API request
+        by_gene (boolean): whether to query for impact by transcript (default, False) or the
+                           highest impact per gene (True). Default: False
+        max_workers (int): the maximum number of VEP API requests to have in flight at once.
+                           Default: 1
+        cache (object):    an annotator.cache.AnnotationCache to look annotations up in before
+                           querying the API. Only cache misses are sent to the API, and their
+                           annotations are stored in the cache. Default: None (no caching)
+        backend (object):  the annotator.backends.AnnotationBackend to send queries to.
+                           Default: None (the public Ensembl REST API)
+        journal (object):  an annotator.journal.Journal to checkpoint completed chunks to.
+                           Default: None (no checkpointing)
+        flatten (boolean): whether to return one flat list of output lines (True), or one list of
+                           output lines per input variant (False). Default: True
+        extractor (object): the annotator.extract.Extractor that builds the output lines, and so
+                           sets the output columns. Default: None (the default output columns)
+        metrics (object):  an annotator.metrics.Metrics to record the time spent getting
+                           annotations ("annotate") and building output lines ("merge") in.
+                           Default: None
+        chunk_sizer (object): an annotator.chunking.AdaptiveChunkSize to size requests with, to
+                           keep what it learned across calls. Default: None (a new one, starting at
+                           chunk_size)
+        store (object):    an annotator.store.AnnotationStore to look annotations up in first. Only
+                           the variants it doesn't hold are looked up in the cache or sent to the
+                           API. Default: None (no store)
+        progress (object): an annotator.metrics.Progress to count the variants sent to the API in,
+                           as by get_chunked_annotations(). Default: None
     
     Returns:
-        A list of lists, each in this format, with "NA" for missing values: 
+        A list of lists, each in this format by default (see extractor.columns), with "NA" for
+        missing values: 
         [CHROM, POS, REF, ALT, FILTER, N_VARIANT_READS, TOTAL_READS, VARIANT_READ_FRACTION, 
         VARIANT_TYPE, GENE_ID, GENE_SYMBOL, TRANSCRIPT_ID, IMPACT, CONSEQUENCE_TERMS, HGVSP, 
         DBSNP_ID, COSMIC_ID, POP_AF]
+        If flatten is False, these are grouped into one list per input variant.
     """
-    ## Get annotations for the variants
-    annotations = get_chunked_annotations(vcf_lines, chunk_size = chunk_size, by_gene = by_gene)
-
-    ## Set which VEP consequences we want
-    consequences_list = ["transcript_consequences", "intergenic_consequences"]
-
-    ## Use a list comprehension to run merge_variant_annotation on every variant and its associated
-    ## VEP annotations
-    out_list =  [
-                    annotator.vep.merge_variant_annotation(variant, annotation, consequences_list)
-                    for variant, annotation in zip(vcf_lines, annotations)
-                ]
+    if extractor is None:
+        extractor = annotator.extract.DEFAULT_EXTRACTOR
+
+    ## Only look up each distinct allele once
+    unique_lines, index = deduplicate_variants(vcf_lines)
+
+    ## Get annotations for the variants, only querying the API for those that aren't stored or
+    ## cached
+    with annotator.metrics.stage(metrics, "annotate"):
+        if store is not None:
+            stored = store.get_many(unique_lines,
+                                    storage_parameters(vep_parameters(by_gene, extractor),
+                                                       extractor))
+            missing = [line for line, annotation in zip(unique_lines, stored) if annotation is None]
+            if metrics is not None:
+                metrics.count("store_hits", len(unique_lines) - len(missing))
+        else:
+            missing = unique_lines
+        if cache is None:
+            annotations = get_chunked_annotations(missing,
+                                                  chunk_size = chunk_size,
+                                                  by_gene = by_gene,
+                                                  max_workers = max_workers,
+                                                  backend = backend,
+                                                  journal = journal,
+                                                  extractor = extractor,
+                                                  metrics = metrics,
+                                                  chunk_sizer = chunk_sizer,
+                                                  progress = progress)
+        else:
+            annotations = get_cached_annotations(missing,
+                                                 cache,
+                                                 chunk_size = chunk_size,
+                                                 by_gene = by_gene,
+                                                 max_workers = max_workers,
+                                                 backend = backend,
+                                                 journal = journal,
+                                                 extractor = extractor,
+                                                 metrics = metrics,
+                                                 chunk_sizer = chunk_sizer,
+                                                 progress = progress)
+        if store is not None:
+            ## Slot the fetched annotations back into the gaps, in order
+            fetched = iter(annotations)
+            annotations = [next(fetched) if annotation is None else annotation
+                           for annotation in stored]
+
+    with annotator.metrics.stage(metrics, "merge"):
+        ## Fan the annotations of the distinct alleles back out to every input variant
+        annotations = [annotations[i] for i in index]
+
+        ## Build the output lines of every variant from its VEP annotation
+        extract = extractor.extract
+        out_list = [
+            extract(variant, annotation) for variant, annotation in zip(vcf_lines, annotations)
+        ]
 
     ## Flatten the out_list
-    out_list = [element for sublist in out_list for element in sublist]
+    if flatten:
+        out_list = [element for sublist in out_list for element in sublist]
 
     return out_list
@@ -0,0 +1,8 @@
+"""
+Benchmarks of the annotator pipeline. The suite is made of three parts:
+    synthetic:   a generator of synthetic Platypus-style VCFs of any size
+    mock_server: a local mock of the VEP REST API, with configurable latency
+    run:         per-stage timing and memory reports, which can be compared across commits
+
+Run "python -m benchmarks.run --help" from the repository root for usage.
+"""
@@ -0,0 +1,294 @@
+"""
+This module implements a local mock of the VEP REST API for benchmarking. It answers POST requests
+to /vep/<species>/region like the Ensembl server: one annotation per queried variant, echoing the
+query in the "input" field.
+
+Annotations are either replayed from a file of recorded VEP responses, or synthesized. Synthetic
+annotations are deterministic for a given query, and have the shape and size of real ones: several
+transcript consequences with the usual keys, or an intergenic consequence, and colocated dbSNP and
+COSMIC variants with population frequencies. A latency can be added to every request, and a
+fraction of requests can be failed with 503 to exercise the client's retries. Requests with a
+variant whose alleles aren't nucleotides are rejected with 400, as VEP does.
+
+Usage:
+    python -m benchmarks.mock_server [--port PORT] [--latency SECONDS] [--responses PATH]
+"""
+import argparse
+import http.server
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+
+import annotator.jsonutil
+
+CONSEQUENCES = [
+    ("missense_variant", "MODERATE"), ("synonymous_variant", "LOW"), ("intron_variant", "MODIFIER"),
+    ("3_prime_UTR_variant", "MODIFIER"), ("5_prime_UTR_variant", "MODIFIER"),
+    ("upstream_gene_variant", "MODIFIER"), ("downstream_gene_variant", "MODIFIER"),
+    ("stop_gained", "HIGH"), ("splice_region_variant", "LOW"), ("frameshift_variant", "HIGH"),
+    ("non_coding_transcript_exon_variant", "MODIFIER")
+]
+BIOTYPES = ["protein_coding", "protein_coding", "protein_coding", "nonsense_mediated_decay",
+            "retained_intron", "lncRNA"]
+## Alleles VEP accepts in region queries
+ALLELE = re.compile(r"[ACGTNacgtn-]+")
+POPULATIONS = ["gnomade", "gnomadg", "af", "afr", "amr", "eas", "eur", "sas"]
+
+def _variant_class(ref, alt):
+    if len(ref) == len(alt):
+        return "SNV" if len(ref) == 1 else "substitution"
+    return "insertion" if len(alt) > len(ref) else "deletion"
+
+def synthesize_annotation(query, per_gene = False) -> dict:
+    """
+    Synthesize a realistic VEP annotation of a variant. The same query always gives the same
+    annotation.
+
+    Args:
+        query (str):        the variant query string, as sent to the VEP region endpoint
+        per_gene (boolean): whether to report one consequence per gene, as VEP's per_gene option.
+                            Default: False
+
+    Returns:
+        A VEP annotation (dict).
+    """
+    chrom, pos, _, ref, alt = query.split(" ")[:5]
+    pos = int(pos)
+    rng = random.Random(zlib.crc32(query.encode("utf-8")))
+    annotation = {
+        "input": query,
+        "id": ".",
+        "seq_region_name": chrom,
+        "start": pos,
+        "end": pos + len(ref) - 1,
+        "strand": 1,
+        "allele_string": f"{ref}/{alt}",
+        "assembly_name": "GRCh38",
+        "variant_class": _variant_class(ref, alt)
+    }
+    if rng.random() < 0.3:
+        ## Intergenic variants have a single consequence, without gene or transcript
+        annotation["most_severe_consequence"] = "intergenic_variant"
+        annotation["intergenic_consequences"] = [{
+            "variant_allele": alt, "impact": "MODIFIER",
+            "consequence_terms": ["intergenic_variant"]
+        }]
+    else:
+        consequences = []
+        for gene in range(1 if per_gene else rng.randint(1, 2)):
+            gene_id = f"ENSG{rng.randint(0, 99999999999):011d}"
+            symbol = f"GENE{rng.randint(1, 20000)}"
+            for transcript in range(1 if per_gene else rng.randint(1, 8)):
+                term, impact = rng.choice(CONSEQUENCES)
+                transcript_id = f"ENST{rng.randint(0, 99999999999):011d}"
+                consequence = {
+                    "variant_allele": alt, "gene_id": gene_id, "gene_symbol": symbol,
+                    "gene_symbol_source": "HGNC", "hgnc_id": f"HGNC:{rng.randint(1, 50000)}",
+                    "transcript_id": transcript_id, "biotype": rng.choice(BIOTYPES),
+                    "impact": impact, "consequence_terms": [term], "strand": rng.choice([1, -1])
+                }
+                if transcript == 0:
+                    consequence["canonical"] = 1
+                if impact in ("MODERATE", "LOW", "HIGH"):
+                    protein_pos = rng.randint(1, 2000)
+                    consequence.update({
+                        "hgvsc": f"{transcript_id}.1:c.{protein_pos * 3}{ref}>{alt}",
+                        "hgvsp": f"ENSP{rng.randint(0, 99999999999):011d}.1:p.Gly{protein_pos}Cys",
+                        "protein_start": protein_pos, "protein_end": protein_pos,
+                        "cdna_start": protein_pos * 3 + 60, "cdna_end": protein_pos * 3 + 60,
+                        "cds_start": protein_pos * 3, "cds_end": protein_pos * 3,
+                        "amino_acids": "G/C", "codons": "Ggt/Tgt"
+                    })
+                if term == "missense_variant":
+                    consequence.update({
+                        "sift_prediction": rng.choice(["deleterious", "tolerated"]),
+                        "sift_score": round(rng.random(), 2),
+                        "polyphen_prediction": rng.choice(["benign", "probably_damaging"]),
+                        "polyphen_score": round(rng.random(), 3)
+                    })
+                elif term in ("upstream_gene_variant", "downstream_gene_variant"):
+                    consequence["distance"] = rng.randint(1, 5000)
+                consequences.append(consequence)
+        annotation["transcript_consequences"] = consequences
+        annotation["most_severe_consequence"] = consequences[0]["consequence_terms"][0]
+    colocated = []
+    if rng.random() < 0.5:
+        colocated.append({
+            "id": f"rs{rng.randint(1, 999999999)}", "allele_string": f"{ref}/{alt}",
+            "start": pos, "end": pos + len(ref) - 1, "strand": 1, "seq_region_name": chrom,
+            "frequencies": {alt: {p: round(rng.random() / 10, 5) for p in POPULATIONS}}
+        })
+    if rng.random() < 0.1:
+        colocated.append({
+            "id": f"COSV{rng.randint(1, 99999999)}", "allele_string": "COSMIC_MUTATION",
+            "start": pos, "end": pos, "strand": 1, "seq_region_name": chrom, "somatic": 1
+        })
+    if colocated:
+        annotation["colocated_variants"] = colocated
+    return annotation
+
+def load_responses(path) -> dict:
+    """
+    Load recorded VEP responses, as read by backends.ReplayBackend: a JSON list of VEP responses,
+    or JSON lines of bare responses or {"params": ..., "response": ...} records.
+
+    Args:
+        path (str): path to the recorded responses
+
+    Returns:
+        A dictionary of VEP responses keyed by their "input" field.
+    """
+    with open(path, "r", encoding = "utf-8") as f:
+        text = f.read()
+    if text.lstrip().startswith("["):
+        records = annotator.jsonutil.loads(text)
+    else:
+        records = [annotator.jsonutil.loads(l) for l in text.splitlines() if l.strip()]
+    return {r["response"]["input"] if "response" in r else r["input"]:
+            r.get("response", r) for r in records}
+
+class MockVepServer:
+    """
+    A mock VEP REST server, run in a background thread. Use it as a context manager, and point a
+    backends.RestBackend at its url.
+
+    Args:
+        latency (float):    seconds to wait before answering each request. Default: 0
+        responses (str):    path to recorded VEP responses to replay. Variants without a recorded
+                            response get a synthetic one. Default: None (all synthetic)
+        error_rate (float): the fraction of requests to fail with 503 Service Unavailable.
+                            Default: 0
+        host (str):         the address to listen on. Default: "127.0.0.1"
+        port (int):         the port to listen on. Default: 0 (any free port)
+    """
+    def __init__(self, latency = 0.0, responses = None, error_rate = 0.0, host = "127.0.0.1",
+                 port = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.responses = load_responses(responses) if responses else {}
+        self.requests = 0
+        self.variants = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        "The base URL of the server"
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def annotate(self, queries, params) -> list:
+        """
+        Answer a list of variant queries, with recorded responses where available.
+
+        Args:
+            queries (list): the variant query strings
+            params (dict):  the query parameters
+
+        Returns:
+            A list of VEP annotations (dicts), one per query.
+        """
+        per_gene = params.get("per_gene") in ("1", "true")
+        return [self.responses.get(q) or synthesize_annotation(q, per_gene) for q in queries]
+
+    def _handler(self):
+        mock = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            "Request handler of the mock server"
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, headers = None):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                url = urllib.parse.urlsplit(self.path)
+                parts = url.path.strip("/").split("/")
+                if len(parts) != 3 or parts[0] != "vep" or parts[2] != "region":
+                    self._reply(404, b'{"error":"Not found"}')
+                    return
+                with mock._lock:
+                    mock.requests += 1
+                    failed = mock._rng.random() < mock.error_rate
+                if mock.latency:
+                    time.sleep(mock.latency)
+                if failed:
+                    self._reply(503, b'{"error":"Service unavailable"}', {"Retry-After": "0"})
+                    return
+                try:
+                    queries = annotator.jsonutil.loads(body)["variants"]
+                except (annotator.jsonutil.JSONDecodeError, KeyError, TypeError):
+                    self._reply(400, b'{"error":"Malformed request body"}')
+                    return
+                ## Like VEP, reject the whole request if any variant has an invalid allele
+                for query in queries:
+                    fields = str(query).split(" ")
+                    if len(fields) < 5 or not all(ALLELE.fullmatch(a) for a in fields[3:5]):
+                        self._reply(400, annotator.jsonutil.dumps_bytes(
+                            {"error": f"Could not parse variant {query}"}
+                        ))
+                        return
+                params = dict(urllib.parse.parse_qsl(url.query))
+                with mock._lock:
+                    mock.variants += len(queries)
+                self._reply(200, annotator.jsonutil.dumps_bytes(mock.annotate(queries, params)))
+        return Handler
+
+    def start(self):
+        "Start serving in a background thread"
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        "Stop serving and close the socket"
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    "Runs the mock server from the command line, until interrupted"
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks.mock_server",
+                                     description = "Runs a mock VEP REST server.")
+    parser.add_argument("--port", help = "Port to listen on. Default: 8000", type = int,
+                        default = 8000)
+    parser.add_argument("--latency", help = "Seconds of latency per request. Default: 0",
+                        type = float, default = 0.0)
+    parser.add_argument("--responses", help = "Recorded VEP responses to replay.", type = str)
+    parser.add_argument("--error-rate", help = "Fraction of requests to fail with 503. Default: 0",
+                        type = float, default = 0.0)
+    args = parser.parse_args()
+    server = MockVepServer(latency = args.latency, responses = args.responses,
+                           error_rate = args.error_rate, port = args.port)
+    print(f"Serving a mock VEP API at {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+if __name__ == "__main__":
+    main()
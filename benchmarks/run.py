@@ -0,0 +1,248 @@
+"""
+This module runs the annotator benchmarks: it generates a synthetic VCF, starts a mock VEP server,
+and times each stage of the pipeline separately, then the whole pipeline end to end. Peak memory
+of each stage is measured with tracemalloc in a second, untimed, pass. The report is written as
+JSON with the commit it was run on, so reports from different commits can be compared.
+
+Usage:
+    python -m benchmarks.run [-n RECORDS] [--latency SECONDS] [-o REPORT] [--compare BASELINE]
+
+Stages:
+    read:       reading and splitting the VCF lines (vcf.iter_vcf)
+    parse:      parsing the lines into variants (vcf.iter_parse_vcf)
+    scan:       reading and parsing in one pass from a memory map (vcf.iter_scan_vcf), as
+                main.run_annotator does
+    annotate:   querying the mock VEP server (vep.get_chunked_annotations)
+    extract:    building the output lines from the annotations (extract.Extractor.extract)
+    write:      writing the output lines to a TSV (output.TsvWriter)
+    end_to_end: the whole pipeline (main.run_annotator)
+
+The annotate and end_to_end stages only run on the first --annotate-limit variants, since their
+runtime is dominated by the (mock) network.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import annotator.backends
+import annotator.extract
+import annotator.main
+import annotator.output
+import annotator.vcf
+import annotator.vep
+
+from benchmarks import mock_server, synthetic
+
+def git_commit() -> str:
+    "The short hash of the checked out commit, with a + if the tree has changes, or None"
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True,
+                                text = True, check = True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("+" if dirty else "")
+
+def measure(function, memory = True) -> dict:
+    """
+    Time a stage, then run it again under tracemalloc for its peak memory.
+
+    Args:
+        function (callable): runs the stage, and returns its result and the number of items done
+        memory (boolean):    whether to measure peak memory. Default: True
+
+    Returns:
+        A tuple of the stage result and a dictionary of its measurements.
+    """
+    start = time.perf_counter()
+    result, items = function()
+    seconds = time.perf_counter() - start
+    stats = {
+        "seconds": round(seconds, 4),
+        "items": items,
+        "items_per_second": round(items / seconds, 1) if seconds else None
+    }
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            stats["peak_memory_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+def run_benchmarks(records = 100000, multiallelic = 0.05, seed = 0, latency = 0.0,
+                   annotate_limit = 20000, chunk_size = 200, max_workers = 4, memory = True,
+                   vcf_path = None, responses = None) -> dict:
+    """
+    Run every benchmark stage, and return the report.
+
+    Args:
+        records (int):        the number of records in the synthetic VCF. Default: 100000
+        multiallelic (float): the fraction of multiallelic records. Default: 0.05
+        seed (int):           the random seed of the synthetic VCF. Default: 0
+        latency (float):      the latency of the mock server, in seconds per request. Default: 0
+        annotate_limit (int): the maximum number of variants to annotate. Default: 20000
+        chunk_size (int):     the number of variants per request. Default: 200
+        max_workers (int):    the number of requests in flight at once. Default: 4
+        memory (boolean):     whether to measure the peak memory of each stage. Default: True
+        vcf_path (str):       a VCF to benchmark instead of a synthetic one. Default: None
+        responses (str):      recorded VEP responses for the mock server to replay. Default: None
+
+    Returns:
+        The report, as a dictionary.
+    """
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "records": records, "multiallelic": multiallelic, "seed": seed, "latency": latency,
+            "annotate_limit": annotate_limit, "chunk_size": chunk_size,
+            "max_workers": max_workers, "vcf": vcf_path, "responses": responses
+        },
+        "stages": {}
+    }
+    stages = report["stages"]
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            mock_server.MockVepServer(latency = latency, responses = responses) as server:
+        if vcf_path is None:
+            vcf_path = synthetic.generate_vcf(os.path.join(tmpdir, "synthetic.vcf"), records,
+                                              multiallelic = multiallelic, seed = seed)
+        backend = annotator.backends.RestBackend(server.url, rate_limit = None)
+
+        def read():
+            lines = list(annotator.vcf.iter_vcf(vcf_path))
+            return lines, len(lines) - 1
+        lines, stages["read"] = measure(read, memory)
+
+        def parse():
+            variants = list(annotator.vcf.iter_parse_vcf(lines, "NR", "NV"))
+            return variants, len(variants)
+        variants, stages["parse"] = measure(parse, memory)
+        del lines
+
+        def scan():
+            scanned = list(annotator.vcf.iter_scan_vcf(vcf_path, "NR", "NV"))
+            return None, len(scanned)
+        _, stages["scan"] = measure(scan, memory)
+        variants = variants[:annotate_limit]
+
+        def annotate():
+            annotations = annotator.vep.get_chunked_annotations(
+                variants, chunk_size = chunk_size, max_workers = max_workers, backend = backend
+            )
+            return annotations, len(annotations)
+        annotations, stages["annotate"] = measure(annotate, memory)
+
+        def extract():
+            extract_lines = annotator.extract.DEFAULT_EXTRACTOR.extract
+            rows = [row for variant, annotation in zip(variants, annotations)
+                    for row in extract_lines(variant, annotation)]
+            return rows, len(rows)
+        rows, stages["extract"] = measure(extract, memory)
+
+        def write():
+            with annotator.output.TsvWriter(os.path.join(tmpdir, "out.tsv")) as writer:
+                writer.write_rows(rows)
+            return None, len(rows)
+        _, stages["write"] = measure(write, memory)
+        del rows, annotations
+
+        ## End to end, on a VCF of the annotated variants only
+        subset_path = os.path.join(tmpdir, "subset.vcf")
+        with open(subset_path, "w", encoding = "utf-8") as f:
+            f.write(synthetic.HEADER)
+            n_lines = 0
+            for record in annotator.vcf.iter_vcf(vcf_path):
+                if n_lines > len(variants):
+                    break
+                if n_lines:
+                    f.write("\t".join(record[:10]) + "\n")
+                n_lines += 1
+
+        def end_to_end():
+            n_rows = annotator.main.run_annotator(
+                subset_path, os.path.join(tmpdir, "end_to_end.tsv"), "NR", "NV",
+                chunk_size = chunk_size, max_workers = max_workers, backend = backend
+            )
+            return None, n_rows
+        _, stages["end_to_end"] = measure(end_to_end, memory)
+        report["server"] = {"requests": server.requests, "variants": server.variants}
+    return report
+
+def compare(report, baseline) -> str:
+    """
+    Format a comparison of two benchmark reports, stage by stage.
+
+    Args:
+        report (dict):   the current report
+        baseline (dict): the report to compare against
+
+    Returns:
+        A table of the seconds and peak memory of each stage in both reports, as a string.
+    """
+    out = [f"{'stage':<12}{'baseline s':>12}{'current s':>12}{'change':>10}"
+           f"{'baseline MB':>14}{'current MB':>12}",
+           f"{'commit':<12}{str(baseline.get('commit')):>12}{str(report.get('commit')):>12}"]
+    for stage, stats in report["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        change = (stats["seconds"] - base["seconds"]) / base["seconds"] if base["seconds"] else 0
+        out.append(
+            f"{stage:<12}{base['seconds']:>12.3f}{stats['seconds']:>12.3f}{change:>+10.1%}"
+            f"{str(base.get('peak_memory_mb', '-')):>14}{str(stats.get('peak_memory_mb', '-')):>12}"
+        )
+    return "\n".join(out)
+
+def main():
+    "Runs the benchmarks from the command line"
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks.run",
+                                     description = "Benchmarks the annotator pipeline.")
+    parser.add_argument("-n", "--records", help = "Records in the synthetic VCF. Default: 100000",
+                        type = int, default = 100000)
+    parser.add_argument("--multiallelic", help = "Fraction of multiallelic records. Default: 0.05",
+                        type = float, default = 0.05)
+    parser.add_argument("--seed", help = "Random seed. Default: 0", type = int, default = 0)
+    parser.add_argument("--vcf", help = "Benchmark this VCF (NR/NV fields) instead.", type = str)
+    parser.add_argument("--latency", help = "Mock server latency per request. Default: 0",
+                        type = float, default = 0.0)
+    parser.add_argument("--responses", help = "Recorded VEP responses to replay.", type = str)
+    parser.add_argument("--annotate-limit", help = "Variants to annotate. Default: 20000",
+                        type = int, default = 20000)
+    parser.add_argument("--chunk-size", help = "Variants per request. Default: 200", type = int,
+                        default = 200)
+    parser.add_argument("--max-workers", help = "Requests in flight. Default: 4", type = int,
+                        default = 4)
+    parser.add_argument("--no-memory", help = "Skip the peak memory measurements.",
+                        action = "store_true")
+    parser.add_argument("-o", "--output", help = "Path to write the JSON report to.", type = str)
+    parser.add_argument("--compare", help = "A previous JSON report to compare against.",
+                        type = str)
+    args = parser.parse_args()
+
+    report = run_benchmarks(records = args.records, multiallelic = args.multiallelic,
+                            seed = args.seed, latency = args.latency,
+                            annotate_limit = args.annotate_limit, chunk_size = args.chunk_size,
+                            max_workers = args.max_workers, memory = not args.no_memory,
+                            vcf_path = args.vcf, responses = args.responses)
+    text = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, "r", encoding = "utf-8") as f:
+            print(compare(report, json.load(f)), file = sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+This module generates synthetic VCFs for benchmarking. Records look like Platypus calls: a
+GT:GL:GOF:GQ:NR:NV genotype column, with NR (total reads) and NV (variant reads), and a fraction of
+multiallelic sites. The output is reproducible for a given seed.
+
+Usage:
+    python -m benchmarks.synthetic -n RECORDS -o OUTPUT [--multiallelic FRACTION] [--seed SEED]
+
+An OUTPUT ending in .gz is written BGZF compressed.
+"""
+import argparse
+import random
+
+import annotator.bgzf
+
+## Chromosomes to spread records over, weighted by (roughly) their length in Mb
+CHROMOSOMES = [
+    ("1", 248), ("2", 242), ("3", 198), ("4", 190), ("5", 181), ("6", 171), ("7", 159),
+    ("8", 145), ("9", 138), ("10", 134), ("11", 135), ("12", 133), ("13", 114), ("14", 107),
+    ("15", 102), ("16", 90), ("17", 83), ("18", 80), ("19", 59), ("20", 64), ("21", 47),
+    ("22", 51), ("X", 156)
+]
+BASES = "ACGT"
+FILTERS = ["PASS"] * 8 + ["alleleBias", "badReads"]
+
+HEADER = """##fileformat=VCFv4.0
+##source=Platypus_Version_0.8.1
+##INFO=<ID=TC,Number=1,Type=Integer,Description="Total coverage at this locus">
+##INFO=<ID=TR,Number=.,Type=Integer,Description="Total number of reads containing this variant">
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Unphased genotypes">
+##FORMAT=<ID=GL,Number=.,Type=Float,Description="Genotype log10-likelihoods">
+##FORMAT=<ID=GOF,Number=.,Type=Float,Description="Goodness of fit value">
+##FORMAT=<ID=GQ,Number=.,Type=Integer,Description="Genotype quality as phred score">
+##FORMAT=<ID=NR,Number=.,Type=Integer,Description="Number of reads covering variant location">
+##FORMAT=<ID=NV,Number=.,Type=Integer,Description="Number of reads containing variant">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample
+"""
+
+def _allele(rng, ref):
+    "Draw an alt allele: mostly SNVs, with some insertions and deletions"
+    kind = rng.random()
+    if kind < 0.85:
+        return rng.choice([base for base in BASES if base != ref[0]])
+    if kind < 0.93:
+        return ref[0] + "".join(rng.choice(BASES) for _ in range(rng.randint(1, 6)))
+    return ref[0]
+
+def iter_records(n_records, multiallelic = 0.05, seed = 0):
+    """
+    Lazily generate synthetic VCF records, sorted by chromosome and position.
+
+    Args:
+        n_records (int):      the number of records (lines) to generate
+        multiallelic (float): the fraction of records with two alt alleles. Default: 0.05
+        seed (int):           the random seed. Default: 0
+
+    Yields:
+        VCF data lines, without the trailing newline.
+    """
+    rng = random.Random(seed)
+    total_length = sum(length for _, length in CHROMOSOMES)
+    remaining = n_records
+    for i, (chrom, length) in enumerate(CHROMOSOMES):
+        if i == len(CHROMOSOMES) - 1:
+            n_chrom = remaining
+        else:
+            n_chrom = min(remaining, round(n_records * length / total_length))
+        remaining -= n_chrom
+        ## Evenly spaced positions with some jitter, so records stay sorted
+        step = max(1, length * 1_000_000 // max(n_chrom, 1))
+        pos = rng.randint(1, step)
+        for _ in range(n_chrom):
+            ref = rng.choice(BASES)
+            alts = [_allele(rng, ref)]
+            if rng.random() < multiallelic:
+                second = _allele(rng, ref)
+                while second == alts[0]:
+                    second = _allele(rng, ref)
+                alts.append(second)
+            ## A deletion needs a longer reference allele
+            if any(len(alt) < len(ref) or alt == ref for alt in alts):
+                ref += "".join(rng.choice(BASES) for _ in range(rng.randint(1, 6)))
+            total = rng.randint(10, 400)
+            variants = [rng.randint(1, total) for _ in alts]
+            genotype = "1/2" if len(alts) > 1 else rng.choice(["0/1", "1/1"])
+            qual = rng.randint(20, 2965)
+            yield (
+                f"{chrom}\t{pos}\t.\t{ref}\t{','.join(alts)}\t{qual}\t{rng.choice(FILTERS)}\t"
+                f"TC={total};TR={sum(variants)}\tGT:GL:GOF:GQ:NR:NV\t"
+                f"{genotype}:-1,-1,-1:3:99:"
+                f"{','.join([str(total)] * len(alts))}:{','.join(map(str, variants))}"
+            )
+            pos += rng.randint(max(1, step // 2), step + step // 2) + len(ref)
+
+def generate_vcf(path, n_records, multiallelic = 0.05, seed = 0) -> str:
+    """
+    Write a synthetic VCF. Paths ending in .gz are written BGZF compressed, as by bgzip.
+
+    Args:
+        path (str):           path to the output VCF
+        n_records (int):      the number of records (lines) to generate
+        multiallelic (float): the fraction of records with two alt alleles. Default: 0.05
+        seed (int):           the random seed. Default: 0
+
+    Returns:
+        The path to the VCF.
+    """
+    if path.endswith(".gz"):
+        with open(path, "wb") as f:
+            buffer = [HEADER]
+            size = len(HEADER)
+            for record in iter_records(n_records, multiallelic, seed):
+                buffer.append(record + "\n")
+                size += len(record) + 1
+                ## Compress roughly 1 MB at a time, keeping only the final EOF block
+                if size > 1 << 20:
+                    block = annotator.bgzf.compress("".join(buffer).encode("utf-8"))
+                    f.write(block[:-len(annotator.bgzf.BGZF_EOF)])
+                    buffer = []
+                    size = 0
+            f.write(annotator.bgzf.compress("".join(buffer).encode("utf-8")))
+    else:
+        with open(path, "w", encoding = "utf-8") as f:
+            f.write(HEADER)
+            f.writelines(record + "\n" for record in iter_records(n_records, multiallelic, seed))
+    return path
+
+def main():
+    "Generates a synthetic VCF from the command line"
+    parser = argparse.ArgumentParser(prog = "python -m benchmarks.synthetic",
+                                     description = "Generates a synthetic Platypus-style VCF.")
+    parser.add_argument("-n", "--records", help = "Number of records.", type = int,
+                        required = True)
+    parser.add_argument("-o", "--output", help = "Output path. .gz is BGZF compressed.",
+                        type = str, required = True)
+    parser.add_argument("--multiallelic", help = "Fraction of multiallelic records. Default: 0.05",
+                        type = float, default = 0.05)
+    parser.add_argument("--seed", help = "Random seed. Default: 0", type = int, default = 0)
+    args = parser.parse_args()
+    generate_vcf(args.output, args.records, multiallelic = args.multiallelic, seed = args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+""" This module implements testing for the backends module, without network access. """
+import json
+import os
+import tempfile
+import unittest
+
+import annotator.exceptions
+from annotator import backends, vep
+
+## Synthetic VEP responses, written in the format of the VEP REST API rather than captured from it
+RESPONSES_PATH = os.path.join(os.path.dirname(__file__), "data", "synthetic_vep_responses.jsonl")
+
+class test_replay_backend(unittest.TestCase):
+    """ Unit tests for the ReplayBackend class """
+    def test_replay_mixed_genic_intergenic_variants(self):
+        """
+        Test annotation of an intergenic and a genic variant from replayed responses
+        """
+        variant_list = [["9", "82929050", "A", "T", "PASS", 100, 150],
+                        ["9", "83004550", "T", "G", "PASS", 58, 92]]
+        expected_output = [
+            ['9', '82929050', 'A', 'T', 'PASS', 100, 150, '0.66667', 'SNV', 'NA', 'NA',
+             'NA', 'MODIFIER', 'intergenic_variant', 'NA', 'NA', 'NA', 'NA'],
+            ['9', '83004550', 'T', 'G', 'PASS', 58, 92, '0.63043', 'SNV', 'ENSG00000165105',
+             'RASEF', 'ENST00000376447', 'LOW', 'synonymous_variant', 
+             'ENSP00000365630.3:p.Arg384=', 'NA', 'NA', 'NA']]
+        backend = backends.ReplayBackend(RESPONSES_PATH)
+        annotations = vep.annotate_variants(variant_list, backend = backend)
+        self.assertEqual(annotations, expected_output)
+
+    def test_replay_missing_variant(self):
+        """
+        Test that a variant without a recorded response raises a RequestError
+        """
+        backend = backends.ReplayBackend(RESPONSES_PATH)
+        with self.assertRaises(annotator.exceptions.RequestError):
+            vep.get_variant_annotations([["1", "1", "A", "T", "PASS", 1, 2]], backend = backend)
+
+    def test_record_and_replay(self):
+        """
+        Test that recorded responses replay for the same query parameters only
+        """
+        variant_list = [["12", "25245351", "G", "T", "PASS", 100, 150]]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            record_path = os.path.join(tmpdir, "record.jsonl")
+            recorder = backends.get_backend(RESPONSES_PATH, record = record_path)
+            recorded = vep.get_variant_annotations(variant_list, backend = recorder)
+            with open(record_path, encoding = "utf-8") as f:
+                self.assertEqual(vep.prune_annotation(json.loads(f.readline())["response"]),
+                                 recorded[0])
+            replay = backends.get_backend(record_path)
+            self.assertEqual(vep.get_variant_annotations(variant_list, backend = replay), recorded)
+            with self.assertRaises(annotator.exceptions.RequestError):
+                vep.get_variant_annotations(variant_list, by_gene = True, backend = replay)
+
+    def test_incomplete_backend(self):
+        """
+        Test that a backend without annotate() can't be created, and that others start without
+        retry listeners
+        """
+        class incomplete_backend(backends.AnnotationBackend):
+            pass
+        with self.assertRaises(TypeError):
+            incomplete_backend()
+        self.assertEqual(backends.ReplayBackend(RESPONSES_PATH).retry_listeners, [])
+
+    def test_get_backend(self):
+        """
+        Test building backends from their command-line specifications
+        """
+        self.assertEqual(backends.get_backend("ensembl").base_url, backends.ENSEMBL_REST_URL)
+        self.assertEqual(backends.get_backend("http://localhost:3000/").base_url,
+                         "http://localhost:3000")
+        self.assertIsInstance(backends.get_backend(RESPONSES_PATH), backends.ReplayBackend)
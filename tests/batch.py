@@ -0,0 +1,89 @@
+""" This module implements testing for the batch module. """
+import os
+import tempfile
+import unittest
+
+from annotator import backends, batch
+
+class recording_backend(backends.AnnotationBackend):
+    """ A backend that annotates everything as intergenic and remembers what it was asked """
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    def annotate(self, vcf_lines, params):
+        self.queries.extend(backends.variant_query(line) for line in vcf_lines)
+        return [
+            {"input": backends.variant_query(line), "variant_class": "SNV",
+             "intergenic_consequences": [{"impact": "MODIFIER"}]}
+            for line in vcf_lines
+        ]
+
+class test_run_batch(unittest.TestCase):
+    """ Unit tests for the run_batch function """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        header = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"
+        self.paths = []
+        ## Two files sharing positions 105-109
+        for name, positions in (("a.vcf", range(100, 110)), ("b.vcf", range(105, 120))):
+            path = os.path.join(self.tmpdir.name, name)
+            with open(path, "w", encoding = "utf-8") as f:
+                f.write(header)
+                for pos in positions:
+                    f.write(f"1\t{pos}\t.\tA\tT\t50\tPASS\t.\tNR:NV\t10:5\n")
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_shared_variants_annotated_once(self):
+        """
+        Test that the union of variants is queried once, and that one output is written per input
+        """
+        backend = recording_backend()
+        output_dir = os.path.join(self.tmpdir.name, "out")
+        rows = batch.run_batch(self.paths, output_dir, "NR", "NV", chunk_size = 4,
+                               backend = backend)
+        self.assertEqual(len(backend.queries), 20)
+        self.assertEqual(len(set(backend.queries)), 20)
+        self.assertEqual(rows, {os.path.join(output_dir, "a.tsv"): 10,
+                                os.path.join(output_dir, "b.tsv"): 15})
+        with open(os.path.join(output_dir, "b.tsv"), encoding = "utf-8") as f:
+            self.assertEqual(len(f.readlines()), 16)
+
+    def test_zero_cache_max_age(self):
+        """
+        Test that a persistent cache with a max age of 0 is not used, and that the union of
+        variants is still only queried once
+        """
+        cache_path = os.path.join(self.tmpdir.name, "cache.sqlite")
+        output_dir = os.path.join(self.tmpdir.name, "out")
+        batch.run_batch(self.paths, output_dir, "NR", "NV", cache_path = cache_path,
+                        backend = recording_backend())
+        backend = recording_backend()
+        batch.run_batch(self.paths, output_dir, "NR", "NV", cache_path = cache_path,
+                        cache_max_age = 0, backend = backend)
+        self.assertEqual(len(backend.queries), 20)
+
+    def test_resolve_inputs(self):
+        """
+        Test resolving inputs from globs and manifests, and error handling of unmatched globs
+        """
+        manifest = os.path.join(self.tmpdir.name, "manifest.txt")
+        with open(manifest, "w", encoding = "utf-8") as f:
+            f.write(f"# inputs\n{self.paths[1]}\n\n{self.paths[0]}\n")
+        self.assertEqual(batch.resolve_inputs(manifest = manifest), self.paths[::-1])
+        self.assertEqual(
+            batch.resolve_inputs([os.path.join(self.tmpdir.name, "*.vcf")], manifest), self.paths
+        )
+        with self.assertRaises(ValueError):
+            batch.resolve_inputs([os.path.join(self.tmpdir.name, "*.bcf")])
+
+    def test_output_names(self):
+        """
+        Test naming outputs after inputs, and refusing colliding outputs
+        """
+        self.assertEqual(batch.output_path("/data/s1.vcf.gz", "out"), os.path.join("out", "s1.tsv"))
+        with self.assertRaises(ValueError):
+            batch.run_batch(["x/s1.vcf", "y/s1.vcf"], "out", "NR", "NV")
@@ -0,0 +1,82 @@
+""" This module implements testing for the benchmarks package. """
+import gzip
+import os
+import tempfile
+import unittest
+
+from annotator import backends, exceptions, vcf, vep
+from benchmarks import mock_server, run, synthetic
+
+class test_synthetic(unittest.TestCase):
+    """ Unit tests for the synthetic VCF generator """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_generate_vcf(self):
+        """
+        Test that synthetic VCFs parse, are sorted, reproducible, and readable compressed
+        """
+        path = synthetic.generate_vcf(os.path.join(self.tmpdir.name, "a.vcf"), 500,
+                                      multiallelic = 0.2)
+        variants = vcf.parse_vcf(vcf.read_vcf(path), "NR", "NV")
+        self.assertGreater(len(variants), 500)
+        self.assertTrue(all(0 < v.var_reads <= v.total_reads for v in variants))
+        compressed = synthetic.generate_vcf(os.path.join(self.tmpdir.name, "a.vcf.gz"), 500,
+                                            multiallelic = 0.2)
+        with open(path, "rb") as f, gzip.open(compressed, "rb") as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(vcf.read_vcf(compressed), vcf.read_vcf(path))
+        ## Positions increase within each chromosome
+        lines = vcf.read_vcf(path)[1:]
+        for previous, line in zip(lines, lines[1:]):
+            if previous[0] == line[0]:
+                self.assertLess(int(previous[1]), int(line[1]))
+
+class test_mock_server(unittest.TestCase):
+    """ Unit tests for the mock VEP server """
+    def test_rest_round_trip(self):
+        """
+        Test that a RestBackend gets one deterministic annotation per variant, through retries
+        """
+        variants = [vcf.Variant("1", 100 + i, "A", "T", "PASS", 5, 10) for i in range(25)]
+        with mock_server.MockVepServer(error_rate = 0.3) as server:
+            backend = backends.RestBackend(server.url, rate_limit = None, max_retries = 10)
+            annotations = vep.get_chunked_annotations(variants, chunk_size = 10,
+                                                      backend = backend)
+        self.assertEqual([a["input"] for a in annotations],
+                         [backends.variant_query(v) for v in variants])
+        expected = mock_server.synthesize_annotation(backends.variant_query(variants[0]))
+        self.assertEqual(annotations[0], vep.prune_annotation(expected))
+        self.assertEqual(server.variants, 25)
+        self.assertGreaterEqual(server.requests, 3)
+
+    def test_rejected_variant(self):
+        """
+        Test that a malformed allele gets the whole request rejected with a BadRequestError
+        """
+        variants = [vcf.Variant("1", 100, "A", "T", "PASS", 5, 10),
+                    vcf.Variant("1", 200, "A", "<DEL>", "PASS", 5, 10)]
+        with mock_server.MockVepServer() as server:
+            backend = backends.RestBackend(server.url, rate_limit = None)
+            with self.assertRaises(exceptions.BadRequestError):
+                backend.annotate(variants, {})
+            with self.assertLogs("annotator.vep", level = "WARNING"):
+                annotations = vep.get_chunked_annotations(variants, backend = backend)
+        self.assertNotIn("error", annotations[0])
+        self.assertIn("Could not parse variant", annotations[1]["error"])
+
+class test_run(unittest.TestCase):
+    """ Unit tests for the benchmark runner """
+    def test_run_benchmarks(self):
+        """
+        Test that every stage is reported, and that reports can be compared
+        """
+        report = run.run_benchmarks(records = 200, annotate_limit = 50, memory = False)
+        self.assertEqual(list(report["stages"]),
+                         ["read", "parse", "scan", "annotate", "extract", "write", "end_to_end"])
+        self.assertEqual(report["stages"]["read"]["items"], 200)
+        self.assertEqual(report["stages"]["annotate"]["items"], 50)
+        self.assertIn("end_to_end", run.compare(report, report))
@@ -0,0 +1,88 @@
+""" This module implements testing for the cache module. """
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from annotator import cache, vep
+
+class test_annotation_cache(unittest.TestCase):
+    """ Unit tests for the AnnotationCache class """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.sqlite")
+        self.params = vep.vep_parameters(False)
+        self.lines = [["1", "100", "A", "T", "PASS", 1, 2],
+                      ["1", "200", "C", "G", "PASS", 3, 4]]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hits_and_misses(self):
+        """
+        Test that stored annotations are returned and counted as hits, and unknown ones as misses
+        """
+        with cache.AnnotationCache(self.path) as c:
+            self.assertEqual(c.get_many(self.lines, self.params), [None, None])
+            c.put_many(self.lines[:1], [{"input": "1 100 . A T . . ."}], self.params)
+            self.assertEqual(c.get_many(self.lines, self.params),
+                             [{"input": "1 100 . A T . . ."}, None])
+            self.assertEqual((c.hits, c.misses), (1, 3))
+
+    def test_persistence_and_parameters(self):
+        """
+        Test that entries persist across instances and are keyed on the VEP parameters
+        """
+        with cache.AnnotationCache(self.path) as c:
+            c.put_many(self.lines, [{"a": 1}, {"b": 2}], self.params)
+        with cache.AnnotationCache(self.path) as c:
+            self.assertEqual(c.get_many(self.lines, self.params), [{"a": 1}, {"b": 2}])
+            self.assertEqual(c.get_many(self.lines, vep.vep_parameters(True)), [None, None])
+
+    def test_size_eviction(self):
+        """
+        Test that the least recently used entries are evicted beyond max_entries
+        """
+        with cache.AnnotationCache(self.path, max_entries = 1) as c:
+            c.put_many(self.lines, [{"a": 1}, {"b": 2}], self.params)
+            self.assertEqual(len(c), 1)
+            self.assertEqual(c.evictions, 1)
+
+    def test_age_eviction(self):
+        """
+        Test that entries older than max_age are treated as misses
+        """
+        with cache.AnnotationCache(self.path, max_age = 10) as c:
+            c.put_many(self.lines, [{"a": 1}, {"b": 2}], self.params)
+            with patch("annotator.cache.time.time", return_value = time.time() + 60):
+                self.assertEqual(c.get_many(self.lines, self.params), [None, None])
+                self.assertEqual(c.evict(), 2)
+
+    def test_zero_max_age(self):
+        """
+        Test that a max_age of 0 expires every entry, and that a negative one is refused
+        """
+        with cache.AnnotationCache(self.path) as c:
+            c.put_many(self.lines, [{"a": 1}, {"b": 2}], self.params)
+        with cache.AnnotationCache(self.path, max_age = 0) as c:
+            self.assertEqual(c.get_many(self.lines, self.params), [None, None])
+        with self.assertRaises(ValueError):
+            cache.AnnotationCache(self.path, max_age = -1)
+
+    def test_annotate_variants_only_queries_misses(self):
+        """
+        Test that annotate_variants only sends cache misses to the API
+        """
+        annotation = {"variant_class": "SNV", "intergenic_consequences": [{"impact": "MODIFIER"}]}
+        ## Annotations are cached under the query parameters and the fields pruning kept
+        params = vep.storage_parameters(self.params)
+        with cache.AnnotationCache(self.path) as c:
+            c.put_many(self.lines[:1], [annotation], params)
+            with patch("annotator.vep.get_chunked_annotations",
+                       return_value = [annotation]) as fetch:
+                out = vep.annotate_variants(self.lines, cache = c)
+            fetch.assert_called_once()
+            self.assertEqual(fetch.call_args[0][0], self.lines[1:])
+            self.assertEqual(len(out), 2)
+            self.assertEqual(c.get_many(self.lines, params), [annotation, annotation])
@@ -0,0 +1,80 @@
+""" This module implements testing for the chunking module. """
+import json
+import unittest
+from unittest.mock import patch
+
+from annotator import backends, chunking, vcf, vep
+
+class fake_response:
+    """ A minimal stand-in for requests.Response """
+    def __init__(self, status_code, content = b"[]"):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = content
+        self.text = content.decode("utf-8")
+
+class flaky_session:
+    """ A session that fails the first request with a 503, and answers every other one """
+    def __init__(self):
+        self.sizes = []
+
+    def post(self, url, data = None, **kwargs):
+        """ Record the number of variants posted, and answer them """
+        queries = json.loads(data)["variants"]
+        self.sizes.append(len(queries))
+        if len(self.sizes) == 1:
+            return fake_response(503)
+        return fake_response(200, json.dumps([{"input": q} for q in queries]).encode("utf-8"))
+
+class test_adaptive_chunk_size(unittest.TestCase):
+    """ Unit tests for the AdaptiveChunkSize class """
+    def test_shrink_and_grow(self):
+        """
+        Test shrinking on slow or large responses and on failures, and growing back on fast ones
+        """
+        sizer = chunking.AdaptiveChunkSize(200, target_latency = 10, max_response_bytes = 1000)
+        self.assertEqual(sizer.size, 200)
+        ## Twice as slow as the target: half the size
+        sizer.success(200, 20)
+        self.assertEqual(sizer.size, 100)
+        ## Four times too large a response: a quarter of the size
+        sizer.success(100, 1, response_bytes = 4000)
+        self.assertEqual(sizer.size, 25)
+        sizer.failure()
+        self.assertEqual(sizer.size, 12)
+        ## Short (tail) chunks don't grow the size, full ones do, up to the maximum
+        sizer.success(5, 1)
+        self.assertEqual(sizer.size, 12)
+        for _ in range(20):
+            sizer.success(sizer.size, 1)
+        self.assertEqual(sizer.size, 200)
+
+    def test_bounds(self):
+        """
+        Test that the size stays within its bounds, and that bad maximums are rejected
+        """
+        sizer = chunking.AdaptiveChunkSize(4, minimum = 2)
+        for _ in range(5):
+            sizer.failure()
+        self.assertEqual(sizer.size, 2)
+        with self.assertRaises(ValueError):
+            chunking.AdaptiveChunkSize(0)
+        with self.assertRaises(ValueError):
+            chunking.AdaptiveChunkSize(2.5)
+
+class test_chunk_size_on_retries(unittest.TestCase):
+    """ Unit tests for adapting the chunk size to retried requests """
+    def test_retry_shrinks_next_chunk(self):
+        """
+        Test that a 503 that succeeds on retry halves the size of the chunks sent after it
+        """
+        backend = backends.RestBackend("http://test")
+        backend.session = flaky_session()
+        lines = [vcf.Variant("1", pos, "A", "T", "PASS", 5, 10) for pos in range(1, 17)]
+        with patch("annotator.transport.time.sleep"):
+            annotations = vep.get_chunked_annotations(lines, chunk_size = 8, backend = backend)
+        self.assertFalse(any("error" in annotation for annotation in annotations))
+        ## The failed chunk is retried at its size. The size is then halved to 4, and grows back by
+        ## one step for the fast retry, so the next chunk has 5 variants
+        self.assertEqual(backend.session.sizes, [8, 8, 5, 3])
+        self.assertEqual(backend.retry_listeners, [])
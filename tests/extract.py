@@ -0,0 +1,85 @@
+""" This module implements testing for the extract module. """
+import unittest
+
+from annotator import extract, vep
+
+ANNOTATION = {
+    "input": "12 25245351 . G T . . .",
+    "variant_class": "SNV",
+    "most_severe_consequence": "missense_variant",
+    "transcript_consequences": [
+        {"gene_id": "ENSG00000133703", "gene_symbol": "KRAS", "transcript_id": "ENST00000256078",
+         "impact": "MODERATE", "consequence_terms": ["missense_variant"],
+         "hgvsp": "ENSP00000256078.5:p.Gly12Cys", "sift_prediction": "deleterious",
+         "canonical": 1},
+        {"gene_id": "ENSG00000133703", "gene_symbol": "KRAS", "transcript_id": "ENST00000311936",
+         "impact": "MODIFIER", "consequence_terms": ["intron_variant", "NMD_transcript_variant"]}
+    ],
+    "colocated_variants": [
+        {"id": "COSV55497369", "allele_string": "COSMIC_MUTATION"},
+        {"id": "rs121913530", "allele_string": "C/A/G/T", "clin_sig": ["pathogenic"],
+         "frequencies": {"T": {"gnomade": 0.0001}}}
+    ]
+}
+VARIANT = ["12", 25245351, "G", "T", "PASS", 100, 150]
+
+class test_extractor(unittest.TestCase):
+    """ Unit tests for the Extractor class """
+    def test_default_fields(self):
+        """
+        Test that the default fields match the output columns, in order
+        """
+        lines = extract.DEFAULT_EXTRACTOR.extract(VARIANT, ANNOTATION)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0], [
+            "12", 25245351, "G", "T", "PASS", 100, 150, "0.66667", "SNV", "ENSG00000133703",
+            "KRAS", "ENST00000256078", "MODERATE", "missense_variant",
+            "ENSP00000256078.5:p.Gly12Cys", "rs121913530", "COSV55497369", "0.0001"
+        ])
+        self.assertEqual(lines[1][13:15], ["intron_variant;NMD_transcript_variant", "NA"])
+        self.assertEqual(len(lines[0]), len(extract.DEFAULT_EXTRACTOR.columns))
+
+    def test_custom_fields(self):
+        """
+        Test adding and dropping columns, including SCOPE:KEY fields
+        """
+        extractor = extract.Extractor(
+            extract.parse_fields("GENE_SYMBOL,SIFT,CANONICAL,colocated:clin_sig,"
+                                 "annotation:most_severe_consequence=MSC")
+        )
+        self.assertEqual(extractor.columns[8:],
+                         ["GENE_SYMBOL", "SIFT", "CANONICAL", "CLIN_SIG", "MSC"])
+        self.assertEqual(extractor.params, {"canonical": "1"})
+        lines = extractor.extract(VARIANT, ANNOTATION)
+        self.assertEqual(lines[0][8:],
+                         ["KRAS", "deleterious", 1, "pathogenic", "missense_variant"])
+        self.assertEqual(lines[1][8:], ["KRAS", "NA", "NA", "pathogenic", "missense_variant"])
+
+    def test_no_consequences(self):
+        """
+        Test that a variant without consequences gets a single line of NA consequence fields
+        """
+        lines = extract.DEFAULT_EXTRACTOR.extract(VARIANT, {"variant_class": "SNV"})
+        self.assertEqual(lines, [VARIANT + ["0.66667", "SNV"] + ["NA"] * 9])
+
+    def test_parse_fields(self):
+        """
+        Test expanding "default", and rejecting unknown or duplicate fields
+        """
+        fields = extract.parse_fields("default,POLYPHEN")
+        self.assertEqual([field.name for field in fields],
+                         extract.DEFAULT_FIELDS + ["POLYPHEN"])
+        for specs in ("NOT_A_FIELD", "nowhere:key", "GENE_ID,GENE_ID", "feature:pos=POS"):
+            with self.assertRaises(ValueError):
+                extract.parse_fields(specs)
+
+    def test_prune_fields(self):
+        """
+        Test that pruning to an extractor's fields keeps everything it reads
+        """
+        extractor = extract.Extractor(["SIFT", "DBSNP_ID"])
+        pruned = vep.prune_annotation(ANNOTATION, extractor.prune_fields)
+        self.assertNotIn("variant_class", pruned)
+        self.assertEqual(pruned["transcript_consequences"][0], {"sift_prediction": "deleterious"})
+        self.assertEqual(extractor.extract(VARIANT, pruned),
+                         extractor.extract(VARIANT, ANNOTATION))
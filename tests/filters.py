@@ -0,0 +1,119 @@
+""" This module implements testing for the filters module. """
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from annotator import filters, main, vcf
+
+HEADER = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n"
+
+def variant(filter_value = "PASS", var_reads = 5, total_reads = 10, ref = "A", alt = "T"):
+    "Build a Variant with the given fields"
+    return vcf.Variant("1", 100, ref, alt, filter_value, var_reads, total_reads)
+
+class test_filters(unittest.TestCase):
+    """ Unit tests for the filters module """
+    def test_variant_type(self):
+        """
+        Test variant classification from alleles
+        """
+        self.assertEqual(filters.variant_type("A", "T"), "SNV")
+        self.assertEqual(filters.variant_type("AC", "GT"), "substitution")
+        self.assertEqual(filters.variant_type("A", "ACG"), "insertion")
+        self.assertEqual(filters.variant_type("ACG", "A"), "deletion")
+        self.assertEqual(filters.variant_type("AC", "T"), "indel")
+        self.assertEqual(filters.variant_type("A", "<DEL>"), "sequence_alteration")
+
+    def test_parse_filter_values(self):
+        """
+        Test parsing FILTER expressions into values to keep and drop
+        """
+        self.assertEqual(filters.parse_filter_values("PASS"), ({"PASS"}, set()))
+        self.assertEqual(filters.parse_filter_values("!badReads, !alleleBias"),
+                         (None, {"badReads", "alleleBias"}))
+        self.assertEqual(filters.parse_filter_values("PASS,Q20,!sb"), ({"PASS", "Q20"}, {"sb"}))
+        with self.assertRaises(ValueError):
+            filters.parse_filter_values(" , !")
+
+    def test_criteria(self):
+        """
+        Test each criterion, and counting the reasons variants are dropped for
+        """
+        variant_filter = filters.VariantFilter(filter_values = "!badReads", min_total_reads = 8,
+                                               min_variant_reads = 2, min_vaf = 0.1,
+                                               max_vaf = 0.9, variant_types = ["SNV"])
+        self.assertTrue(variant_filter)
+        variants = [
+            variant(),
+            variant(filter_value = "badReads;Q20"),
+            variant(total_reads = 4, var_reads = 2),
+            variant(var_reads = 1, total_reads = 20),
+            variant(var_reads = 10, total_reads = 10),
+            variant(ref = "A", alt = "AT"),
+            variant(filter_value = "Q20")
+        ]
+        self.assertEqual(list(variant_filter.apply(variants)), [variants[0], variants[6]])
+        self.assertEqual(variant_filter.kept, 2)
+        self.assertEqual(variant_filter.dropped, {"FILTER": 1, "TOTAL_READS": 1,
+                                                  "N_VARIANT_READS": 1,
+                                                  "VARIANT_READ_FRACTION": 1, "VARIANT_TYPE": 1})
+        with self.assertLogs("annotator.filters", level = "INFO"):
+            variant_filter.log_summary()
+        self.assertEqual(variant_filter.kept, 0)
+
+        ## Records holding variants are filtered on the variant
+        keep_pass = filters.VariantFilter(filter_values = "PASS")
+        records = [("s1", variants[0]), ("s2", variants[6])]
+        self.assertEqual(list(keep_pass.apply(records, record = 1)), records[:1])
+
+    def test_invalid(self):
+        """
+        Test that an empty filter keeps everything, and invalid filters are rejected
+        """
+        self.assertFalse(filters.VariantFilter())
+        with self.assertRaises(ValueError):
+            filters.VariantFilter(variant_types = ["SNP"])
+        with self.assertRaises(ValueError):
+            filters.VariantFilter(min_vaf = 0.5, max_vaf = 0.2)
+
+class test_run_annotator_filter(unittest.TestCase):
+    """ Unit tests for filtering in run_annotator() """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.vcf_path = os.path.join(self.tmpdir.name, "in.vcf")
+        with open(self.vcf_path, "w", encoding = "utf-8") as f:
+            f.write("##fileformat=VCFv4.2\n" + HEADER)
+            f.write("1\t10\t.\tA\tT\t50\tPASS\t.\tNR:NV\t10:5\t10:1\n")
+            f.write("1\t20\t.\tA\tG\t50\tbadReads\t.\tNR:NV\t10:5\t10:5\n")
+            f.write("1\t30\t.\tA\tC\t50\tPASS\t.\tNR:NV\t2:1\t2:1\n")
+        self.annotation = {"variant_class": "SNV",
+                           "intergenic_consequences": [{"impact": "MODIFIER"}]}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_filtered_variants_not_queried(self):
+        """
+        Test that variants dropped by the filter are neither sent to VEP nor written
+        """
+        output = os.path.join(self.tmpdir.name, "out.tsv")
+        sent = []
+        def annotate(lines, **kwargs):
+            sent.extend(lines)
+            return [self.annotation] * len(lines)
+        with patch("annotator.vep.get_chunked_annotations", side_effect = annotate):
+            rows = main.run_annotator(self.vcf_path, output, "NR", "NV",
+                                      variant_filter = filters.VariantFilter(
+                                          filter_values = "PASS", min_total_reads = 5))
+            self.assertEqual(rows, 1)
+            self.assertEqual([line.pos for line in sent], [10])
+
+            ## In multi-sample mode, each sample's reads are checked
+            sent.clear()
+            main.run_annotator(self.vcf_path, output, "NR", "NV", samples = "all",
+                               variant_filter = filters.VariantFilter(min_variant_reads = 5))
+            with open(output, encoding = "utf-8") as f:
+                written = [l.split("\t")[:3] for l in f][1:]
+            self.assertEqual(written, [["s1", "1", "10"], ["s1", "1", "20"], ["s2", "1", "20"]])
+            self.assertEqual([line.pos for line in sent], [10, 20])
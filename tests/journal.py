@@ -0,0 +1,84 @@
+""" This module implements testing for the journal module and resuming runs. """
+import os
+import tempfile
+import unittest
+
+import annotator.exceptions
+from annotator import backends, journal, main, vep
+
+class counting_backend(backends.AnnotationBackend):
+    """ A backend that annotates everything as intergenic, and fails after a number of chunks """
+    def __init__(self, fail_after = None):
+        super().__init__()
+        self.fail_after = fail_after
+        self.chunks = 0
+
+    def annotate(self, vcf_lines, params):
+        if self.fail_after is not None and self.chunks >= self.fail_after:
+            raise annotator.exceptions.RequestError("Simulated failure")
+        self.chunks += 1
+        return [
+            {"input": backends.variant_query(line), "variant_class": "SNV",
+             "intergenic_consequences": [{"impact": "MODIFIER"}]}
+            for line in vcf_lines
+        ]
+
+class test_journal(unittest.TestCase):
+    """ Unit tests for the Journal class """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "out.tsv.journal")
+        self.params = vep.vep_parameters(False)
+        self.lines = [["1", str(pos), "A", "T", "PASS", 1, 2] for pos in range(5)]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resume_skips_completed_chunks(self):
+        """
+        Test that chunks recorded in a journal are skipped when it is resumed
+        """
+        responses = counting_backend().annotate(self.lines[:3], self.params)
+        with journal.Journal(self.path) as j:
+            j.record(self.lines[:3], self.params, responses)
+        with journal.Journal(self.path, resume = True) as j:
+            self.assertEqual(j.lookup(self.lines[:3], self.params), responses)
+            self.assertEqual(j.lookup(self.lines[1:3], self.params), responses[1:3])
+            self.assertIsNone(j.lookup(self.lines[2:], self.params))
+            self.assertIsNone(j.lookup(self.lines[:3], vep.vep_parameters(True)))
+
+    def test_truncated_journal(self):
+        """
+        Test that a half-written last line is ignored on resume, and that not resuming discards the
+        journal
+        """
+        with open(self.path, "w", encoding = "utf-8") as f:
+            f.write('{"params": {}, "queries": ["1 0 . A T . . ."], "resp')
+        with journal.Journal(self.path, resume = True) as j:
+            self.assertEqual(len(j), 0)
+        with journal.Journal(self.path) as j:
+            pass
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+class test_resume_run(unittest.TestCase):
+    """ Unit tests for checkpointing and resuming run_annotator """
+    def test_resume_after_failure(self):
+        """
+        Test that a run failing part way can be resumed without re-querying completed chunks, and
+        that the journal is removed once the run completes
+        """
+        vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, "variants.tsv")
+            with self.assertRaises(annotator.exceptions.RequestError):
+                main.run_annotator(vcf_path, output_path, "NR", "NV", chunk_size = 5,
+                                   backend = counting_backend(fail_after = 2), checkpoint = True)
+            self.assertTrue(os.path.exists(output_path + ".journal"))
+
+            backend = counting_backend()
+            n_rows = main.run_annotator(vcf_path, output_path, "NR", "NV", chunk_size = 5,
+                                        backend = backend, resume = True)
+            self.assertEqual(n_rows, 18)
+            ## 18 variants in chunks of 5: two were journaled, two remain
+            self.assertEqual(backend.chunks, 2)
+            self.assertFalse(os.path.exists(output_path + ".journal"))
@@ -0,0 +1,35 @@
+""" This module implements testing for the jsonutil module. """
+import unittest
+from unittest.mock import patch
+
+from annotator import jsonutil
+
+class test_jsonutil(unittest.TestCase):
+    """ Unit tests for JSON encoding and decoding, with and without orjson """
+    document = {"variants": ["9 82929050 . A T . . .", "3 64527465 . C Ä . . ."],
+                "frequencies": {"T": {"af": 0.25}}, "strand": -1, "hgvsp": None}
+
+    def test_round_trip(self):
+        """
+        Test that encoding then decoding gives back the same object
+        """
+        self.assertEqual(jsonutil.loads(jsonutil.dumps(self.document)), self.document)
+        self.assertEqual(jsonutil.loads(jsonutil.dumps_bytes(self.document)), self.document)
+
+    def test_stdlib_fallback(self):
+        """
+        Test that the standard library path gives the same results when orjson is missing
+        """
+        encoded = jsonutil.dumps_bytes(self.document)
+        with patch("annotator.jsonutil.orjson", None):
+            self.assertEqual(jsonutil.dumps_bytes(self.document), encoded)
+            self.assertEqual(jsonutil.loads(encoded), self.document)
+            with self.assertRaises(jsonutil.JSONDecodeError):
+                jsonutil.loads('{"input": ')
+
+    def test_decode_error(self):
+        """
+        Test that malformed JSON raises JSONDecodeError
+        """
+        with self.assertRaises(jsonutil.JSONDecodeError):
+            jsonutil.loads('{"input": ')
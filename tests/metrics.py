@@ -0,0 +1,108 @@
+""" This module implements testing for the metrics module. """
+import json
+import os
+import tempfile
+import unittest
+
+from annotator import backends, filters, main, metrics
+
+class intergenic_backend(backends.AnnotationBackend):
+    """ A backend that annotates everything as intergenic """
+    def annotate(self, vcf_lines, params):
+        return [
+            {"input": backends.variant_query(line), "variant_class": "SNV",
+             "intergenic_consequences": [{"impact": "MODIFIER"}]}
+            for line in vcf_lines
+        ]
+
+    @property
+    def last_response_bytes(self):
+        return 100
+
+class test_histogram(unittest.TestCase):
+    """ Unit tests for the Histogram class """
+    def test_observe(self):
+        """
+        Test bucketing, summary statistics and quantile estimates
+        """
+        histogram = metrics.Histogram((1, 10))
+        for value in (0.5, 2, 3, 50):
+            histogram.observe(value)
+        report = histogram.report()
+        self.assertEqual([bucket["count"] for bucket in report["buckets"]], [1, 2, 1])
+        self.assertEqual((report["count"], report["min"], report["max"]), (4, 0.5, 50))
+        self.assertEqual(report["p50"], 10)
+        self.assertEqual(report["p95"], 50)
+        self.assertIsNone(metrics.Histogram((1,)).report()["p50"])
+
+class test_progress(unittest.TestCase):
+    """ Unit tests for the Progress class """
+    def test_eta(self):
+        """
+        Test that progress is logged with an ETA once the interval has passed, and not before
+        """
+        progress = metrics.Progress(total = 100, interval = 0)
+        with self.assertLogs("annotator.metrics", level = "INFO") as logs:
+            progress.update(50)
+        self.assertIn("50/100 variants annotated (50.0%)", logs.output[0])
+        self.assertIn("ETA", logs.output[0])
+        progress = metrics.Progress(total = 100, interval = 3600)
+        with self.assertNoLogs("annotator.metrics", level = "INFO"):
+            progress.update(50)
+
+class test_metrics(unittest.TestCase):
+    """ Unit tests for instrumenting run_annotator() """
+    def test_run_annotator(self):
+        """
+        Test that every stage and request is recorded, and that hooks see every event
+        """
+        events = []
+        collected = metrics.Metrics(hooks = [lambda event, data: events.append(event)])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            rows = main.run_annotator("data/test_vcf_data.txt", os.path.join(tmpdir, "out.tsv"),
+                                      "NR", "NV", chunk_size = 50, backend = intergenic_backend(),
+                                      metrics = collected)
+            collected.write(os.path.join(tmpdir, "metrics.json"))
+            with open(os.path.join(tmpdir, "metrics.json"), encoding = "utf-8") as f:
+                report = json.load(f)
+        self.assertEqual(set(report["stages"]), {"parse", "annotate", "merge", "write"})
+        self.assertEqual(report["counters"]["rows"], rows)
+        requests = report["requests"]
+        self.assertEqual(requests["chunk_size"]["sum"], report["counters"]["variants"])
+        self.assertEqual(requests["response_bytes"]["sum"], 100 * requests["count"])
+        self.assertEqual(requests["errors"], 0)
+        self.assertEqual(events.count("request"), requests["count"])
+        self.assertIn("stage", events)
+
+    def test_progress_total(self):
+        """
+        Test that a run counts its progress against the number of variants it annotates, whether
+        they are sent to VEP or found in the cache
+        """
+        vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for _ in range(2):
+                collected = metrics.Metrics()
+                variant_filter = filters.VariantFilter(filter_values = "PASS")
+                main.run_annotator(vcf_path, os.path.join(tmpdir, "out.tsv"), "NR", "NV",
+                                   chunk_size = 4, backend = intergenic_backend(),
+                                   cache_path = os.path.join(tmpdir, "cache.sqlite"),
+                                   metrics = collected, variant_filter = variant_filter)
+                self.assertEqual(collected.progress.total, 16)
+                self.assertEqual(collected.progress.done, 16)
+                self.assertEqual(collected.counters["variants"], 16)
+                self.assertEqual(collected.counters["filtered_variants"], 2)
+
+    def test_request_errors(self):
+        """
+        Test that failed requests are counted, and the error passed through
+        """
+        class failing_backend(backends.AnnotationBackend):
+            def annotate(self, vcf_lines, params):
+                raise ValueError("failed")
+        collected = metrics.Metrics()
+        backend = collected.instrument(failing_backend())
+        self.assertIs(collected.instrument(backend), backend)
+        with self.assertRaises(ValueError):
+            backend.annotate([["1", 1, "A", "T"]], {})
+        self.assertEqual(collected.report()["requests"]["errors"], 1)
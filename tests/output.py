@@ -0,0 +1,88 @@
+""" This module implements testing for the output module. """
+import gzip
+import os
+import tempfile
+import unittest
+
+from annotator import output
+
+ROWS = [
+    ["9", 82929050, "A", "T", "PASS", 100, 150, "0.66667", "SNV", "NA", "NA", "NA", "MODIFIER",
+     "intergenic_variant", "NA", "NA", "NA", "NA"],
+    ["9", 83004550, "T", "G", "PASS", 58, 92, "0.63043", "SNV", "ENSG00000165105", "RASEF",
+     "ENST00000376447", "LOW", "synonymous_variant", "ENSP00000365630.3:p.Arg384=",
+     "rs1", "NA", "0.25"]
+]
+
+class test_writers(unittest.TestCase):
+    """ Unit tests for the output writers """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, output_format = None):
+        "Write ROWS in two batches with the writer for a file name, and return its path"
+        path = os.path.join(self.tmpdir.name, name)
+        with output.open_writer(path, output_format = output_format) as writer:
+            writer.write_rows(ROWS[:1])
+            writer.write_rows(ROWS[1:])
+        self.assertEqual(writer.rows_written, 2)
+        return path
+
+    def expected_tsv(self):
+        "The expected TSV output of ROWS"
+        return "".join("\t".join(map(str, line)) + "\n" for line in [output.COLUMNS] + ROWS)
+
+    def test_detect_format(self):
+        """
+        Test detecting output formats from file extensions
+        """
+        self.assertEqual(output.detect_format("out.tsv"), "tsv")
+        self.assertEqual(output.detect_format("out.txt"), "tsv")
+        self.assertEqual(output.detect_format("out.tsv.gz"), "tsv.gz")
+        self.assertEqual(output.detect_format("out.tsv.zst"), "tsv.zst")
+        self.assertEqual(output.detect_format("out.parquet"), "parquet")
+        self.assertEqual(output.detect_format("OUT.ARROW"), "arrow")
+        with self.assertRaises(ValueError):
+            output.open_writer(os.path.join(self.tmpdir.name, "out"), output_format = "csv")
+
+    def test_gzip_tsv(self):
+        """
+        Test that gzip output decompresses to the same text as plain output
+        """
+        with open(self.write("out.tsv"), encoding = "utf-8") as f:
+            self.assertEqual(f.read(), self.expected_tsv())
+        with gzip.open(self.write("out.tsv.gz"), "rt", encoding = "utf-8") as f:
+            self.assertEqual(f.read(), self.expected_tsv())
+        ## The format argument overrides the extension
+        with gzip.open(self.write("out.tsv", output_format = "tsv.gz"), "rt") as f:
+            self.assertEqual(f.read(), self.expected_tsv())
+
+    @unittest.skipIf(output.zstandard is None, "zstandard is not installed")
+    def test_zstd_tsv(self):
+        """
+        Test that zstd output decompresses to the same text as plain output
+        """
+        with open(self.write("out.tsv.zst"), "rb") as f:
+            text = output.zstandard.ZstdDecompressor().stream_reader(f).read().decode("utf-8")
+        self.assertEqual(text, self.expected_tsv())
+
+    @unittest.skipIf(output.pyarrow is None, "pyarrow is not installed")
+    def test_columnar(self):
+        """
+        Test that Parquet and Arrow output have typed columns, with nulls for NA values
+        """
+        tables = [
+            output.pyarrow.parquet.read_table(self.write("out.parquet")),
+            output.pyarrow.ipc.open_file(self.write("out.arrow")).read_all()
+        ]
+        for table in tables:
+            self.assertEqual(table.column_names, output.COLUMNS)
+            self.assertEqual(table.column("POS").to_pylist(), [82929050, 83004550])
+            self.assertEqual(table.column("VARIANT_READ_FRACTION").to_pylist(), [0.66667, 0.63043])
+            self.assertEqual(table.column("POP_AF").to_pylist(), [None, 0.25])
+            self.assertEqual(table.column("GENE_SYMBOL").to_pylist(), [None, "RASEF"])
+            self.assertEqual(table.column("IMPACT").to_pylist(), ["MODIFIER", "LOW"])
+            self.assertTrue(output.pyarrow.types.is_dictionary(table.schema.field("IMPACT").type))
@@ -0,0 +1,124 @@
+""" This module implements testing for the service module. """
+import concurrent.futures
+import os
+import tempfile
+import threading
+import unittest
+
+import requests
+
+import annotator.exceptions
+from annotator import backends, main, service, vcf, vep
+
+HEADER = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"
+
+class batch_backend(backends.AnnotationBackend):
+    """ A backend that records the size of every batch, and rejects batches with a bad allele """
+    def __init__(self, fail = False):
+        super().__init__()
+        self.batches = []
+        self.fail = fail
+        self._lock = threading.Lock()
+
+    def annotate(self, vcf_lines, params):
+        with self._lock:
+            self.batches.append(len(vcf_lines))
+        if self.fail:
+            raise annotator.exceptions.RequestError("API request failed with status 503!")
+        if any(line[3] == "X" for line in vcf_lines):
+            raise annotator.exceptions.BadRequestError("Could not parse variant")
+        return [{"input": backends.variant_query(line), "variant_class": "SNV",
+                 "per_gene": params["per_gene"]} for line in vcf_lines]
+
+def variants(start, n, alt = "T"):
+    "Build n Variants from a position"
+    return [vcf.Variant("1", pos, "A", alt, "PASS", 5, 10) for pos in range(start, start + n)]
+
+class test_annotation_service(unittest.TestCase):
+    """ Unit tests for the AnnotationService class """
+    def setUp(self):
+        self.upstream = batch_backend()
+        self.params = vep.vep_parameters(False)
+
+    def annotate_concurrently(self, url, requests_lines):
+        "Send several requests to a service at once, and return their results"
+        client = backends.RestBackend(url, max_retries = 0)
+        with concurrent.futures.ThreadPoolExecutor(len(requests_lines)) as executor:
+            futures = [executor.submit(client.annotate, lines, self.params)
+                       for lines in requests_lines]
+            return [future.result() for future in futures]
+
+    def test_coalesces_requests(self):
+        """
+        Test that concurrent requests are sent to the backend together, within the window
+        """
+        requests_lines = [variants(100, 10), variants(200, 10), variants(300, 10)]
+        with service.AnnotationService(self.upstream, port = 0, window = 0.5) as s:
+            results = self.annotate_concurrently(s.url, requests_lines)
+        self.assertEqual(self.upstream.batches, [30])
+        for lines, result in zip(requests_lines, results):
+            self.assertEqual([r["input"] for r in result], list(map(backends.variant_query, lines)))
+
+    def test_full_batches_and_cache(self):
+        """
+        Test that full batches are sent without waiting for the window, and that annotations are
+        served from memory afterwards
+        """
+        lines = variants(100, 25)
+        with service.AnnotationService(self.upstream, port = 0, batch_size = 10,
+                                       window = 0.05) as s:
+            client = backends.RestBackend(s.url)
+            first = client.annotate(lines, self.params)
+            self.assertEqual(sorted(self.upstream.batches), [5, 10, 10])
+            self.assertEqual(client.annotate(lines, self.params), first)
+            self.assertEqual(len(self.upstream.batches), 3)
+            ## Other parameters are annotated separately
+            per_gene = client.annotate(lines[:1], vep.vep_parameters(True))
+            self.assertEqual(per_gene[0]["per_gene"], "true")
+            stats = requests.get(s.url + "/stats", timeout = 10).json()
+        self.assertEqual(stats["cache_hits"], 25)
+        self.assertEqual(stats["batches"], 4)
+
+    def test_rejected_variants_isolated(self):
+        """
+        Test that only the requests with a rejected variant fail, and that the client then
+        isolates the variant
+        """
+        good = variants(100, 10)
+        bad = variants(200, 5) + variants(300, 1, alt = "X")
+        with service.AnnotationService(self.upstream, port = 0, window = 0.2) as s:
+            results = self.annotate_concurrently(s.url, [good, good[:3]])
+            self.assertEqual(len(results[1]), 3)
+            client = backends.RestBackend(s.url, max_retries = 0)
+            with self.assertRaises(annotator.exceptions.BadRequestError):
+                client.annotate(bad, self.params)
+            annotations = vep.get_chunked_annotations(bad, backend = client)
+        self.assertEqual(["error" in a for a in annotations], [False] * 5 + [True])
+
+    def test_backend_failure(self):
+        """
+        Test that a failing backend is reported to the client as a failed request
+        """
+        with service.AnnotationService(batch_backend(fail = True), port = 0, window = 0) as s:
+            with self.assertRaises(annotator.exceptions.RequestError):
+                backends.RestBackend(s.url, max_retries = 0).annotate(variants(1, 2), self.params)
+            self.assertEqual(requests.post(s.url + "/vep/mus_musculus/region", json = {},
+                                           timeout = 10).status_code, 404)
+
+    def test_run_annotator(self):
+        """
+        Test that a run through the service writes the same output as a run on its backend
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vcf_path = os.path.join(tmpdir, "in.vcf")
+            with open(vcf_path, "w", encoding = "utf-8") as f:
+                f.write(HEADER + "".join(f"1\t{pos}\t.\tA\tT\t50\tPASS\t.\tNR:NV\t10:5\n"
+                                         for pos in range(1, 60)))
+            outputs = []
+            with service.AnnotationService(self.upstream, port = 0) as s:
+                for backend in (batch_backend(), backends.RestBackend(s.url)):
+                    output = os.path.join(tmpdir, f"out{len(outputs)}.tsv")
+                    main.run_annotator(vcf_path, output, "NR", "NV", backend = backend)
+                    with open(output, encoding = "utf-8") as f:
+                        outputs.append(f.read())
+        self.assertEqual(outputs[0], outputs[1])
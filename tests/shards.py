@@ -0,0 +1,137 @@
+""" This module implements testing for the shards module. """
+import gzip
+import os
+import random
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import annotator.exceptions
+from annotator import bgzf, main, shards, vcf
+
+HEADER = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n"
+
+def write_vcf(path, n_records):
+    "Write a VCF of random variants, BGZF compressed if the path ends in .gz, and return its path"
+    rng = random.Random(0)
+    lines = [HEADER]
+    pos = 0
+    for i in range(n_records):
+        pos += rng.randint(1, 1000)
+        ref = rng.choice("ACGT")
+        alts = rng.sample([base for base in "ACGT" if base != ref], 2 if i % 20 == 0 else 1)
+        if i % 7 == 0:
+            alts[0] = ref + "".join(rng.choice("ACGT") for _ in range(rng.randint(1, 6)))
+        total = rng.randint(10, 400)
+        nr = ",".join([str(total)] * len(alts))
+        nv = ",".join(str(rng.randint(1, total)) for _ in alts)
+        lines.append(f"{1 + i * 3 // n_records}\t{pos}\t.\t{ref}\t{','.join(alts)}\t50\t"
+                     f"{rng.choice(['PASS', 'alleleBias'])}\t.\tGT:NR:NV\t0/1:{nr}:{nv}\t./.\n")
+    data = "".join(lines).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(bgzf.compress(data) if path.endswith(".gz") else data)
+    return path
+
+class test_shards(unittest.TestCase):
+    """ Unit tests for parsing VCFs in shards """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.vcf_path = write_vcf(os.path.join(self.tmpdir.name, "in.vcf"), 2000)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def serial(self, path, **kwargs):
+        "Parse a VCF serially, as run_annotator() does"
+        return list(vcf.iter_parse_vcf(vcf.iter_vcf(path), "NR", "NV", **kwargs))
+
+    def test_shard_ranges(self):
+        """
+        Test that shards cover the whole file, and that BGZF shards start on block boundaries
+        """
+        ranges = shards.shard_ranges(self.vcf_path, None, shard_bytes = 10000)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], os.path.getsize(self.vcf_path))
+        self.assertTrue(all(a[1] == b[0] for a, b in zip(ranges, ranges[1:])))
+
+        path = write_vcf(os.path.join(self.tmpdir.name, "in.vcf.gz"), 5000)
+        offsets = bgzf.block_offsets(path)
+        ranges = shards.shard_ranges(path, "bgzf", shard_bytes = 30000)
+        self.assertGreater(len(ranges), 1)
+        self.assertEqual(ranges[-1][1], os.path.getsize(path))
+        self.assertTrue(all(start in offsets for start, _ in ranges))
+
+    def test_parallel_matches_serial(self):
+        """
+        Test that parsing in shards, plain or BGZF compressed, gives the same variants in the same
+        order as parsing serially
+        """
+        expected = self.serial(self.vcf_path)
+        parsed = list(shards.iter_parse_vcf_parallel(self.vcf_path, "NR", "NV", processes = 2,
+                                                     shard_bytes = 4099))
+        self.assertEqual(parsed, expected)
+
+        path = write_vcf(os.path.join(self.tmpdir.name, "in.vcf.gz"), 2000)
+        parsed = list(shards.iter_parse_vcf_parallel(path, "NR", "NV", processes = 2,
+                                                     shard_bytes = 20000))
+        self.assertEqual(parsed, expected)
+
+    def test_samples(self):
+        """
+        Test parsing a multi-sample VCF in shards, with a last line lacking its newline
+        """
+        path = os.path.join(self.tmpdir.name, "samples.vcf")
+        with open(path, "w", encoding = "utf-8") as f:
+            f.write(HEADER)
+            f.write("".join(f"1\t{pos}\t.\tC\tA,T\t50\tPASS\t.\tGT:NR:NV\t1/2:20,20:5,6\t./.\n"
+                            for pos in range(1, 500)))
+            f.write("2\t7\t.\tG\tA\t50\tPASS\t.\tGT:NR:NV\t0/1:10:5\t0/1:8:4")
+        expected = list(vcf.iter_parse_vcf_samples(vcf.iter_vcf(path), "NR", "NV"))
+        parsed = list(shards.iter_parse_vcf_parallel(path, "NR", "NV", samples = "all",
+                                                     processes = 2, shard_bytes = 1000))
+        self.assertEqual(parsed, expected)
+        self.assertEqual(parsed[-1], ("s2", vcf.Variant("2", 7, "G", "A", "PASS", 4, 8)))
+
+    def test_gzip_serial(self):
+        """
+        Test that a gzip compressed VCF is parsed serially
+        """
+        with open(self.vcf_path, "rb") as f:
+            data = f.read()
+        path = os.path.join(self.tmpdir.name, "in.vcf.gz")
+        with open(path, "wb") as f:
+            f.write(gzip.compress(data))
+        with self.assertLogs("annotator.shards", level = "INFO"):
+            parsed = list(shards.iter_parse_vcf_parallel(path, "NR", "NV", processes = 2,
+                                                         shard_bytes = 4096))
+        self.assertEqual(parsed, self.serial(self.vcf_path))
+
+    def test_errors(self):
+        """
+        Test that unknown samples are reported before parsing, and truncated lines from a worker
+        """
+        with self.assertRaises(ValueError):
+            next(shards.iter_parse_vcf_parallel(self.vcf_path, "NR", "NV", sample_name = "s9",
+                                                processes = 2, shard_bytes = 4096))
+        with open(self.vcf_path, "a", encoding = "utf-8") as f:
+            f.write("1\t5\t.\tA\n" + "1\t6\t.\tA\tT\t50\tPASS\t.\tGT:NR:NV\t0/1:10:5\n" * 200)
+        with self.assertRaises(annotator.exceptions.MalformedDataError):
+            list(shards.iter_parse_vcf_parallel(self.vcf_path, "NR", "NV", processes = 2,
+                                                shard_bytes = 4096))
+
+    def test_run_annotator(self):
+        """
+        Test that run_annotator writes the same output whether it parses in shards or serially
+        """
+        annotation = {"variant_class": "SNV", "intergenic_consequences": [{"impact": "MODIFIER"}]}
+        outputs = []
+        with patch("annotator.vep.get_chunked_annotations",
+                   side_effect = lambda lines, **kwargs: [annotation] * len(lines)), \
+                patch("annotator.shards.SHARD_BYTES", 4096):
+            for parse_processes in (1, 2):
+                output = os.path.join(self.tmpdir.name, f"out{parse_processes}.tsv")
+                main.run_annotator(self.vcf_path, output, "NR", "NV",
+                                   parse_processes = parse_processes)
+                with open(output, encoding = "utf-8") as f:
+                    outputs.append(f.read())
+        self.assertEqual(outputs[0], outputs[1])
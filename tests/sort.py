@@ -0,0 +1,96 @@
+""" This module implements testing for the sort module. """
+import os
+import random
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from annotator import main, sort, vcf
+
+HEADER = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"
+
+class test_sort(unittest.TestCase):
+    """ Unit tests for the sort module """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_vcf(self, positions, contigs = ()):
+        "Write a VCF of (chrom, pos) sites, and return its path"
+        path = os.path.join(self.tmpdir.name, "in.vcf")
+        with open(path, "w", encoding = "utf-8") as f:
+            f.write("##fileformat=VCFv4.2\n")
+            f.writelines(f"##contig=<ID={contig},length=1000>\n" for contig in contigs)
+            f.write(HEADER)
+            for chrom, pos in positions:
+                f.write(f"{chrom}\t{pos}\t.\tA\tT\t50\tPASS\t.\tNR:NV\t10:5\n")
+        return path
+
+    def test_natural_order(self):
+        """
+        Test natural chromosome order, with and without a chr prefix, and ##contig order
+        """
+        names = ["chr10", "GL000192.1", "Y", "2", "MT", "chr1", "X", "GL000205.1", "GL00020.1"]
+        self.assertEqual(sorted(names, key = sort.natural_key),
+                         ["chr1", "2", "chr10", "X", "Y", "MT", "GL00020.1", "GL000192.1",
+                          "GL000205.1"])
+        key = sort.chromosome_key(["X", "2", "1"])
+        self.assertEqual(sorted(["1", "2", "X", "10", "3"], key = key), ["X", "2", "1", "3", "10"])
+
+    def test_parse_vcf_order(self):
+        """
+        Test that parse_vcf sorts chromosomes in natural rather than string order
+        """
+        path = self.write_vcf([("10", 5), ("2", 7), ("2", 3), ("X", 1), ("1", 9)])
+        variants = vcf.parse_vcf(vcf.read_vcf(path), "NR", "NV")
+        self.assertEqual([(v.chrom, v.pos) for v in variants],
+                         [("1", 9), ("2", 3), ("2", 7), ("10", 5), ("X", 1)])
+
+    def test_external_sort(self):
+        """
+        Test that sorting in spilled runs matches sorting in memory, and is stable
+        """
+        rng = random.Random(0)
+        items = [vcf.Variant(rng.choice(["1", "2", "10", "X"]), rng.randint(1, 50), "A", "T",
+                             "PASS", i, 10) for i in range(5000)]
+        key = sort.variant_key()
+        expected = sorted(items, key = key)
+        ## A tiny budget spills many runs
+        with patch("annotator.sort.SPILL_BATCH_SIZE", 100):
+            result = list(sort.iter_sorted(items, key, memory_mb = 0.05,
+                                           tmpdir = self.tmpdir.name))
+        self.assertEqual(result, expected)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+        self.assertEqual(list(sort.iter_sorted(items, key)), expected)
+        self.assertEqual(list(sort.iter_sorted([], key)), [])
+
+    def test_sorted_input_detected(self):
+        """
+        Test that sorted VCFs are detected, in natural and in ##contig order
+        """
+        sites = [("2", 1), ("2", 5), ("10", 1), ("X", 3)]
+        self.assertTrue(sort.vcf_is_sorted(self.write_vcf(sites)))
+        self.assertFalse(sort.vcf_is_sorted(self.write_vcf(sites[::-1])))
+        path = self.write_vcf([("X", 3), ("10", 1), ("2", 1), ("2", 5)],
+                              contigs = ["X", "10", "2"])
+        self.assertEqual(sort.read_contigs(path), ["X", "10", "2"])
+        self.assertTrue(sort.vcf_is_sorted(path, sort.read_contigs(path)))
+
+    def test_run_annotator_sort(self):
+        """
+        Test that run_annotator writes sorted output, and skips sorting sorted input
+        """
+        annotation = {"variant_class": "SNV", "intergenic_consequences": [{"impact": "MODIFIER"}]}
+        output = os.path.join(self.tmpdir.name, "out.tsv")
+        with patch("annotator.vep.get_chunked_annotations",
+                   side_effect = lambda lines, **kwargs: [annotation] * len(lines)):
+            main.run_annotator(self.write_vcf([("10", 5), ("2", 7), ("1", 9)]), output, "NR",
+                               "NV", sort = True)
+            with open(output, encoding = "utf-8") as f:
+                self.assertEqual([l.split("\t")[0] for l in f][1:], ["1", "2", "10"])
+            with patch("annotator.sort.iter_sorted") as iter_sorted:
+                main.run_annotator(self.write_vcf([("1", 9), ("2", 7)]), output, "NR", "NV",
+                                   sort = True)
+            iter_sorted.assert_not_called()
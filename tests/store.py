@@ -0,0 +1,171 @@
+""" This module implements testing for the store module. """
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from annotator import backends, cache, extract, journal, main, store, vcf, vep
+
+HEADER = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"
+
+class fake_backend(backends.AnnotationBackend):
+    """ A backend that annotates every variant with a transcript, a dbSNP and a COSMIC ID """
+    def annotate(self, vcf_lines, params):
+        return [
+            {"input": backends.variant_query(line), "variant_class": "SNV",
+             "transcript_consequences": [
+                 {"gene_id": f"G{line[1]}", "transcript_id": "T1", "impact": "LOW",
+                  "consequence_terms": ["intron_variant", "splice_region_variant"],
+                  "strand": 1},
+                 {"gene_id": f"G{line[1]}", "transcript_id": "T2", "impact": "MODIFIER",
+                  "consequence_terms": ["upstream_gene_variant"]}
+             ],
+             "colocated_variants": [
+                 {"id": f"rs{line[1]}", "frequencies": {line[3]: {"af": 0.25}}},
+                 {"id": f"COSV{line[1]}", "allele_string": "COSMIC_MUTATION"}
+             ]}
+            for line in vcf_lines
+        ]
+
+def variant(pos, alt = "T", chrom = "1"):
+    "Build a Variant at a position"
+    return vcf.Variant(chrom, pos, "A", alt, "PASS", 5, 10)
+
+class test_annotation_store(unittest.TestCase):
+    """ Unit tests for building and reading annotation stores """
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "annotations.store")
+        self.params = vep.storage_parameters(vep.vep_parameters(False))
+        self.variants = [variant(300, chrom = "2"), variant(100), variant(100, alt = "G"),
+                         variant(200), variant(50, chrom = "X")]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def record(self, variants):
+        "Record the responses of the fake backend for variants, and return the recording's path"
+        path = os.path.join(self.tmpdir.name, "recording.jsonl")
+        backends.RecordingBackend(fake_backend(), path).annotate(variants,
+                                                                 vep.vep_parameters(False))
+        return path
+
+    def test_lookups(self):
+        """
+        Test that stored variants are found, including alleles sharing a position, and that others
+        are misses
+        """
+        self.assertEqual(store.build_store([self.record(self.variants)], self.path), 5)
+        expected = [vep.prune_annotation(annotation)
+                    for annotation in fake_backend().annotate(self.variants, None)]
+        unknown = [variant(100, alt = "C"), variant(150), variant(1, chrom = "22")]
+        with store.AnnotationStore(self.path) as s:
+            self.assertEqual(len(s), 5)
+            self.assertEqual(s.get_many(self.variants + unknown, self.params),
+                             expected + [None] * 3)
+            self.assertEqual((s.hits, s.misses), (5, 3))
+            self.assertEqual(s.stats()["hit_rate"], 0.625)
+
+    def test_latest_wins_and_errors_skipped(self):
+        """
+        Test that the last annotation of a variant across sources is kept, and that rejected
+        variants are left out
+        """
+        first = self.record(self.variants[:2])
+        second = os.path.join(self.tmpdir.name, "responses.json")
+        with open(second, "w", encoding = "utf-8") as f:
+            f.write('[{"input": "2 300 . A T . . .", "variant_class": "deletion"},'
+                    ' {"input": "1 200 . A T . . .", "error": "bad allele"}]')
+        self.assertEqual(store.build_store([first, second], self.path), 2)
+        with store.AnnotationStore(self.path) as s:
+            self.assertEqual(s.lookup(self.variants[0]),
+                             {"input": "2 300 . A T . . .", "variant_class": "deletion"})
+            self.assertIsNone(s.lookup(self.variants[3]))
+
+    def test_legacy_and_repeated_lines(self):
+        """
+        Test that outputs with the legacy HGVSP and CONSEQUENCE_TERMS layout are read swapped back,
+        and that repeated lines of a variant don't duplicate its features
+        """
+        expected = [
+            ["1", "100", "A", "T", "PASS", "5", "10", "0.5", "SNV", "G1", "NA", "T1", "LOW",
+             "missense_variant", "ENSP1:p.Gly12Cys", "NA", "NA", "NA"],
+            ["1", "100", "A", "T", "PASS", "5", "10", "0.5", "SNV", "G1", "NA", "T2", "MODIFIER",
+             "intron_variant;NMD_transcript_variant", "NA", "NA", "NA", "NA"]
+        ]
+        legacy = [row[:13] + [row[14], row[13]] + row[15:] for row in expected]
+        repeated = [row[:4] + ["LowQual"] + row[5:] for row in legacy]
+        tsv_path = os.path.join(self.tmpdir.name, "legacy.tsv")
+        with open(tsv_path, "w", encoding = "utf-8") as f:
+            f.write("\t".join(extract.DEFAULT_EXTRACTOR.columns) + "\n")
+            f.writelines("\t".join(row) + "\n" for row in legacy + legacy + repeated)
+        with self.assertLogs("annotator.store", level = "WARNING"):
+            store.build_store([tsv_path], self.path)
+        with store.AnnotationStore(self.path) as s:
+            annotation = s.lookup(variant(100))
+        self.assertEqual(extract.DEFAULT_EXTRACTOR.extract(["1", "100", "A", "T", "PASS", "5",
+                                                            "10"], annotation), expected)
+
+    def test_parameters(self):
+        """
+        Test that a store is not used for other VEP parameters, and that sources for other
+        parameters are not read
+        """
+        recording = self.record(self.variants)
+        store.build_store([recording], self.path)
+        with store.AnnotationStore(self.path) as s:
+            with self.assertLogs("annotator.store", level = "WARNING"):
+                by_gene = vep.storage_parameters(vep.vep_parameters(True))
+                self.assertEqual(s.get_many(self.variants, by_gene), [None] * 5)
+        self.assertEqual(store.build_store([recording], self.path, by_gene = True), 0)
+        with open(self.path, "wb") as f:
+            f.write(b"not a store")
+        with self.assertRaises(ValueError):
+            store.AnnotationStore(self.path)
+
+    def test_sources(self):
+        """
+        Test that stores built from a journal, a cache or an output give the same output lines as
+        the annotations they were built from, without querying VEP
+        """
+        vcf_path = os.path.join(self.tmpdir.name, "in.vcf")
+        with open(vcf_path, "w", encoding = "utf-8") as f:
+            f.write(HEADER + "".join(f"{v.chrom}\t{v.pos}\t.\t{v.ref}\t{v.alt}\t50\tPASS\t.\t"
+                                     "NR:NV\t10:5\n" for v in self.variants))
+        output = os.path.join(self.tmpdir.name, "out.tsv")
+        main.run_annotator(vcf_path, output, "NR", "NV", backend = fake_backend())
+        with open(output, encoding = "utf-8") as f:
+            expected = f.read()
+
+        annotations = fake_backend().annotate(self.variants, None)
+        journal_path = os.path.join(self.tmpdir.name, "run.journal")
+        with journal.Journal(journal_path) as j:
+            j.record(self.variants, self.params,
+                     [vep.prune_annotation(annotation) for annotation in annotations])
+        cache_path = os.path.join(self.tmpdir.name, "cache.sqlite")
+        with cache.AnnotationCache(cache_path) as c:
+            c.put_many(self.variants, annotations, self.params)
+
+        for source in (journal_path, cache_path, output):
+            store.build_store([source], self.path)
+            with patch("annotator.vep.get_chunked_annotations",
+                       side_effect = lambda lines, **kwargs: [{}] * len(lines)) as annotate:
+                main.run_annotator(vcf_path, output + ".new", "NR", "NV", store_path = self.path)
+                self.assertEqual(annotate.call_args[0][0], [])
+            with open(output + ".new", encoding = "utf-8") as f:
+                self.assertEqual(f.read(), expected, source)
+
+    def test_only_unknown_variants_queried(self):
+        """
+        Test that annotate_variants only sends the variants missing from the store to VEP
+        """
+        store.build_store([self.record(self.variants[:3])], self.path)
+        sent = []
+        def annotate(lines, **kwargs):
+            sent.extend(lines)
+            return fake_backend().annotate(lines, None)
+        with store.AnnotationStore(self.path) as s, \
+                patch("annotator.vep.get_chunked_annotations", side_effect = annotate):
+            rows = vep.annotate_variants(self.variants, store = s)
+        self.assertEqual(sent, self.variants[3:])
+        self.assertEqual(rows, vep.annotate_variants(self.variants, backend = fake_backend()))
@@ -0,0 +1,121 @@
+""" This module implements testing for the transport module, without network access. """
+import socket
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import requests
+
+from annotator import transport
+
+class fake_response:
+    """ A minimal stand-in for requests.Response """
+    def __init__(self, status_code, headers = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class fake_session:
+    """ A session that replays a fixed sequence of responses or exceptions """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        """ Return (or raise) the next response """
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class test_post(unittest.TestCase):
+    """ Unit tests for the retrying post function """
+    def test_retry_after_is_honoured(self):
+        """
+        Test that a 429 is retried after the delay in its Retry-After header
+        """
+        session = fake_session([fake_response(429, {"Retry-After": "2"}), fake_response(200)])
+        with patch("annotator.transport.time.sleep") as sleep:
+            response = transport.post(session, "http://test")
+        self.assertEqual(response.status_code, 200)
+        sleep.assert_called_once_with(2.0)
+
+    def test_exponential_backoff(self):
+        """
+        Test that server errors and connection failures back off exponentially
+        """
+        session = fake_session([fake_response(503), requests.ConnectionError(), fake_response(200)])
+        with patch("annotator.transport.time.sleep") as sleep:
+            response = transport.post(session, "http://test", backoff = 1.0)
+        self.assertEqual(response.status_code, 200)
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertTrue(0.5 <= delays[0] <= 1.0)
+        self.assertTrue(1.0 <= delays[1] <= 2.0)
+
+    def test_retry_after_is_capped(self):
+        """
+        Test that a Retry-After longer than max_backoff is capped, for the rate limiter too
+        """
+        session = fake_session([fake_response(503, {"Retry-After": "86400"}), fake_response(200)])
+        rate_limiter = Mock()
+        with patch("annotator.transport.time.sleep") as sleep:
+            transport.post(session, "http://test", rate_limiter = rate_limiter, max_backoff = 5)
+        sleep.assert_called_once_with(5)
+        rate_limiter.pause.assert_called_once_with(5)
+
+    def test_no_retry_on_name_resolution_error(self):
+        """
+        Test that a host name that doesn't resolve fails at once, without backing off
+        """
+        error = requests.ConnectionError()
+        error.__context__ = socket.gaierror(-2, "Name or service not known")
+        session = fake_session([error, fake_response(200)])
+        with patch("annotator.transport.time.sleep") as sleep:
+            with self.assertRaises(requests.ConnectionError):
+                transport.post(session, "http://test")
+        sleep.assert_not_called()
+        self.assertEqual(session.calls, 1)
+
+    def test_no_retry_on_client_error(self):
+        """
+        Test that non-retryable statuses are returned immediately
+        """
+        session = fake_session([fake_response(400)])
+        self.assertEqual(transport.post(session, "http://test").status_code, 400)
+        self.assertEqual(session.calls, 1)
+
+    def test_out_of_retries(self):
+        """
+        Test that the last response is returned once retries are exhausted
+        """
+        session = fake_session([fake_response(429)] * 3)
+        with patch("annotator.transport.time.sleep"):
+            response = transport.post(session, "http://test", max_retries = 2)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(session.calls, 3)
+
+class test_token_bucket(unittest.TestCase):
+    """ Unit tests for the TokenBucket class """
+    def test_rate_is_limited(self):
+        """
+        Test that requests beyond the burst size are spaced out at the configured rate
+        """
+        bucket = transport.TokenBucket(50, capacity = 1)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_retry_after_header_formats(self):
+        """
+        Test parsing Retry-After given in seconds, as an HTTP date, and malformed
+        """
+        self.assertEqual(transport.retry_after(fake_response(429, {"Retry-After": "3"})), 3.0)
+        self.assertEqual(
+            transport.retry_after(
+                fake_response(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})
+            ),
+            0.0
+        )
+        self.assertIsNone(transport.retry_after(fake_response(429, {"Retry-After": "soon"})))
+        self.assertIsNone(transport.retry_after(fake_response(429)))
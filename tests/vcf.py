@@ -1,10 +1,12 @@
 """ This module implements testing for the vcf module. """
+import gzip
 import os
+import tempfile
 import unittest
 from unittest.mock import mock_open, patch
 
 import annotator.exceptions
-from annotator import vcf
+from annotator import bgzf, vcf
 
 
 class test_load_vcf(unittest.TestCase):
@@ -43,6 +45,78 @@ class test_load_vcf(unittest.TestCase):
             with self.assertRaises(annotator.exceptions.MalformedDataError):
                 vcf.read_vcf("dummy_path.vcf")
 
+class test_iter_vcf(unittest.TestCase):
+    """ Unit tests for the iter_vcf function """
+    def test_iter_matches_read(self):
+        """
+        Test that streaming a VCF yields the same lines as reading it in full
+        """
+        vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
+        self.assertEqual(list(vcf.iter_vcf(vcf_path)), vcf.read_vcf(vcf_path))
+
+    def test_iter_truncated_vcf(self):
+        """
+        Test that the lines before a truncated line are yielded before the error is raised
+        """
+        header = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n"
+        row = "1\t100\t.\tA\tT\t10\tPASS\t.\tNR:NV\t10:5\n"
+        m = mock_open(read_data = header + row + "1\t200\t.\tA\n")
+        with patch('builtins.open', m):
+            lines = vcf.iter_vcf("dummy_path.vcf")
+            self.assertEqual(len(next(lines)), 10)
+            self.assertEqual(next(lines)[1], "100")
+            with self.assertRaises(annotator.exceptions.MalformedDataError):
+                next(lines)
+
+class test_compressed_vcf(unittest.TestCase):
+    """ Unit tests for reading gzip and BGZF compressed VCFs """
+    def setUp(self):
+        self.vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
+        with open(self.vcf_path, "rb") as f:
+            self.data = f.read()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        """ Write data to a file in the temporary directory and return its path """
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_gzip_vcf(self):
+        """
+        Test that a gzip compressed VCF is detected and read like the uncompressed VCF
+        """
+        path = self.write("platypus.vcf.gz", gzip.compress(self.data))
+        self.assertEqual(bgzf.detect_compression(path), "gzip")
+        self.assertEqual(vcf.read_vcf(path), vcf.read_vcf(self.vcf_path))
+
+    def test_bgzf_vcf(self):
+        """
+        Test that a multi-block BGZF VCF is detected and read like the uncompressed VCF, with one or
+        several decompression threads
+        """
+        ## Repeat the body so the file spans several BGZF blocks
+        header, body = self.data.split(b"\n#CHROM", 1)
+        body = b"#CHROM" + body
+        lines = body.split(b"\n", 1)
+        data = header + b"\n" + lines[0] + b"\n" + (lines[1].rstrip(b"\n") + b"\n") * 100
+        path = self.write("platypus.vcf.gz", bgzf.compress(data))
+        self.assertEqual(bgzf.detect_compression(path), "bgzf")
+        expected = vcf.read_vcf(self.write("platypus.vcf", data))
+        self.assertEqual(len(expected), 1 + 17 * 100)
+        self.assertEqual(vcf.read_vcf(path), expected)
+        self.assertEqual(vcf.read_vcf(path, threads = 4), expected)
+
+    def test_plain_vcf(self):
+        """
+        Test that an uncompressed VCF is not detected as compressed
+        """
+        self.assertIsNone(bgzf.detect_compression(self.vcf_path))
+
 class test_parse_vcf(unittest.TestCase):
     """ Unit tests for the parse_vcf function """
     def test_parse_platypus_vcf(self):
@@ -95,7 +169,123 @@ class test_parse_vcf(unittest.TestCase):
                 "1/2:-1,-1,-1:8:99:169,169:75,92"
             ]
         ]
-        expected = [['3', '64527465', 'C', 'A', 'PASS', '75', '169'],
-                    ['3', '64527465', 'C', 'T', 'PASS', '92', '169']]
+        expected = [vcf.Variant('3', 64527465, 'C', 'A', 'PASS', 75, 169),
+                    vcf.Variant('3', 64527465, 'C', 'T', 'PASS', 92, 169)]
         vcf_parsed = vcf.parse_vcf(vcf_lines, "NR", "NV")
         self.assertEqual(vcf_parsed, expected)
+
+    def test_iter_parse_vcf_streams(self):
+        """
+        Test that iter_parse_vcf consumes its input lazily, one VCF line at a time
+        """
+        header = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "s"]
+        def lines():
+            yield header
+            yield ["1", "100", ".", "A", "T", ".", "PASS", ".", "NR:NV", "10:5"]
+            raise AssertionError("Read past the first data line")
+        parsed = vcf.iter_parse_vcf(lines(), "NR", "NV")
+        self.assertEqual(next(parsed), vcf.Variant("1", 100, "A", "T", "PASS", 5, 10))
+
+    def test_non_integer_counts(self):
+        """
+        Test that non-integer positions and read counts raise a MalformedDataError
+        """
+        header = ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "s"]
+        lines = [header, ["1", "100", ".", "A", "T", ".", "PASS", ".", "NR:NV", "10:x"]]
+        with self.assertRaises(annotator.exceptions.MalformedDataError):
+            vcf.parse_vcf(lines, "NR", "NV")
+
+class test_parse_vcf_samples(unittest.TestCase):
+    """ Unit tests for the iter_parse_vcf_samples function """
+    def setUp(self):
+        self.vcf_lines = [
+            ["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "s1", "s2",
+             "s3"],
+            ["3", "64527465", ".", "C", "A,T", "2906", "PASS", ".", "GT:NR:NV",
+             "1/2:169,169:75,92", "0/1:20,20:10,0", "./."],
+            ["4", "100", ".", "G", "A", "50", "PASS", ".", "GT:NR:NV",
+             "0/1:10:5", "0/0:12:0", "0/1:8:.",]
+        ]
+
+    def test_all_samples(self):
+        """
+        Test that every allele is yielded for every sample with coverage data
+        """
+        expected = [
+            ("s1", vcf.Variant("3", 64527465, "C", "A", "PASS", 75, 169)),
+            ("s2", vcf.Variant("3", 64527465, "C", "A", "PASS", 10, 20)),
+            ("s1", vcf.Variant("3", 64527465, "C", "T", "PASS", 92, 169)),
+            ("s2", vcf.Variant("3", 64527465, "C", "T", "PASS", 0, 20)),
+            ("s1", vcf.Variant("4", 100, "G", "A", "PASS", 5, 10)),
+            ("s2", vcf.Variant("4", 100, "G", "A", "PASS", 0, 12))
+        ]
+        self.assertEqual(list(vcf.iter_parse_vcf_samples(self.vcf_lines, "NR", "NV")), expected)
+
+    def test_selected_samples(self):
+        """
+        Test selecting samples by name, and error handling of unknown samples
+        """
+        parsed = list(vcf.iter_parse_vcf_samples(self.vcf_lines, "NR", "NV", samples = ["s2"]))
+        self.assertEqual([sample for sample, _ in parsed], ["s2"] * 3)
+        with self.assertRaises(ValueError):
+            list(vcf.iter_parse_vcf_samples(self.vcf_lines, "NR", "NV", samples = ["s4"]))
+
+
+class test_scan_vcf(unittest.TestCase):
+    """ Unit tests for the iter_scan_vcf function """
+    def setUp(self):
+        self.vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data):
+        """ Write a VCF to the temporary directory and return its path """
+        path = os.path.join(self.tmpdir.name, "scan.vcf")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_scan_matches_parse(self):
+        """
+        Test that scanning a VCF yields the same variants as parsing it, uncompressed or not
+        """
+        expected = list(vcf.iter_parse_vcf(vcf.iter_vcf(self.vcf_path), "NR", "NV"))
+        self.assertEqual(list(vcf.iter_scan_vcf(self.vcf_path, "NR", "NV")), expected)
+        with open(self.vcf_path, "rb") as f:
+            path = self.write(bgzf.compress(f.read()))
+        self.assertEqual(list(vcf.iter_scan_vcf(path, "NR", "NV")), expected)
+
+    def test_scan_columns(self):
+        """
+        Test scanning a named sample, a wide INFO column, CRLF line endings and a last line without
+        a newline
+        """
+        header = b"##INFO=<ID=ANN>\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n"
+        rows = [b"1\t100\t.\tA\tT,G\t10\tPASS\tANN=" + b"x|" * 5000
+                + b"\tNR:NV\t10,10:5,1\t8,8:4,2",
+                b"2\t7\t.\tAC\tA\t10\tq10\t.\tGT:NR:NV\t0/1:9:3\t0/1:6:1"]
+        path = self.write(header + b"\r\n".join(rows))
+        self.assertEqual(list(vcf.iter_scan_vcf(path, "NR", "NV", sample_name = "s2")), [
+            vcf.Variant("1", 100, "A", "T", "PASS", 4, 8),
+            vcf.Variant("1", 100, "A", "G", "PASS", 2, 8),
+            vcf.Variant("2", 7, "AC", "A", "q10", 1, 6)
+        ])
+        with self.assertRaises(ValueError):
+            next(vcf.iter_scan_vcf(path, "NR", "NV", sample_name = "s3"))
+
+    def test_scan_malformed(self):
+        """
+        Test that truncated lines and non-integer read counts raise a MalformedDataError, after the
+        variants before them are yielded
+        """
+        header = b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tsample\n"
+        row = b"1\t100\t.\tA\tT\t10\tPASS\t.\tNR:NV\t10:5\n"
+        for bad in (b"1\t200\t.\tA\n", b"1\t200\t.\tA\tT\t10\tPASS\t.\tNR:NV\t10:x\n"):
+            variants = vcf.iter_scan_vcf(self.write(header + row + bad), "NR", "NV")
+            self.assertEqual(next(variants).pos, 100)
+            with self.assertRaises(annotator.exceptions.MalformedDataError):
+                next(variants)
+        with self.assertRaises(annotator.exceptions.MalformedDataError):
+            next(vcf.iter_scan_vcf(self.write(b""), "NR", "NV"))
@@ -1,8 +1,16 @@
 """ This module implements testing for the vep and main modules """
 import os
+import tempfile
+import time
 import unittest
+from unittest.mock import patch
 
-from annotator import vcf, vep, main
+from annotator import backends, cache, exceptions, extract, vcf, vep, main
+
+## Synthetic VEP responses for the variants these tests annotate, so that they run without network.
+## They were written in the format of the VEP REST API, not captured from it: the platypus.vcf ones
+## from the annotations in output/main/variants.tsv, the others by hand.
+RESPONSES_PATH = os.path.join(os.path.dirname(__file__), "data", "synthetic_vep_responses.jsonl")
 
 class test_get_variant_annotations(unittest.TestCase):
     """ Unit tests for the get_variant_annotations function """
@@ -13,7 +21,8 @@ class test_get_variant_annotations(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations = vep.get_variant_annotations(vcf_parsed)
+        annotations = vep.get_variant_annotations(vcf_parsed,
+                                                  backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(vcf_parsed), len(annotations))
 
     def test_get_variant_annotations_empty_vcf(self):
@@ -23,9 +32,20 @@ class test_get_variant_annotations(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "empty.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations = vep.get_variant_annotations(vcf_parsed)
+        annotations = vep.get_variant_annotations(vcf_parsed,
+                                                  backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(annotations), 0)
 
+    def test_default_backend(self):
+        """
+        Test that the default backend is created on first use and then shared
+        """
+        vep.default_backend.cache_clear()
+        with patch("annotator.backends.RestBackend") as rest_backend:
+            self.assertIs(vep.default_backend(), vep.default_backend())
+            rest_backend.assert_called_once_with()
+        vep.default_backend.cache_clear()
+
 class test_chunked_annotations(unittest.TestCase):
     """ Unit tests for the get_chunked_annotations function """
     def test_chunked_vep_size_1(self):
@@ -35,7 +55,8 @@ class test_chunked_annotations(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations = vep.get_chunked_annotations(vcf_parsed[0:2], 1)
+        annotations = vep.get_chunked_annotations(vcf_parsed[0:2], 1,
+                                                  backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(annotations), 2)
 
     def test_chunked_vep_same_size(self):
@@ -45,7 +66,8 @@ class test_chunked_annotations(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations = vep.get_chunked_annotations(vcf_parsed[0:2], 2)
+        annotations = vep.get_chunked_annotations(vcf_parsed[0:2], 2,
+                                                  backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(annotations), 2)
 
     def test_chunked_vep_gr_size(self):
@@ -55,7 +77,8 @@ class test_chunked_annotations(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations = vep.get_chunked_annotations(vcf_parsed[0:2], 3)
+        annotations = vep.get_chunked_annotations(vcf_parsed[0:2], 3,
+                                                  backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(annotations), 2)
 
     def test_chunked_vep_emptydata(self):
@@ -65,9 +88,77 @@ class test_chunked_annotations(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "empty.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations = vep.get_chunked_annotations(vcf_parsed)
+        annotations = vep.get_chunked_annotations(vcf_parsed,
+                                                  backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(annotations), 0)
 
+    def test_chunked_vep_concurrent_order(self):
+        """
+        Test that concurrently dispatched chunks are returned in input order, even when later
+        chunks finish first
+        """
+        variant_lines = [["1", str(pos), "A", "T", "PASS", 1, 2] for pos in range(10)]
+        def fake_annotations(vcf_lines, **kwargs):
+            ## Earlier chunks take longer, so they finish last
+            time.sleep(0.01 * (10 - int(vcf_lines[0][1])))
+            return [{"input": line[1]} for line in vcf_lines]
+        with patch("annotator.vep.get_variant_annotations", side_effect = fake_annotations):
+            annotations = vep.get_chunked_annotations(variant_lines, 3, max_workers = 4)
+        self.assertEqual([a["input"] for a in annotations], [str(pos) for pos in range(10)])
+
+    def test_chunked_vep_bisects_rejected_chunks(self):
+        """
+        Test that a chunk rejected with a 400 is bisected, so only the malformed variants are
+        rejected, and that rejected variants aren't cached
+        """
+        variant_lines = [["1", str(pos), "A", "T", "PASS", 1, 2] for pos in range(16)]
+        variant_lines[5][3] = "<DEL>"
+        sizes = []
+        def fake_annotations(vcf_lines, **kwargs):
+            sizes.append(len(vcf_lines))
+            if any(line[3] == "<DEL>" for line in vcf_lines):
+                raise exceptions.BadRequestError("Could not parse variant")
+            return [{"input": line[1]} for line in vcf_lines]
+        with patch("annotator.vep.get_variant_annotations", side_effect = fake_annotations):
+            with self.assertLogs("annotator.vep", level = "WARNING"):
+                annotations = vep.get_chunked_annotations(variant_lines, 8)
+            self.assertEqual([a.get("error") for a in annotations],
+                             [None] * 5 + ["Could not parse variant"] + [None] * 10)
+            ## The first chunk of 8 is split into 4 + 4, then 2 + 2, then 1 + 1
+            self.assertEqual(sizes, [8, 4, 4, 2, 1, 1, 2, 8])
+            with tempfile.TemporaryDirectory() as tmpdir, self.assertLogs("annotator.vep"):
+                with cache.AnnotationCache(os.path.join(tmpdir, "cache.sqlite")) as c:
+                    vep.get_cached_annotations(variant_lines, c, chunk_size = 8)
+                    self.assertEqual(c.stores, 15)
+
+    def test_chunked_vep_matches_on_input(self):
+        """
+        Test that responses are matched to variants on their input field, so that reordered
+        responses stay aligned and dropped ones become errors, with or without workers
+        """
+        variant_lines = [["1", str(pos), "A", "T", "PASS", 1, 2] for pos in range(10)]
+        class shuffling_backend(backends.AnnotationBackend):
+            def annotate(self, vcf_lines, params):
+                ## Reverse the responses, and drop the one for position 3
+                return [{"input": backends.variant_query(line), "variant_class": line[1]}
+                        for line in reversed(vcf_lines) if line[1] != "3"]
+        for max_workers in (1, 4):
+            with self.assertLogs("annotator.vep", level = "WARNING"):
+                annotations = vep.get_chunked_annotations(variant_lines, 3,
+                                                          max_workers = max_workers,
+                                                          backend = shuffling_backend())
+            self.assertEqual([a.get("variant_class") for a in annotations],
+                             ["0", "1", "2", None, "4", "5", "6", "7", "8", "9"])
+            self.assertEqual(annotations[3]["input"], "1 3 . A T . . .")
+            self.assertIn("error", annotations[3])
+
+    def test_chunked_vep_bad_max_workers(self):
+        """
+        Test that a non-positive number of workers is rejected
+        """
+        with self.assertRaises(ValueError):
+            vep.get_chunked_annotations([], max_workers = 0)
+
 class test_merge_variant_annotation(unittest.TestCase):
     """ Unit tests for the merge_variant_annotation function """
     def test_intergenic_variant(self):
@@ -77,9 +168,10 @@ class test_merge_variant_annotation(unittest.TestCase):
         variant_list = [["9", "82929050", "A", "T", "PASS", 100, 150]]
         expected_output = [
             ['9', '82929050', 'A', 'T', 'PASS', 100, 150, '0.66667', 'SNV', 'NA',
-             'NA', 'NA', 'MODIFIER', 'NA', 'intergenic_variant', 'NA', 'NA', 'NA']
+             'NA', 'NA', 'MODIFIER', 'intergenic_variant', 'NA', 'NA', 'NA', 'NA']
         ]
-        annotations = vep.annotate_variants(variant_list)
+        annotations = vep.annotate_variants(variant_list,
+                                            backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(annotations), 1)
         self.assertEqual(annotations, expected_output)
 
@@ -93,11 +185,12 @@ class test_merge_variant_annotation(unittest.TestCase):
                         ["9", "83004550", "T", "G", "PASS", 58, 92]]
         expected_output = [
             ['9', '82929050', 'A', 'T', 'PASS', 100, 150, '0.66667', 'SNV', 'NA', 'NA',
-             'NA', 'MODIFIER', 'NA', 'intergenic_variant', 'NA', 'NA', 'NA'],
+             'NA', 'MODIFIER', 'intergenic_variant', 'NA', 'NA', 'NA', 'NA'],
             ['9', '83004550', 'T', 'G', 'PASS', 58, 92, '0.63043', 'SNV', 'ENSG00000165105',
-             'RASEF', 'ENST00000376447', 'LOW', 'ENSP00000365630.3:p.Arg384=', 
-             'synonymous_variant', 'NA', 'NA', 'NA']]
-        annotations = vep.annotate_variants(variant_list)
+             'RASEF', 'ENST00000376447', 'LOW', 'synonymous_variant', 
+             'ENSP00000365630.3:p.Arg384=', 'NA', 'NA', 'NA']]
+        annotations = vep.annotate_variants(variant_list,
+                                            backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(annotations, expected_output)
 
     def test_known_pathogenic_variants(self):
@@ -105,14 +198,53 @@ class test_merge_variant_annotation(unittest.TestCase):
         Test some known pathogenic cancer variants: 
         (KRAS G12C, 12:25245351:G>T), 
         (BRAF V600E, 7:140753336:A>T)
-        Ensure that they return COSMIC IDs so they aren't missed in a real analysis
+        Ensure that their COSMIC IDs are written so they aren't missed in a real analysis. The
+        responses are synthetic, so this checks the extraction of COSMIC IDs, not what VEP returns.
         """
         variant_list = [["12", "25245351", "G", "T", "PASS", 100, 150],
                         ["7", "140753336", "A", "T", "PASS", 58, 92]]
-        annotations = vep.annotate_variants(variant_list)
+        annotations = vep.annotate_variants(variant_list,
+                                            backend = backends.ReplayBackend(RESPONSES_PATH))
         cosmic_ids = [line[16] for line in annotations]
         self.assertTrue(all(id.startswith("COS") for id in cosmic_ids))
 
+    def test_extractor_reused(self):
+        """
+        Test that merge_variant_annotation compiles one Extractor per consequences list
+        """
+        variant = ["1", "100", "A", "T", "PASS", 5, 10]
+        annotation = {"input": "1 100 . A T . . .", "variant_class": "SNV",
+                      "regulatory_feature_consequences": [{"impact": "MODIFIER"}]}
+        with patch("annotator.extract.Extractor", wraps = extract.Extractor) as extractor:
+            for _ in range(3):
+                lines = vep.merge_variant_annotation(variant, annotation,
+                                                     ["regulatory_feature_consequences"])
+        self.assertEqual(extractor.call_count, 1)
+        self.assertEqual(lines[0][8:13], ["SNV", "NA", "NA", "NA", "MODIFIER"])
+
+    def test_prune_annotation(self):
+        """
+        Test that pruning drops unused keys without changing the merged output
+        """
+        variant = ["9", "83004550", "T", "G", "PASS", 58, 92]
+        annotation = {
+            "input": "9 83004550 . T G . . .",
+            "variant_class": "SNV",
+            "most_severe_consequence": "synonymous_variant",
+            "transcript_consequences": [
+                {"gene_id": "ENSG00000165105", "gene_symbol": "RASEF", "impact": "LOW",
+                 "transcript_id": "ENST00000376447", "consequence_terms": ["synonymous_variant"],
+                 "cdna_start": 1277, "codons": "cgG/cgT", "strand": -1}
+            ]
+        }
+        pruned = vep.prune_annotation(annotation)
+        self.assertNotIn("most_severe_consequence", pruned)
+        self.assertNotIn("codons", pruned["transcript_consequences"][0])
+        self.assertEqual(pruned["input"], annotation["input"])
+        consequences_list = ["transcript_consequences", "intergenic_consequences"]
+        self.assertEqual(vep.merge_variant_annotation(variant, pruned, consequences_list),
+                         vep.merge_variant_annotation(variant, annotation, consequences_list))
+
 
 
 
@@ -125,7 +257,8 @@ class test_annotate_variants(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        out_list = vep.annotate_variants(vcf_parsed)
+        out_list = vep.annotate_variants(vcf_parsed,
+                                         backend = backends.ReplayBackend(RESPONSES_PATH))
         it = iter(out_list)
         the_len = len(next(it))
         self.assertTrue(all(len(l) == the_len for l in it))
@@ -137,7 +270,8 @@ class test_annotate_variants(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "empty.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations = vep.annotate_variants(vcf_parsed)
+        annotations = vep.annotate_variants(vcf_parsed,
+                                            backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(len(annotations), 0)
 
     def test_by_gene_arg(self):
@@ -148,7 +282,8 @@ class test_annotate_variants(unittest.TestCase):
         vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
         vcf_file = vcf.read_vcf(vcf_path)
         vcf_parsed = vcf.parse_vcf(vcf_file, "NR", "NV")
-        annotations_gene = vep.annotate_variants(vcf_parsed, by_gene = True)
+        annotations_gene = vep.annotate_variants(vcf_parsed, by_gene = True,
+                                                 backend = backends.ReplayBackend(RESPONSES_PATH))
         ## Get the gene IDs and show that the number of gene IDs == the length of the table
         gene_ids = set([str(line[1]) + "_" + line[3] + "_" + line[9] for line in annotations_gene])
         self.assertEqual(len(gene_ids), len(annotations_gene))
@@ -158,9 +293,27 @@ class test_annotate_variants(unittest.TestCase):
         Test that VAFs are correctly calculated
         """
         variant_list = [["9", "82929050", "A", "T", "PASS", 100, 200]]
-        annotations = vep.annotate_variants(variant_list)
+        annotations = vep.annotate_variants(variant_list,
+                                            backend = backends.ReplayBackend(RESPONSES_PATH))
         self.assertEqual(annotations[0][7], str(0.5))
 
+    def test_duplicate_variants_queried_once(self):
+        """
+        Test that duplicate alleles are only sent to the API once, and that every copy is annotated
+        """
+        variant_lines = [["1", "100", "A", "T", "PASS", 1, 2],
+                         ["1", "100", "A", "G", "PASS", 1, 4],
+                         ["1", "100", "A", "T", "LowQual", 3, 4]]
+        def fake_annotations(vcf_lines, **kwargs):
+            return [{"variant_class": line[3], "intergenic_consequences": [{"impact": "MODIFIER"}]}
+                    for line in vcf_lines]
+        with patch("annotator.vep.get_chunked_annotations",
+                   side_effect = fake_annotations) as fetch:
+            annotations = vep.annotate_variants(variant_lines)
+        self.assertEqual(fetch.call_args[0][0], variant_lines[:2])
+        self.assertEqual([line[8] for line in annotations], ["T", "G", "T"])
+        self.assertEqual([line[7] for line in annotations], ["0.5", "0.25", "0.75"])
+
 class test_main(unittest.TestCase):
     """ Unit tests for the run_annotator function """
     def test_correct_dims(self):
@@ -169,11 +322,102 @@ class test_main(unittest.TestCase):
         columns
         """
         ## This should return 23 rows
-        output = main.run_annotator(
-            os.path.join(os.path.dirname(__file__), "data", "platypus.vcf"),
-            "/dev/null", 
-            "NR", "NV")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, "variants.tsv")
+            n_rows = main.run_annotator(
+                os.path.join(os.path.dirname(__file__), "data", "platypus.vcf"),
+                output_path,
+                "NR", "NV",
+                backend = backends.ReplayBackend(RESPONSES_PATH))
+            with open(output_path, encoding = "UTF-8") as f:
+                output = [l.rstrip("\n").split("\t") for l in f][1:]
+        self.assertEqual(n_rows, 23)
         self.assertEqual(len(output), 23)
         it = iter(output)
         the_len = len(next(it))
         self.assertTrue(all(len(l) == the_len for l in it))
+
+    def test_bad_batch_sizes(self):
+        """
+        Test that run_annotator refuses chunk sizes and numbers of workers below 1, rather than
+        writing an empty output
+        """
+        vcf_path = os.path.join(os.path.dirname(__file__), "data", "platypus.vcf")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, "variants.tsv")
+            for kwargs in ({"max_workers": 0}, {"max_workers": -1}, {"chunk_size": 0}):
+                with self.assertRaises(ValueError):
+                    main.run_annotator(vcf_path, output_path, "NR", "NV",
+                                       backend = backends.ReplayBackend(RESPONSES_PATH), **kwargs)
+            self.assertFalse(os.path.exists(output_path))
+
+    def test_streaming_output(self):
+        """
+        Test that each batch of rows is written to the output before the next batch is annotated
+        """
+        annotation = {"variant_class": "SNV", "intergenic_consequences": [{"impact": "MODIFIER"}]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_path = os.path.join(tmpdir, "out", "variants.tsv")
+            rows_on_disk = []
+            def fake_annotations(variant_lines, **kwargs):
+                with open(output_path, encoding = "UTF-8") as f:
+                    rows_on_disk.append(len(f.readlines()) - 1)
+                return [annotation] * len(variant_lines)
+            with patch("annotator.vep.get_chunked_annotations", side_effect = fake_annotations):
+                n_rows = main.run_annotator(
+                    os.path.join(os.path.dirname(__file__), "data", "platypus.vcf"),
+                    output_path,
+                    "NR", "NV",
+                    chunk_size = 5)
+        self.assertEqual(n_rows, 18)
+        self.assertEqual(rows_on_disk, [0, 5, 10, 15])
+
+    def test_multi_sample_single_pass(self):
+        """
+        Test that a multi-sample VCF is annotated in one pass, querying each site once and writing
+        one row per sample
+        """
+        header = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\ts2\n"
+        rows = "".join(
+            f"1\t{pos}\t.\tA\tT\t50\tPASS\t.\tNR:NV\t10:{pos % 10}\t20:5\n"
+            for pos in range(100, 110)
+        )
+        annotation = {"variant_class": "SNV", "intergenic_consequences": [{"impact": "MODIFIER"}]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vcf_path = os.path.join(tmpdir, "multi.vcf")
+            with open(vcf_path, "w", encoding = "UTF-8") as f:
+                f.write(header + rows)
+            output_path = os.path.join(tmpdir, "variants.tsv")
+            with patch("annotator.vep.get_chunked_annotations",
+                       side_effect = lambda lines, **kwargs: [annotation] * len(lines)) as fetch:
+                n_rows = main.run_annotator(vcf_path, output_path, "NR", "NV", chunk_size = 4,
+                                            samples = "all")
+            with open(output_path, encoding = "UTF-8") as f:
+                output = [l.rstrip("\n").split("\t") for l in f]
+        self.assertEqual(n_rows, 20)
+        self.assertEqual(output[0][0], "SAMPLE")
+        self.assertEqual([line[0] for line in output[1:3]], ["s1", "s2"])
+        self.assertEqual([line[8] for line in output[1:3]], ["0.0", "0.25"])
+        ## 10 sites in batches of 4 sites: every site is queried exactly once
+        self.assertEqual([len(call.args[0]) for call in fetch.call_args_list], [4, 4, 2])
+
+    def test_multi_sample_zero_depth(self):
+        """
+        Test that a sample with no reads at a site is written with an NA variant read fraction
+        """
+        header = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n"
+        annotation = {"variant_class": "SNV", "intergenic_consequences": [{"impact": "MODIFIER"}]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            vcf_path = os.path.join(tmpdir, "multi.vcf")
+            with open(vcf_path, "w", encoding = "UTF-8") as f:
+                f.write(header + "1\t100\t.\tA\tT\t50\tPASS\t.\tGT:NR:NV\t0/1:10:5\t0/0:0:0\n")
+            output_path = os.path.join(tmpdir, "variants.tsv")
+            with patch("annotator.vep.get_chunked_annotations",
+                       side_effect = lambda lines, **kwargs: [annotation] * len(lines)):
+                n_rows = main.run_annotator(vcf_path, output_path, "NR", "NV", samples = "all")
+            with open(output_path, encoding = "UTF-8") as f:
+                output = [l.rstrip("\n").split("\t") for l in f]
+        self.assertEqual(n_rows, 2)
+        self.assertEqual([line[:1] + line[6:9] for line in output[1:]],
+                         [["S1", "5", "10", "0.5"], ["S2", "0", "0", "NA"]])
+